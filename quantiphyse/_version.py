@@ -0,0 +1,3 @@
+__version__ = '0.0.0'
+__timestamp__ = ''
+__license__ = ''
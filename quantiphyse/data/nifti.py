@@ -24,12 +24,20 @@ import traceback
 import nibabel as nib
 import numpy as np
 
-from .qpdata import DataGrid, QpData, NumpyData, Metadata
+from .qpdata import DataGrid, QpData, NumpyData, Metadata, resident_nbytes
 
 LOG = logging.getLogger(__name__)
 
 QP_NIFTI_EXTENSION_CODE = 42
 
+#: Uncompressed, unscaled data larger than this size in bytes is kept memory mapped by
+#: ``raw()`` rather than being loaded into memory. If None, data is always loaded into memory
+MMAP_MIN_SIZE = 512*1024*1024
+
+#: Maximum size in bytes of the individual volumes of a data set cached in memory
+#: by ``volume()``. Least recently used volumes are evicted when this is exceeded
+VOLUME_CACHE_SIZE = 256*1024*1024
+
 class NiftiData(QpData):
     """
     QpData from a Nifti file
@@ -47,7 +55,14 @@ class NiftiData(QpData):
 
         self.rawdata = None
         self.voldata = None
+        self._vol_lru = []
+        self._voxel_image = None
         self.nifti_header = nii.header
+        # Data type of the array returned by raw(). Scaled data is converted to floating point
+        if getattr(nii.dataobj, "slope", 1) == 1 and getattr(nii.dataobj, "inter", 0) == 0:
+            self._dtype = nii.get_data_dtype()
+        else:
+            self._dtype = np.dtype(np.float64)
         metadata = None
         for ext in self.nifti_header.extensions:
             if ext.get_code() == QP_NIFTI_EXTENSION_CODE:
@@ -84,39 +99,190 @@ class NiftiData(QpData):
         grid = DataGrid(shape[:3], nii.header.get_best_affine(), units=xyz_units)
         QpData.__init__(self, fname, grid, nvols, vol_unit=vol_units, vol_scale=vol_scale, fname=fname, metadata=metadata)
 
+    def __getstate__(self):
+        state = QpData.__getstate__(self)
+        state["_voxel_image"] = None
+        return state
+
     def raw(self):
-        # NB: copy() converts data to an in-memory array instead of a numpy file memmap.
-        # Appears to improve speed drastically as well as stop a bug with accessing the subset of the array
-        # memmap has been designed to save space on ram by keeping the array on the disk but does
-        # horrible things with performance, and analysis especially when the data is on the network.
-        if self.rawdata is None:
-            nii = nib.load(self.fname)
-            #self.rawdata = nii.get_data().copy()
-            self.rawdata = nii.get_data()
-            self.rawdata = self._correct_dims(self.rawdata)
+        # Small data is loaded into memory. Memory mapping saves RAM by keeping the array on the
+        # disk but can do horrible things to performance, especially when the data is on the network.
+        # Large uncompressed data is kept memory mapped (see MMAP_MIN_SIZE) so it is never all
+        # resident in memory at once
+        with self._lock:
+            if self.rawdata is None:
+                nii = nib.load(self.fname)
+                if self._can_mmap(nii):
+                    LOG.debug("Memory mapping data from %s", self.fname)
+                    rawdata = nii.dataobj.get_unscaled()
+                else:
+                    rawdata = np.array(nii.dataobj)
+                self.rawdata = self._correct_dims(rawdata)
+
+            self.voldata = None
+            self._vol_lru = []
+            return self.rawdata
 
-        self.voldata = None
-        return self.rawdata
-        
     def volume(self, vol, qpdata=False):
         vol = min(vol, self.nvols-1)
-        if self.nvols == 1:
-            ret = self.raw()
-        elif self.rawdata is not None:
-            ret = self.rawdata[:, :, :, vol]
-        else:
-            if self.voldata is None:
-                self.voldata = [None,] * self.nvols
-            if self.voldata[vol] is None:
-                nii = nib.load(self.fname)
-                self.voldata[vol] = self._correct_dims(nii.dataobj[..., vol])
-            ret = self.voldata[vol]
+        with self._lock:
+            if self.nvols == 1:
+                ret = self.raw()
+            elif self.rawdata is not None:
+                ret = self.rawdata[:, :, :, vol]
+            else:
+                if self.voldata is None:
+                    self.voldata = [None,] * self.nvols
+                if self.voldata[vol] is None:
+                    nii = nib.load(self.fname)
+                    self.voldata[vol] = self._correct_dims(np.asarray(nii.dataobj[..., vol]))
+                    self._vol_lru.append(vol)
+                    self._evict_volumes()
+                else:
+                    self._vol_lru.remove(vol)
+                    self._vol_lru.append(vol)
+                ret = self.voldata[vol]
 
         if qpdata:
             return NumpyData(ret, grid=self.grid, name="%s_vol_%i" % (self.name, vol))
         else:
             return ret
 
+    def uncache(self):
+        """
+        Remove cached data arrays from memory
+
+        The data will be re-read from the file when next required. If the data has
+        been modified in place (see ``clear_cache()``) it no longer matches the file
+        and only derived data is removed
+        """
+        LOG.debug("Uncaching %s", self.name)
+        with self._lock:
+            QpData.uncache(self)
+            if self.version > 0:
+                return
+            self.rawdata = None
+            self.voldata = None
+            self._vol_lru = []
+            self._voxel_image = None
+
+    @property
+    def dtype(self):
+        with self._lock:
+            if self.rawdata is not None:
+                return self.rawdata.dtype
+        return self._dtype
+
+    @property
+    def resident_size(self):
+        with self._lock:
+            size = resident_nbytes(self.rawdata) + super(NiftiData, self).resident_size
+            if self.voldata is not None:
+                size += sum([resident_nbytes(voldata) for voldata in self.voldata])
+            return size
+
+    def range(self, vol=None, percentile=100, roi=None):
+        if vol is None and roi is None and percentile == 100 and self._meta.get("range", None) is None:
+            with self._lock:
+                loaded = self.rawdata is not None and not isinstance(self.rawdata, np.memmap)
+            if not loaded and (self.nvols > 1 or isinstance(self.raw(), np.memmap)):
+                # Find the range of data which is not in memory one volume at a time so
+                # the whole data set is not needed in memory at once
+                dmin, dmax = [], []
+                for idx in range(self.nvols):
+                    voldata = self.volume(idx)
+                    voldata = voldata[np.isfinite(voldata)]
+                    if voldata.size > 0:
+                        dmin.append(np.min(voldata))
+                        dmax.append(np.max(voldata))
+                if dmin:
+                    self._meta["range"] = min(dmin), max(dmax)
+        return QpData.range(self, vol, percentile, roi)
+
+    def _voxel_value(self, data_pos, vol):
+        vol = min(vol, self.nvols-1)
+        with self._lock:
+            if self.rawdata is None and (self.voldata is None or self.voldata[vol] is None):
+                # Read just the voxel required from the file
+                value = self._read_voxels(data_pos, vol)
+                if value is not None:
+                    return value
+        return QpData._voxel_value(self, data_pos, vol)
+
+    def _voxel_timeseries(self, data_pos):
+        with self._lock:
+            if self.rawdata is None:
+                # Read just the voxel timeseries from the file
+                timeseries = self._read_voxels(data_pos)
+                if timeseries is not None:
+                    return timeseries
+        return QpData._voxel_timeseries(self, data_pos)
+
+    def _read_voxels(self, data_pos, vol=None):
+        """
+        Read data for a single voxel directly from the file
+
+        This is only done for uncompressed files, where the voxel can be read without
+        decompressing the file up to that point. The image proxy is kept so
+        the header is not re-read on every call. Must be called while holding the data lock
+
+        :param data_pos: Voxel co-ordinates in the data grid
+        :param vol: Volume index. If not specified, return values for all volumes
+        :return: Voxel value or Numpy array of values for each volume, or None
+                 if the file cannot be read in this way
+        :raises IndexError: If the position is outside the data
+        """
+        if self._meta.get("raw_2dt", False) or self.fname.endswith(".gz"):
+            return None
+
+        if self._voxel_image is None:
+            self._voxel_image = nib.load(self.fname)
+        nii = self._voxel_image
+        if len(nii.shape) not in (3, 4) or not nib.is_proxy(nii.dataobj):
+            return None
+
+        if min(data_pos) < 0 or any([pos >= size for pos, size in zip(data_pos, self.grid.shape)]):
+            raise IndexError("Position outside data: %s" % str(data_pos))
+
+        index = tuple(data_pos[:3])
+        if len(nii.shape) == 4:
+            if vol is None:
+                index += (slice(None),)
+            else:
+                index += (vol,)
+
+        voxel_data = np.asarray(nii.dataobj[index])
+        if voxel_data.ndim == 0:
+            return voxel_data[()]
+        else:
+            return voxel_data
+
+    def _evict_volumes(self):
+        """
+        Remove least recently used volumes from memory until the cache is
+        within VOLUME_CACHE_SIZE. The most recently used volume is always kept.
+        Must be called while holding the data lock
+        """
+        cache_size = sum([self.voldata[vol].nbytes for vol in self._vol_lru])
+        while cache_size > VOLUME_CACHE_SIZE and len(self._vol_lru) > 1:
+            vol = self._vol_lru.pop(0)
+            cache_size -= self.voldata[vol].nbytes
+            self.voldata[vol] = None
+
+    def _can_mmap(self, nii):
+        """
+        :return: True if the data in ``nii`` should be kept memory mapped
+        """
+        if MMAP_MIN_SIZE is None:
+            return False
+
+        nbytes = int(np.prod(nii.shape)) * nii.get_data_dtype().itemsize
+        dataobj = nii.dataobj
+        return (nbytes >= MMAP_MIN_SIZE and nib.is_proxy(dataobj) and
+                not self.fname.endswith(".gz") and
+                getattr(dataobj, "slope", 1) == 1 and getattr(dataobj, "inter", 0) == 0 and
+                hasattr(dataobj, "get_unscaled"))
+
     def _correct_dims(self, arr):
         while arr.ndim < 3:
             arr = np.expand_dims(arr, -1)
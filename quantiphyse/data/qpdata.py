@@ -29,8 +29,13 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import os
 import logging
 import math
+import tempfile
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 import scipy
@@ -54,6 +59,10 @@ from . import extras
 #: Used to determine if matrices are diagonal or identity
 EQ_TOL = 1e-3
 
+#: Maximum size in bytes of resampled copies of each data item which are cached
+#: by ``QpData.resample()``
+RESAMPLE_CACHE_SIZE = 256*1024*1024
+
 LOG = logging.getLogger(__name__)
 
 def is_diagonal(mat):
@@ -81,6 +90,15 @@ def is_ortho_vector(vec, shape=1):
             return axis, math.copysign(1, val)
     return None, None
 
+def resident_nbytes(arr):
+    """
+    :return: Size in bytes of a Numpy array held in memory, or 0 if it is None or memory mapped
+    """
+    if arr is None or isinstance(arr, np.memmap):
+        return 0
+    else:
+        return arr.nbytes
+
 def remove_nans(x, replace_val=0):
     """
     Remove NANs from a Numpy array
@@ -93,6 +111,88 @@ def remove_nans(x, replace_val=0):
     x[~np.isfinite(x)] = replace_val
     return x
 
+def _axis_coords(scale, offset, size, in_size):
+    """
+    :return: Tuple of input grid co-ordinates along an axis for each output voxel,
+             and boolean array which is True where these are within the input data
+    """
+    coords = scale * np.arange(size) + offset
+    return coords, np.logical_and(coords >= 0, coords <= in_size - 1)
+
+def _zero_invalid(data, valid):
+    """
+    Set output voxels to zero where they are outside the range of the input data,
+    consistent with ``scipy.ndimage`` in ``constant`` mode
+
+    :param valid: Sequence of boolean arrays, one for each axis
+    """
+    for axis, axis_valid in enumerate(valid):
+        if not np.all(axis_valid):
+            invalid = [slice(None)] * data.ndim
+            invalid[axis] = ~axis_valid
+            data[tuple(invalid)] = 0
+
+def _resample_separable(data, scale, offset, output, order):
+    """
+    Resample a 3D volume using an axis-aligned scaling and translation
+
+    Nearest neighbour resampling is an index lookup using the nearest input voxel along
+    each axis. Linear interpolation is separable so is done as a sequence of 1D interpolations
+    along each axis in double precision, as ``scipy.ndimage``. Axes which reduce the size of
+    the data the most are done first so the intermediate arrays are as small as possible.
+
+    :param scale: Sequence of scale factors from output to input grid co-ordinates
+    :param offset: Sequence of offsets from output to input grid co-ordinates
+    :param output: Array to write the resampled volume to
+    :param order: 0 for nearest neighbour, 1 for linear interpolation
+    """
+    coords, valid = zip(*[_axis_coords(scale[axis], offset[axis], output.shape[axis], data.shape[axis]) 
+                          for axis in range(3)])
+    if order == 0:
+        nearest = [np.floor(np.where(axis_valid, axis_coords + 0.5, 0)).astype(np.intp)
+                   for axis_coords, axis_valid in zip(coords, valid)]
+        output[...] = data[np.ix_(*nearest)]
+    else:
+        ret = data
+        for axis in sorted(range(3), key=lambda axis: float(output.shape[axis]) / data.shape[axis]):
+            weight_shape = [1, 1, 1]
+            weight_shape[axis] = -1
+            lower = np.floor(np.where(valid[axis], coords[axis], 0))
+            frac = (coords[axis] - lower).reshape(weight_shape)
+            lower = lower.astype(np.intp)
+            upper = np.minimum(lower + 1, data.shape[axis] - 1)
+            ret = np.take(ret, lower, axis=axis) * (1 - frac) + np.take(ret, upper, axis=axis) * frac
+        output[...] = ret
+
+    _zero_invalid(output, valid)
+
+def _map_volumes(fn, data, output_shape):
+    """
+    Apply a resampling function to each volume of 3D or 4D data
+
+    Volumes of 4D data are resampled in parallel using threads. This is effective
+    because the Numpy and Scipy functions used release the GIL.
+
+    :param fn: Function taking input volume and output array to write resampled data to
+    :param data: 3D or 4D Numpy array
+    :param output_shape: 3D shape of resampled volumes
+    :return: Resampled data with the same data type as the input
+    """
+    if data.ndim == 3:
+        output = np.empty(output_shape, dtype=data.dtype)
+        fn(data, output)
+        return output
+
+    from quantiphyse.processes.process import get_pool_size
+    nvols = data.shape[3]
+    output = np.empty(list(output_shape) + [nvols], dtype=data.dtype)
+    pool = ThreadPool(max(1, min(nvols, get_pool_size())))
+    try:
+        pool.map(lambda vol: fn(data[..., vol], output[..., vol]), range(nvols))
+    finally:
+        pool.close()
+    return output
+
 class DataGrid(object):
     """
     Defines a regular 3D grid in some 'world' space
@@ -456,12 +556,19 @@ class QpData(object):
     :ivar metadata: General purpose metadata dictionary. Keys are strings and values are YAML
                     convertible objects limited to the basic YAML subset used in the batch system
                     (i.e. strings, numbers and lists/dicts of these)
+
+    Data may be read from background threads (e.g. to prefetch slices) while it is being
+    used in the GUI thread, so cached data is accessed while holding ``_lock``. Subclasses
+    which cache data read from files should use the same lock.
     """
 
     def __init__(self, name, grid, nvols, roi=False, metadata=None, view=None, **kwargs):
         self.name = name
         self.grid = grid
 
+        # Guards cached data which may be accessed from background threads
+        self._lock = threading.RLock()
+
         # Number of volumes (1=3D data)
         self._nvols = nvols
 
@@ -474,6 +581,15 @@ class QpData(object):
             
         self.view = Metadata()
 
+        # Resampled data arrays, most recently used last
+        self._resample_cache = OrderedDict()
+
+        # Incremented when the data is modified in place
+        self._version = 0
+
+        # Minimum value of each volume, used to flag out of range values when slicing
+        self._vol_min = {}
+
         self._meta["fname"] = kwargs.get("fname", None)
         self._meta["vol_scale"] = kwargs.get("vol_scale", 1.0)
         self._meta["vol_units"] = kwargs.get("vol_units", None)
@@ -490,6 +606,17 @@ class QpData(object):
         if view is not None:
             self.view.update(view)
 
+    def __getstate__(self):
+        # Cached data is not pickled
+        state = dict(self.__dict__)
+        state["_resample_cache"] = OrderedDict()
+        state.pop("_lock", None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
     @property
     def metadata(self):
         """ Metadata dictionary """
@@ -592,6 +719,7 @@ class QpData(object):
         # The grid transform can't be properly interpreted because basically the file is broken,
         # so just make it 2D and hope the remaining transform is sensible
         self.grid.shape[2] = 1
+        self.clear_cache()
 
     def raw(self):
         """
@@ -642,9 +770,8 @@ class QpData(object):
             # Out of range but will be misinterpreted by indexing!
             value = 0
         else:
-            rawdata = self.volume(pos[3])
             try:
-                value = rawdata[tuple(data_pos)]
+                value = self._voxel_value(data_pos, pos[3])
             except IndexError:
                 value = 0
 
@@ -673,12 +800,36 @@ class QpData(object):
             # Out of range but will be misinterpreted by indexing!
             return []
         else:
-            rawdata = self.raw()
             try:
-                return list(rawdata[data_pos[0], data_pos[1], data_pos[2], :])
+                return list(self._voxel_timeseries(data_pos))
             except IndexError:
                 return []
 
+    def _voxel_value(self, data_pos, vol):
+        """
+        Get the value at a voxel
+
+        The default implementation uses ``volume()``. Subclasses may override this
+        to avoid loading the whole volume
+
+        :param data_pos: Voxel co-ordinates in the data grid
+        :param vol: Volume index
+        :raises IndexError: If the position is outside the data
+        """
+        return self.volume(vol)[tuple(data_pos)]
+
+    def _voxel_timeseries(self, data_pos):
+        """
+        Get the time/volume series at a voxel of multi-volume data
+
+        The default implementation uses ``raw()``. Subclasses may override this
+        to avoid loading the whole data set
+
+        :param data_pos: Voxel co-ordinates in the data grid
+        :raises IndexError: If the position is outside the data
+        """
+        return self.raw()[data_pos[0], data_pos[1], data_pos[2], :]
+
     def uncache(self):
         """
         Remove large stored data arrays from memory
@@ -689,8 +840,56 @@ class QpData(object):
         data from a file might implement the method to write the data out to a temporary
         file which is then re-read on the next call to ``raw()`` or ``volume()``
 
-        This method is optional and does not have to be implemented"""
-        pass
+        This method is optional and does not have to be implemented. The base class
+        implementation clears cached data derived from the raw data"""
+        with self._lock:
+            self._resample_cache.clear()
+
+    def clear_cache(self):
+        """
+        Clear cached data derived from the raw data, e.g. resampled copies
+
+        This must be called if the array returned by ``raw()`` is modified in place.
+        It also increments ``version`` so results derived from the data which are 
+        cached elsewhere are not reused, and removes the data range stored in the metadata
+        """
+        with self._lock:
+            self._resample_cache.clear()
+            self._vol_min.clear()
+            self._version += 1
+        self._meta.pop("range", None)
+
+    @property
+    def dtype(self):
+        """
+        Numpy dtype of the array returned by ``raw()``
+
+        Subclasses should override this if the data type can be found without
+        loading the data
+        """
+        return self.raw().dtype
+
+    @property
+    def version(self):
+        """
+        Number of times the data has been modified in place (see ``clear_cache()``)
+
+        Together with the identity of the data object this can be used to key
+        caches of results derived from the data
+        """
+        return self._version
+
+    @property
+    def resident_size(self):
+        """
+        Approximate size in bytes of the data arrays currently held in memory
+
+        Memory mapped data is not included. Subclasses which hold data in memory
+        should override this so it can be evicted using ``uncache()`` when necessary.
+        The base class implementation returns the size of cached data
+        """
+        with self._lock:
+            return sum([arr.nbytes for arr in self._resample_cache.values()])
 
     def range(self, vol=None, percentile=100, roi=None):
         """
@@ -804,9 +1003,22 @@ class QpData(object):
         """
         Resample the data onto a new grid
 
+        Resampling which requires interpolation is cached, so repeated resampling onto
+        the same grid is fast. See ``RESAMPLE_CACHE_SIZE``.
+
         :param grid: :class:`DataGrid` to resample the data on to
         :return: New :class:`QpData` object
         """
+        cache_key = (grid.affine.tobytes(), tuple(grid.shape), order,
+                     self.grid.affine.tobytes(), tuple(self.grid.shape), self.roi)
+        with self._lock:
+            data = self._resample_cache.pop(cache_key, None)
+            if data is not None:
+                self._resample_cache[cache_key] = data
+        if data is not None:
+            LOG.debug("Using cached resampled data for %s", self.name)
+            return self._resampled_data(data, grid, suffix)
+
         data = self.raw()
 
         LOG.debug("Resampling from:")
@@ -837,29 +1049,57 @@ class QpData(object):
             affine = tmatrix[:3, :3]
             offset = list(tmatrix[:3, 3])
             output_shape = list(grid.shape[:])
-            if data.ndim == 4:
-                # Make 4D affine with identity transform in 4th dimension
-                affine = np.append(affine, [[0, 0, 0]], 0)
-                affine = np.append(affine, [[0], [0], [0], [1]], 1)
-                offset.append(0)
-                output_shape.append(data.shape[3])
-
-            if is_diagonal(affine):
-                # The transformation is diagonal, so use faster sequence mode
-                affine = np.diagonal(affine)
-            #LOG.debug("WARNING: affine_transform: ")
-            #LOG.debug(affine)
-            #LOG.debug("Offset = ", offset)
-            #LOG.debug("Input shape=", data.shape, data.min(), data.max())
-            #LOG.debug("Output shape=", output_shape)
-            data = scipy.ndimage.affine_transform(data, affine, offset=offset,
-                                                  output_shape=output_shape, order=order)
+
+            if is_diagonal(affine) and (order == 0 or (order == 1 and data.dtype.kind in np.typecodes["AllFloat"])):
+                # The transformation is an axis-aligned scaling and translation. Nearest
+                # neighbour and linear interpolation are separable so can be done one axis
+                # at a time, which is much faster than a general affine transformation. 
+                # Nearest neighbour is the normal case for ROIs and is just an index lookup
+                scale = np.diagonal(affine)
+                def _resample(voldata, output):
+                    _resample_separable(voldata, scale, offset, output, order)
+            else:
+                if is_diagonal(affine):
+                    # The transformation is diagonal, so use faster sequence mode
+                    affine = np.diagonal(affine)
+                def _resample(voldata, output):
+                    scipy.ndimage.affine_transform(voldata, affine, offset=offset, output=output, order=order)
+            data = _map_volumes(_resample, data, output_shape)
 
             if self.roi:
                 # If source data was ROI, output should be, however resampling could have
                 # led to non-integer data
-                data = data.astype(np.int32)
+                data = data.astype(np.int32, copy=False)
+
+            self._cache_resampled(cache_key, data)
+            return self._resampled_data(data, grid, suffix)
+
+        return NumpyData(data=data, grid=grid, name=self.name + suffix, roi=self.roi, 
+                         metadata=self._meta, view=self.view)
+
+    def _cache_resampled(self, cache_key, data):
+        """
+        Add resampled data to the cache, removing least recently used data if
+        the cache is too big
+        """
+        if data.nbytes > RESAMPLE_CACHE_SIZE:
+            return
+
+        with self._lock:
+            self._resample_cache[cache_key] = data
+            cache_size = sum([arr.nbytes for arr in self._resample_cache.values()])
+            while cache_size > RESAMPLE_CACHE_SIZE:
+                _, arr = self._resample_cache.popitem(last=False)
+                cache_size -= arr.nbytes
 
+    def _resampled_data(self, data, grid, suffix):
+        """
+        :return: NumpyData for cached resampled data. The data is copied so the cached
+                 copy cannot be modified
+        """
+        if data.dtype.kind not in np.typecodes["AllFloat"]:
+            # NumpyData takes a copy of floating point data but not integer data
+            data = np.copy(data)
         return NumpyData(data=data, grid=grid, name=self.name + suffix, roi=self.roi, 
                          metadata=self._meta, view=self.view)
 
@@ -952,7 +1192,10 @@ class QpData(object):
                 smask = np.ones(sdata.shape)
             else:
                 # Generate mask by flagging out of range data with value less than data minimum
-                dmin = np.min(rawdata)
+                with self._lock:
+                    if vol not in self._vol_min:
+                        self._vol_min[vol] = np.min(rawdata)
+                    dmin = self._vol_min[vol]
                 sdata = pg.affineSlice(rawdata, slice_shape, slice_origin, slice_basis, range(3),
                                        order=interp_order, mode='constant', cval=dmin-100)
                 smask = np.ones(sdata.shape)
@@ -1023,9 +1266,59 @@ class NumpyData(QpData):
 
         QpData.__init__(self, name, grid, nvols, **kwargs)
 
+    # Temporary file holding the data when it has been spilled out of memory by ``uncache()``
+    _spill_fname = None
+
+    def __getstate__(self):
+        # Make sure spilled data is pickled
+        self.raw()
+        return QpData.__getstate__(self)
+
+    def __del__(self):
+        if self._spill_fname is not None:
+            try:
+                os.remove(self._spill_fname)
+            except Exception:
+                pass
+
     def raw(self):
-        if self._meta.get("raw_2dt", False) and self.rawdata.ndim == 3:
+        with self._lock:
+            if self.rawdata is None and self._spill_fname is not None:
+                LOG.debug("Reloading spilled data for %s from %s", self.name, self._spill_fname)
+                self.rawdata = np.load(self._spill_fname)
+                os.remove(self._spill_fname)
+                self._spill_fname = None
+            rawdata = self.rawdata
+
+        if self._meta.get("raw_2dt", False) and rawdata.ndim == 3:
             # Single-slice, interpret 3rd dimension as time
-            return np.expand_dims(self.rawdata, 2)
+            return np.expand_dims(rawdata, 2)
         else:
-            return self.rawdata
+            return rawdata
+
+    def uncache(self):
+        """
+        Spill the data to a temporary file which is re-read on the next call to ``raw()``
+        """
+        with self._lock:
+            QpData.uncache(self)
+            if resident_nbytes(self.rawdata) > 0:
+                fhandle, fname = tempfile.mkstemp(prefix="qp_spill_", suffix=".npy")
+                with os.fdopen(fhandle, "wb") as spill_file:
+                    np.save(spill_file, self.rawdata)
+                LOG.debug("Spilled data for %s to %s", self.name, fname)
+                self.rawdata = None
+                self._spill_fname = fname
+
+    @property
+    def dtype(self):
+        with self._lock:
+            if self.rawdata is None and self._spill_fname is not None:
+                # Only the header of spilled data needs to be read
+                return np.load(self._spill_fname, mmap_mode="r").dtype
+            return self.rawdata.dtype
+
+    @property
+    def resident_size(self):
+        with self._lock:
+            return resident_nbytes(self.rawdata) + super(NumpyData, self).resident_size
@@ -39,6 +39,10 @@ from .extras import Extra
 
 LOG = logging.getLogger(__name__)
 
+#: Default memory budget in bytes for data held in memory by an ImageVolumeManagement.
+#: If None, there is no limit
+MEMORY_BUDGET = None
+
 class ImageVolumeManagement(QtCore.QObject):
     """
     Holds all image datas used in analysis
@@ -54,6 +58,10 @@ class ImageVolumeManagement(QtCore.QObject):
       ``current_roi`` QpData with ``roi=True`` used as the current ROI
       ``extras`` Mapping from name to object for miscellaneous extra data.
                  Extras must support string-conversion for writing to files.
+      ``memory_budget`` Maximum bytes of data to hold in memory, or None for no limit.
+                        When exceeded, the least recently used data items which are not
+                        main, current or pinned (see ``pin()``) are removed from memory
+                        using ``uncache()``
     """
     # Signals
 
@@ -72,8 +80,12 @@ class ImageVolumeManagement(QtCore.QObject):
     # Change to set of extras (e.g. new one added)
     sig_extras = QtCore.Signal(list)
 
+    # Memory usage checked, passes dictionary of data name : bytes held in memory
+    sig_memory = QtCore.Signal(dict)
+
     def __init__(self):
         super(ImageVolumeManagement, self).__init__()
+        self.memory_budget = MEMORY_BUDGET
         self.reset()
 
     def reset(self):
@@ -83,6 +95,8 @@ class ImageVolumeManagement(QtCore.QObject):
         self.current_data = None
         self.current_roi = None
         self.extras = OrderedDict()
+        self._last_used = OrderedDict()
+        self._pinned = {}
 
         self.sig_main_data.emit(None)
         self.sig_current_data.emit(None)
@@ -132,7 +146,9 @@ class ImageVolumeManagement(QtCore.QObject):
         """
         self._data_exists(name)
         self.main = self.data[name]
+        self._touch(name)
         self.sig_main_data.emit(self.main)
+        self.check_memory()
 
     def add(self, data, name=None, grid=None, make_current=None, make_main=None, roi=None):
         """
@@ -176,6 +192,7 @@ class ImageVolumeManagement(QtCore.QObject):
             self.sig_all_data.emit(list(self.data.keys()))
 
         self.data[data.name] = data
+        self._touch(data.name)
 
         # Set z-order
         data.view.z_order = len(self.data)
@@ -200,6 +217,70 @@ class ImageVolumeManagement(QtCore.QObject):
             else:
                 self.set_current_data(data.name)
 
+        self.check_memory()
+
+    def memory_usage(self):
+        """
+        :return: Dictionary of data name : approximate bytes held in memory
+        """
+        return dict([(name, qpd.resident_size) for name, qpd in self.data.items()])
+
+    def check_memory(self):
+        """
+        Remove least recently used data from memory if the memory budget is exceeded
+
+        Data items which are the main data, current data/ROI or pinned are not
+        removed. Data is removed using ``QpData.uncache()`` and so will be reloaded
+        when it is next used, e.g. when other visible data is next drawn by the viewer.
+        """
+        usage = self.memory_usage()
+        total = sum(usage.values())
+        if self.memory_budget is not None and total > self.memory_budget:
+            for name in list(self._last_used.keys()):
+                if total <= self.memory_budget:
+                    break
+                qpd = self.data.get(name, None)
+                if qpd is None or usage[name] == 0 or self._in_use(qpd):
+                    continue
+                LOG.debug("Memory budget exceeded (%i > %i) - removing %s from memory", total, self.memory_budget, name)
+                qpd.uncache()
+                total -= usage[name]
+                usage[name] = qpd.resident_size
+                total += usage[name]
+
+        self.sig_memory.emit(usage)
+
+    def pin(self, name):
+        """
+        Prevent a data item from being removed from memory when the memory budget is exceeded
+
+        This should be used by code which holds on to the data arrays returned by ``raw()``,
+        e.g. to modify them in place. Each call must be matched by a call to ``unpin()``
+
+        :param name: Name of data item which must exist within the IVM
+        """
+        self._data_exists(name)
+        self._pinned[name] = self._pinned.get(name, 0) + 1
+
+    def unpin(self, name):
+        """
+        Allow a data item pinned by ``pin()`` to be removed from memory again
+
+        :param name: Name of data item. If it has been deleted, this does nothing
+        """
+        count = self._pinned.pop(name, 0) - 1
+        if count > 0:
+            self._pinned[name] = count
+        self.check_memory()
+
+    def _in_use(self, qpd):
+        return (self.is_main_data(qpd) or self.is_current_data(qpd) or self.is_current_roi(qpd) or
+                qpd.name in self._pinned)
+
+    def _touch(self, name):
+        self._last_used.pop(name, None)
+        self._last_used[name] = True
+
     def _data_exists(self, name):
         if name not in self.data:
             raise RuntimeError("Data '%s' does not exist" % name)
@@ -238,9 +319,11 @@ class ImageVolumeManagement(QtCore.QObject):
         if name is not None:
             self._data_exists(name)
             self.current_data = self.data[name]
+            self._touch(name)
         else:
             self.current_data = None
         self.sig_current_data.emit(self.current_data)
+        self.check_memory()
 
     def set_current(self, name):
         """
@@ -268,6 +351,10 @@ class ImageVolumeManagement(QtCore.QObject):
         qpd.name = newname
         del self.data[name]
         self.data[newname] = qpd
+        self._last_used.pop(name, None)
+        self._touch(newname)
+        if name in self._pinned:
+            self._pinned[newname] = self._pinned.pop(name)
         self.sig_all_data.emit(list(self.data.keys()))
 
     def delete(self, name):
@@ -278,6 +365,8 @@ class ImageVolumeManagement(QtCore.QObject):
         """
         self._data_exists(name)
         del self.data[name]
+        self._last_used.pop(name, None)
+        self._pinned.pop(name, None)
         if self.current_data is not None and self.current_data.name == name:
             self.current_data = None
             self.sig_current_data.emit(None)
@@ -285,6 +374,7 @@ class ImageVolumeManagement(QtCore.QObject):
             self.main = None
             self.sig_main_data.emit(None)
         self.sig_all_data.emit(list(self.data.keys()))
+        self.check_memory()
 
     def set_current_roi(self, name):
         """
@@ -295,9 +385,11 @@ class ImageVolumeManagement(QtCore.QObject):
         if name is not None:
             self._roi_exists(name)
             self.current_roi = self.rois[name]
+            self._touch(name)
         else:
             self.current_roi = None
         self.sig_current_roi.emit(self.current_roi)
+        self.check_memory()
 
     def add_extra(self, name, obj):
         """
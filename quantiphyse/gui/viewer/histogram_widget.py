@@ -18,12 +18,141 @@ limitations under the License.
 
 from __future__ import division, unicode_literals, absolute_import, print_function
 
+import logging
+import threading
+import weakref
+from collections import OrderedDict
+
+try:
+    from PySide import QtCore
+except ImportError:
+    from PySide2 import QtCore
+
 from matplotlib import cm
 import numpy as np
 
 import pyqtgraph as pg
 
-from quantiphyse.data.qpdata import remove_nans
+from quantiphyse.utils import stats
+
+LOG = logging.getLogger(__name__)
+
+#: Maximum number of histogram bins
+HIST_BINS = 500
+
+#: Maximum number of per-volume histograms cached
+HIST_CACHE_SIZE = 64
+
+# Histograms of individual volumes, shared between all histogram widgets. Keys identify
+# the data, its version and the volume. Values are a weak reference to the data, used to
+# detect reuse of the data's id, and the histogram
+_HISTOGRAMS = OrderedDict()
+_HISTOGRAMS_LOCK = threading.Lock()
+
+def _cache_get(qpdata, key):
+    with _HISTOGRAMS_LOCK:
+        cached = _HISTOGRAMS.pop(key, None)
+        if cached is None or cached[0]() is not qpdata:
+            return None
+        _HISTOGRAMS[key] = cached
+        return cached[1]
+
+def _cache_put(qpdata, key, value):
+    with _HISTOGRAMS_LOCK:
+        _HISTOGRAMS.pop(key, None)
+        _HISTOGRAMS[key] = (weakref.ref(qpdata), value)
+        while len(_HISTOGRAMS) > HIST_CACHE_SIZE:
+            _HISTOGRAMS.popitem(last=False)
+
+class _HistogramNotifier(QtCore.QObject):
+    """
+    Emits histograms calculated in the background thread. A single instance is
+    used which is never deleted, so it is safe to emit after the widget which
+    requested the histogram has been destroyed
+    """
+    sig_histogram = QtCore.Signal(object, object)
+
+_NOTIFIER = None
+
+# Histograms waiting to be calculated by the background thread. Keys identify the
+# widget making the request, so only its most recent request is acted on
+_PENDING = OrderedDict()
+_PENDING_CONDITION = threading.Condition()
+_WORKER = None
+
+def _notifier():
+    global _NOTIFIER
+    if _NOTIFIER is None:
+        _NOTIFIER = _HistogramNotifier()
+    return _NOTIFIER
+
+def _request_histogram(requester, qpdata, key):
+    """
+    Request a histogram to be calculated in the background thread. It is
+    emitted by the notifier when ready, with its cache key
+
+    :param requester: Identifier of the widget making the request
+    """
+    global _WORKER
+    with _PENDING_CONDITION:
+        _PENDING.pop(requester, None)
+        _PENDING[requester] = (qpdata, key)
+        if _WORKER is None:
+            _WORKER = threading.Thread(target=_worker)
+            _WORKER.daemon = True
+            _WORKER.start()
+        _PENDING_CONDITION.notify()
+
+def _worker():
+    while True:
+        with _PENDING_CONDITION:
+            while not _PENDING:
+                _PENDING_CONDITION.wait()
+            _, (qpdata, key) = _PENDING.popitem(last=False)
+        try:
+            _NOTIFIER.sig_histogram.emit(key, volume_histogram(qpdata, key[2]))
+        except Exception as exc: # pylint: disable=broad-except
+            # The histogram is not displayed, but this should not
+            # stop the thread handling later requests
+            LOG.debug("Failed to calculate histogram: %s", exc)
+        finally:
+            # Do not keep the data alive while waiting, so it is not destroyed in this thread
+            qpdata = None
+
+def histogram_bins(qpdata):
+    """
+    Get the histogram bin edges for a data set
+
+    The bins span the range of the whole data set, so histograms of different
+    volumes share the same axis. Integer data with a small range has one bin
+    per value.
+
+    :param qpdata: QpData instance
+    :return: Array of bin edges
+    """
+    dmin, dmax = [float(val) for val in qpdata.range()]
+    if qpdata.dtype.kind in "biu" and dmax - dmin < HIST_BINS:
+        return np.arange(dmin - 0.5, dmax + 1)
+    if dmin == dmax:
+        dmin, dmax = dmin - 0.5, dmax + 0.5
+    return np.linspace(dmin, dmax, HIST_BINS + 1)
+
+def volume_histogram(qpdata, vol):
+    """
+    Get the histogram of a single volume, using a cached copy if possible
+
+    :param qpdata: QpData instance
+    :param vol: Volume index
+    :return: Tuple of bin edges, counts
+    """
+    key = (id(qpdata), qpdata.version, vol)
+    cached = _cache_get(qpdata, key)
+    if cached is None:
+        edges = histogram_bins(qpdata)
+        hist, _ = stats.region_histogram([qpdata.volume(vol)], bins=len(edges)-1, hrange=(edges[0], edges[-1]))
+        cached = (edges, hist[0])
+        _cache_put(qpdata, key, cached)
+    return cached
 
 class HistogramWidget(pg.HistogramLUTWidget):
     """
@@ -35,7 +164,11 @@ class HistogramWidget(pg.HistogramLUTWidget):
     it is possible to set the custom_view property to substitute another
     set of viewing metadata. This is used to implement the 'background'
     main data view.
+
+    Histograms are calculated in a background thread and cached, so
+    scrolling through the volumes of 4D data does not block the GUI.
     """
+
     def __init__(self, ivl, *args, **kwargs):
         kwargs["fillHistogram"] = False
         super(HistogramWidget, self).__init__(*args, **kwargs)
@@ -47,6 +180,7 @@ class HistogramWidget(pg.HistogramLUTWidget):
         self._updating = False
 
         ivl.sig_focus_changed.connect(self._focus_changed)
+        _notifier().sig_histogram.connect(self._histogram_ready)
         self.sigLevelChangeFinished.connect(self._levels_changed)
         self.sigLevelsChanged.connect(self._levels_changed)
         self.sigLookupTableChanged.connect(self._lut_changed)
@@ -122,15 +256,27 @@ class HistogramWidget(pg.HistogramLUTWidget):
         if key in ("cmap", "cmap_range"):
             self._update_cmap()
 
+    def _histogram_key(self):
+        return (id(self._qpdata), self._qpdata.version, min(self._vol, self._qpdata.nvols-1))
+
     def _update_histogram(self):
-        if self._qpdata is not None:
-            arr = remove_nans(self._qpdata.volume(self._vol))
-            flat = arr.reshape(-1)
-            img = pg.ImageItem(flat.reshape([1, -1]))
-            hist = img.getHistogram()
-            if hist[0] is None:
-                return
-            self.plot.setData(*hist)
+        if self._qpdata is None:
+            return
+
+        key = self._histogram_key()
+        cached = _cache_get(self._qpdata, key)
+        if cached is not None:
+            self._show_histogram(cached)
+        else:
+            _request_histogram(id(self), self._qpdata, key)
+
+    def _histogram_ready(self, key, hist):
+        if self._qpdata is not None and key == self._histogram_key():
+            self._show_histogram(hist)
+
+    def _show_histogram(self, hist):
+        edges, counts = hist
+        self.plot.setData((edges[:-1] + edges[1:]) / 2, counts)
 
     def _update_cmap(self):
         if self.view is not None:
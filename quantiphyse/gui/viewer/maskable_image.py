@@ -29,14 +29,43 @@ from quantiphyse.utils.enums import Boundary
 
 LOG = logging.getLogger(__name__)
 
+#: Number of levels used to quantise floating point image data for rendering
+QUANT_LEVELS = 65536
+
 class MaskableImage(pg.ImageItem):
     """
     Minor addition to ImageItem to allow it to be masked by an ROI
+
+    For speed, each image is quantised once into indices into a set of values, and
+    rendering uses a lookup table from these values to colour, including transparency
+    from the mask and boundary mode. So changing the levels or colour map only 
+    requires the lookup table to be regenerated, not the whole image.
     """
     def __init__(self, image=None, **kwargs):
-        pg.ImageItem.__init__(self, image, **kwargs)
-        self.mask = None
+        self._mask = None
+        self._indices = None
+        self._index_values = None
+        self._argb = None
         self.boundary = Boundary.TRANS
+        pg.ImageItem.__init__(self, image, **kwargs)
+
+    @property
+    def mask(self):
+        """ Mask array - image is transparent where mask is zero """
+        return self._mask
+
+    @mask.setter
+    def mask(self, mask):
+        self._mask = mask
+        self._indices = None
+
+    def setImage(self, image=None, **kwargs):
+        """
+        Subclassed to invalidate the quantised image when new image data is set
+        """
+        if image is not None:
+            self._indices = None
+        pg.ImageItem.setImage(self, image, **kwargs)
 
     def set_boundary_mode(self, mode):
         """
@@ -60,22 +89,95 @@ class MaskableImage(pg.ImageItem):
         else:
             lut = self.lut
 
+        if self.image.ndim != 2 or self.image.size == 1 or self.levels is None or np.ndim(self.levels) != 1:
+            self._render_direct(lut)
+            return
+
+        if self._indices is None:
+            self._quantise()
+
+        values = self._index_values
+        if values is None:
+            self._render_direct(lut)
+            return
+
+        nlut = 256 if lut is None else len(lut)
+        if len(values) > 1 and (values[-1] - values[0]) * nlut > (self.levels[1] - self.levels[0]) * QUANT_LEVELS:
+            # Colour map range is too small relative to the quantisation
+            self._render_direct(lut)
+            return
+
+        # Lookup table from value index to ARGB, with an additional transparent entry for masked pixels
+        table, alpha = pg.functions.makeARGB(values[np.newaxis, :], lut=lut, levels=self.levels)
+        if not alpha:
+            # Transparency is not supported without an alpha channel in the lookup table
+            self._render_direct(lut)
+            return
+        table = np.append(table[0], np.zeros((1, 4), dtype=np.ubyte), axis=0)
+        table[:-1, 3][self._transparent(values)] = 0
+        table = np.ascontiguousarray(table).view(np.uint32).ravel()
+
+        if self._argb is None or self._argb.shape[:2] != self._indices.shape:
+            self._argb = np.empty(self._indices.shape + (4,), dtype=np.ubyte)
+        np.take(table, self._indices, out=self._argb.view(np.uint32)[..., 0])
+        self.qimage = pg.functions.makeQImage(self._argb, alpha, copy=False, transpose=False)
+
+    def _quantise(self):
+        """
+        Convert the image into indices into an array of values
+
+        Integer data is represented exactly. Floating point data is quantised into 
+        ``QUANT_LEVELS`` evenly spaced values. Masked pixels are given an index one 
+        past the end of the values array. The indices are stored transposed, ready for
+        conversion into a QImage
+        """
+        self._index_values = None
+        image = self.image
+        dmin, dmax = np.min(image), np.max(image)
+        if not np.isfinite(dmin) or not np.isfinite(dmax):
+            return
+
+        if image.dtype.kind in "biu" and int(dmax) - int(dmin) < QUANT_LEVELS:
+            values = np.arange(int(dmin), int(dmax) + 1)
+            indices = image.astype(np.intp) - int(dmin)
+        elif dmin == dmax:
+            values = np.array([dmin])
+            indices = np.zeros(image.shape, dtype=np.intp)
+        else:
+            values = np.linspace(dmin, dmax, QUANT_LEVELS)
+            scale = (QUANT_LEVELS - 1) / (float(dmax) - float(dmin))
+            indices = ((image - dmin) * scale + 0.5).astype(np.intp)
+
+        if self._mask is not None:
+            indices[self._mask == 0] = len(values)
+        self._indices = np.ascontiguousarray(indices.T)
+        self._index_values = values
+
+    def _transparent(self, values):
+        """
+        :return: Boolean array which is True for values which are transparent
+                 given the current levels and boundary mode
+        """
+        if self.boundary == Boundary.TRANS:
+            return np.logical_or(values < self.levels[0], values > self.levels[1])
+        elif self.boundary == Boundary.LOWERTRANS:
+            return values < self.levels[0]
+        elif self.boundary == Boundary.UPPERTRANS:
+            return values > self.levels[1]
+        else:
+            return np.zeros(values.shape, dtype=bool)
+
+    def _render_direct(self, lut):
+        """
+        Render the image without using the quantised image
+        """
         argb, alpha = pg.functions.makeARGB(self.image, lut=lut, levels=self.levels)
         if self.image.size > 1:
-            if self.mask is not None:
-                argb[:, :, 3][self.mask == 0] = 0
+            if self._mask is not None:
+                argb[:, :, 3][self._mask == 0] = 0
 
-            if self.boundary == Boundary.TRANS:
-                # Make out of range values transparent
-                trans = np.logical_or(self.image < self.levels[0], self.image > self.levels[1])
-                argb[:, :, 3][trans] = 0
-            elif self.boundary == Boundary.LOWERTRANS:
-                # Make out of range values transparent
-                trans = self.image < self.levels[0]
-                argb[:, :, 3][trans] = 0
-            elif self.boundary == Boundary.UPPERTRANS:
+            if self.boundary in (Boundary.TRANS, Boundary.LOWERTRANS, Boundary.UPPERTRANS):
                 # Make out of range values transparent
-                trans = self.image > self.levels[1]
-                argb[:, :, 3][trans] = 0
+                argb[:, :, 3][self._transparent(self.image)] = 0
 
         self.qimage = pg.functions.makeQImage(argb, alpha)
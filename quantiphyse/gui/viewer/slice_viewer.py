@@ -18,6 +18,12 @@ limitations under the License.
 
 from __future__ import division, unicode_literals, absolute_import
 
+import itertools
+import threading
+import weakref
+from collections import OrderedDict
+
+
 try:
     from PySide import QtGui, QtCore, QtGui as QtWidgets
 except ImportError:
@@ -40,6 +46,91 @@ MAIN_DATA = ""
 # data sets the viewer is ever likely to hold
 MAX_NUM_DATA_SETS = 1000
 
+#: Maximum number of extracted slices cached by each data view
+SLICE_CACHE_SIZE = 16
+
+#: Number of slices ahead in the scroll direction which are extracted in the background
+PREFETCH_SLICES = 3
+
+def label_boundaries(labels):
+    """
+    Find the boundaries of all labelled regions in a 2D slice
+
+    Boundaries are the edges between adjacent pixels with different labels, found in 
+    a single pass over the slice for all labels. Edges at the slice boundary are 
+    included for non-zero labels.
+
+    :param labels: 2D integer Numpy array of region labels
+    :return: Mapping from non-zero label to tuple of X and Y co-ordinate arrays, in pixel
+             units. Each consecutive pair of points is a line segment, suitable for 
+             drawing with ``connect="pairs"``
+    """
+    padded = np.pad(np.asarray(labels), 1, mode="constant")
+
+    # Edges between horizontal neighbours are vertical line segments and vice versa
+    left, right = padded[:-1, 1:-1], padded[1:, 1:-1]
+    xpos, ypos = np.nonzero(left != right)
+    vert_labels = [left[xpos, ypos], right[xpos, ypos]]
+    vert_x = np.stack([xpos, xpos], axis=1)
+    vert_y = np.stack([ypos, ypos + 1], axis=1)
+
+    lower, upper = padded[1:-1, :-1], padded[1:-1, 1:]
+    xpos, ypos = np.nonzero(lower != upper)
+    horiz_labels = [lower[xpos, ypos], upper[xpos, ypos]]
+    horiz_x = np.stack([xpos, xpos + 1], axis=1)
+    horiz_y = np.stack([ypos, ypos], axis=1)
+
+    # Each edge is part of the boundary of the regions on both sides of it
+    seg_labels = np.concatenate(vert_labels + horiz_labels)
+    seg_x = np.concatenate([vert_x, vert_x, horiz_x, horiz_x])
+    seg_y = np.concatenate([vert_y, vert_y, horiz_y, horiz_y])
+    nonzero = seg_labels != 0
+    seg_labels, seg_x, seg_y = seg_labels[nonzero], seg_x[nonzero], seg_y[nonzero]
+
+    order = np.argsort(seg_labels, kind="stable")
+    seg_labels, seg_x, seg_y = seg_labels[order], seg_x[order], seg_y[order]
+    boundaries = {}
+    unique_labels, starts = np.unique(seg_labels, return_index=True)
+    ends = list(starts[1:]) + [len(seg_labels)]
+    for label, start, end in zip(unique_labels, starts, ends):
+        boundaries[label] = (seg_x[start:end].ravel(), seg_y[start:end].ravel())
+    return boundaries
+
+# Slices waiting to be extracted by the prefetch thread, shared between all data views.
+# Keys are the ids of the requesting views, values are a weak reference to the view and
+# the list of slices still to be extracted. Views take turns to have a slice extracted
+_PREFETCH_PENDING = OrderedDict()
+_PREFETCH_CONDITION = threading.Condition()
+_PREFETCH_WORKER = None
+
+def _prefetch_worker():
+    """
+    Extract slices requested by ``SliceDataView.prefetch`` in a background thread
+
+    The thread only holds a weak reference to each view, and releases the data
+    as soon as each slice has been extracted, so they are never destroyed in this thread
+    """
+    while True:
+        with _PREFETCH_CONDITION:
+            while not _PREFETCH_PENDING:
+                _PREFETCH_CONDITION.wait()
+            key, (view_ref, items) = _PREFETCH_PENDING.popitem(last=False)
+            item = items.pop(0)
+            if items:
+                _PREFETCH_PENDING[key] = (view_ref, items)
+        view = view_ref()
+        try:
+            if view is not None:
+                plane, vol, interp_order, roi, resampled_roi = item
+                view._slice_data(plane, vol, interp_order)
+                if roi is not None:
+                    view._roi_slice_data(roi, plane, resampled_roi)
+        except Exception as exc: # pylint: disable=broad-except
+            # Prefetching is only an optimisation so failures are not reported
+            view.debug("Failed to prefetch slice: %s", exc)
+        finally:
+            view, items, item, roi, resampled_roi = None, None, None, None, None
+
 class SliceDataView(LogSource):
     """
     Draws a slice through a data item
@@ -70,6 +161,8 @@ class SliceDataView(LogSource):
         ]
         self._img = MaskableImage()
         self._contours = []
+        self._slice_cache = OrderedDict()
+        self._cache_lock = threading.Lock()
         self._viewbox.addItem(self._img)
         self._lut = get_lut(self._view.cmap, self._view.alpha)
         self.update()
@@ -142,8 +235,7 @@ class SliceDataView(LogSource):
             self._z_order += MAX_NUM_DATA_SETS
 
         if self._img.isVisible() or self._view.contour:
-            slicedata, slicemask, scale, offset = self._qpdata.slice_data(self._plane, vol=self._vol,
-                                                                          interp_order=interp_order)
+            slicedata, slicemask, scale, offset = self._slice_data(self._plane, self._vol, interp_order)
             self.debug("Image data range: %f, %f", np.min(slicedata), np.max(slicedata))
             qtransform = QtGui.QTransform(scale[0, 0], scale[0, 1],
                                           scale[1, 0], scale[1, 1],
@@ -154,42 +246,144 @@ class SliceDataView(LogSource):
             self._img.setZValue(self._z_order)
 
             if self._view.roi:
-                roi = self._ivm.data[self._view.roi]
-                resampled_roi = roi.resample(self._qpdata.grid)
-                maskdata, _, _, _ = resampled_roi.slice_data(self._plane)
+                maskdata = self._roi_slice_data(self._ivm.data[self._view.roi], self._plane)
                 self._img.mask = np.logical_and(maskdata, slicemask)
             else:
                 self._img.mask = slicemask
 
         n_contours = 0
         if self._qpdata.roi and self._view.contour and self._view.visible == Visibility.SHOW:
-            # Update data and level for existing contour items, and create new ones if needed
+            # Boundaries of all regions are found together and regions with the same
+            # colour are drawn as a single item. Existing items are reused where possible
             max_region = max(self._qpdata.regions.keys())
-            for val in self._qpdata.regions:
+            paths = OrderedDict()
+            for val, (xdata, ydata) in label_boundaries(slicedata).items():
                 # Contours do not have alpha transparency
-                pencol = get_col(self._lut, val, (1, max_region))[:3]
-                if val != 0:
-                    if n_contours == len(self._contours):
-                        self._contours.append(pg.IsocurveItem())
-                        self._viewbox.addItem(self._contours[n_contours])
-
-                    contour = self._contours[n_contours]
-                    contour.setTransform(qtransform)
-                    contour.setData((slicedata == val).astype(np.int))
-                    contour.setLevel(1)
-                    contour.setPen(pg.mkPen(pencol, width=3))
-                    contour.setZValue(self._z_order)
-                    n_contours += 1
-
-        # Clear data from contours not required - FIXME delete them?
+                pencol = tuple(get_col(self._lut, val, (1, max_region))[:3])
+                if pencol not in paths:
+                    paths[pencol] = ([], [])
+                paths[pencol][0].append(xdata)
+                paths[pencol][1].append(ydata)
+
+            for pencol, (xdata, ydata) in paths.items():
+                if n_contours == len(self._contours):
+                    self._contours.append(pg.PlotCurveItem())
+                    self._viewbox.addItem(self._contours[n_contours])
+
+                contour = self._contours[n_contours]
+                contour.setTransform(qtransform)
+                contour.setData(np.concatenate(xdata), np.concatenate(ydata), connect="pairs", 
+                                pen=pg.mkPen(pencol, width=3))
+                contour.setZValue(self._z_order)
+                contour.setVisible(True)
+                n_contours += 1
+
+        # Hide contour items which are not required
         for idx in range(n_contours, len(self._contours)):
-            self._contours[idx].setData(None)
+            self._contours[idx].setVisible(False)
+            self._contours[idx].clear()
+
+    def uses(self, name):
+        """
+        :return: True if the view displays the named data set or is masked by it
+        """
+        return self._qpdata.name == name or self._view.roi == name
+
+    def clear_cache(self):
+        """
+        Clear cached slices, e.g. if the data has been modified in place
+        """
+        with self._cache_lock:
+            self._slice_cache.clear()
+
+    def prefetch(self, planes, interp_order=0):
+        """
+        Extract slices in a background thread so they are cached when required
+
+        Any slices which have been requested but not yet extracted are discarded,
+        so only the most recent request is acted on.
+
+        :param planes: Sequence of OrthoSlice instances, in the order they should be extracted
+        """
+        global _PREFETCH_WORKER
+        if not planes or (not self._img.isVisible() and not self._view.contour):
+            return
+
+        # The ROI is resampled here rather than in the background thread as this
+        # creates a new data object. The resampled array is normally already cached
+        # by the ROI from the last redraw
+        roi, resampled_roi = self._ivm.data.get(self._view.roi, None), None
+        if roi is not None:
+            resampled_roi = (roi.version, roi.resample(self._qpdata.grid))
+
+        items = [(plane, self._vol, interp_order, roi, resampled_roi) for plane in planes]
+        with _PREFETCH_CONDITION:
+            _PREFETCH_PENDING.pop(id(self), None)
+            _PREFETCH_PENDING[id(self)] = (weakref.ref(self), items)
+            if _PREFETCH_WORKER is None:
+                _PREFETCH_WORKER = threading.Thread(target=_prefetch_worker)
+                _PREFETCH_WORKER.daemon = True
+                _PREFETCH_WORKER.start()
+            _PREFETCH_CONDITION.notify()
+
+    def _cached(self, key, extract_fn):
+        """
+        Get a cached slice, extracting it if it is not already in the cache
+
+        :param key: Cache key
+        :param extract_fn: Callable which extracts the slice if required
+        """
+        with self._cache_lock:
+            cached = self._slice_cache.pop(key, None)
+            if cached is not None:
+                self._slice_cache[key] = cached
+                return cached
+
+        cached = extract_fn()
+        with self._cache_lock:
+            self._slice_cache[key] = cached
+            while len(self._slice_cache) > SLICE_CACHE_SIZE:
+                self._slice_cache.popitem(last=False)
+        return cached
+
+    def _slice_data(self, plane, vol, interp_order):
+        """
+        Get slice data, using the cached copy if the slice has already been extracted
+
+        :return: Tuple of slice data, mask, scale and offset as returned by ``QpData.slice_data``
+        """
+        key = (self._qpdata.version, self._qpdata.grid.affine.tobytes(),
+               plane.affine.tobytes(), tuple(plane.shape), vol, interp_order)
+        return self._cached(key, lambda: self._qpdata.slice_data(plane, vol=vol, interp_order=interp_order))
+
+    def _roi_slice_data(self, roi, plane, resampled_roi=None):
+        """
+        Get a slice of an ROI used to mask the view, resampled onto the grid of the view data
+
+        Resampling uses the ROI's own cache of resampled data, so the resampled array
+        is shared between views. The slice is cached along with the data slices.
+
+        :param resampled_roi: Tuple of ROI version and ROI already resampled onto the view 
+                              data grid, if available
+        :return: Slice of the ROI data
+        """
+        if resampled_roi is not None:
+            version, resampled = resampled_roi
+        else:
+            version, resampled = roi.version, roi.resample(self._qpdata.grid)
+
+        key = ("roi", roi.name, id(roi), version, roi.grid.affine.tobytes(),
+               self._qpdata.grid.affine.tobytes(), plane.affine.tobytes(), tuple(plane.shape))
+        return self._cached(key, lambda: resampled.slice_data(plane)[0])
 
     def remove(self):
         """
         Remove the view from the viewbox
         """
         self.debug("Removing slice view")
+        with _PREFETCH_CONDITION:
+            _PREFETCH_PENDING.pop(id(self), None)
+        self.clear_cache()
         self._viewbox.removeItem(self._img)
         for contour in self._contours:
             self._viewbox.removeItem(contour)
@@ -297,6 +491,31 @@ class OrthoSliceViewer(pg.GraphicsView, LogSource):
     def redraw(self):
         """ Force a redraw of the viewer, e.g. if data has changed """
         for view in self._data_views.values():
+            view.clear_cache()
+            view.redraw()
+
+    def redraw_data(self, name, bbox=None):
+        """
+        Redraw only the views which use a data set that has been modified in place
+
+        :param name: Name of the data set
+        :param bbox: Optional tuple of slices bounding the modified voxels in the grid
+                     of the data. If the current slice does not intersect it, cached
+                     slices are discarded but nothing is redrawn
+        """
+        views = [view for view in self._data_views.values() if view.uses(name)]
+        for view in views:
+            view.clear_cache()
+
+        if bbox is not None:
+            # Find the range of the modified voxels along the slice normal in the viewer grid
+            corners = itertools.product(*[(sl.start - 0.5, sl.stop - 0.5) for sl in bbox])
+            zpos = [self._ivl.grid.grid_to_grid(list(corner), from_grid=self.ivm.data[name].grid)[self.zaxis]
+                    for corner in corners]
+            if self._slicez < min(zpos) or self._slicez > max(zpos):
+                return
+
+        for view in views:
             view.redraw()
 
     def _view_opts_changed(self, key, value):
@@ -403,6 +622,7 @@ class OrthoSliceViewer(pg.GraphicsView, LogSource):
             self._labels[left].setText("L")
 
     def _update_slice(self):
+        prev_slicez = self._slicez
         self._slicez = self._ivl.focus()[self.zaxis]
         self._vol = self._ivl.focus()[3]
         self._plane = OrthoSlice(self._ivl.grid, self.zaxis, self._slicez)
@@ -411,6 +631,14 @@ class OrthoSliceViewer(pg.GraphicsView, LogSource):
             view.vol = self._vol
         self.debug("set slice: %f %i", self._slicez, self._vol)
 
+        if self._slicez != prev_slicez:
+            # Extract the next few slices in the direction of scrolling in the background
+            step = 1 if self._slicez > prev_slicez else -1
+            planes = [OrthoSlice(self._ivl.grid, self.zaxis, self._slicez + step*idx) 
+                      for idx in range(1, PREFETCH_SLICES+1)]
+            for view in self._data_views.values():
+                view.prefetch(planes)
+
     def _update_visible_arrows(self):
         """
         Update arrows so only those visible are shown
@@ -218,6 +218,18 @@ class Viewer(QtGui.QSplitter, LogSource):
         for view in self.ortho_views.values():
             view.redraw()
 
+    def redraw_data(self, name, bbox=None):
+        """
+        Redraw a single data set which has been modified in place
+
+        :param name: Name of the data set
+        :param bbox: Optional tuple of slices bounding the modified voxels in the grid
+                     of the data. Views whose current slice does not intersect it are
+                     not redrawn
+        """
+        for view in self.ortho_views.values():
+            view.redraw_data(name, bbox)
+
     @property
     def picker(self):
         """ Current picker object """
@@ -28,6 +28,7 @@ except ImportError:
 
 from quantiphyse.data import NumpyData, OrthoSlice
 from quantiphyse.utils import QpException, table_to_extra, sf
+from quantiphyse.utils.stats import region_stats, region_counts
 from quantiphyse.processes import Process
 
 class CalcVolumesProcess(Process):
@@ -56,16 +57,15 @@ class CalcVolumesProcess(Process):
 
         if roi is not None:
             sizes = roi.grid.spacing
-            counts = np.bincount(roi.raw().flatten().astype(np.int))
+            regions = [region for region in roi.regions if sel_region is None or region == sel_region]
+            counts = region_counts(roi.raw(), regions)
             col_idx = 0
-            for region, name in roi.regions.items():
-                if sel_region is None or region == sel_region:
-                    nvoxels = counts[region] if region < len(counts) else 0
-                    vol = nvoxels*sizes[0]*sizes[1]*sizes[2]
-                    self.model.setHorizontalHeaderItem(col_idx, QtGui.QStandardItem(name))
-                    self.model.setItem(0, col_idx, QtGui.QStandardItem(str(nvoxels)))
-                    self.model.setItem(1, col_idx, QtGui.QStandardItem(str(vol)))
-                    col_idx += 1
+            for region, nvoxels in zip(regions, counts):
+                vol = nvoxels*sizes[0]*sizes[1]*sizes[2]
+                self.model.setHorizontalHeaderItem(col_idx, QtGui.QStandardItem(roi.regions[region]))
+                self.model.setItem(0, col_idx, QtGui.QStandardItem(str(nvoxels)))
+                self.model.setItem(1, col_idx, QtGui.QStandardItem(str(vol)))
+                col_idx += 1
 
         if not options.pop('no-extras', False):
             output_name = options.pop('output-name', "roi-vols")
@@ -145,7 +145,6 @@ class DataStatisticsProcess(Process):
         :return: Sequence of summary stats dictionary, roi labels
         """
         stat1 = {'mean': [], 'median': [], 'std': [], 'max': [], 'min': []}
-        regions = []
 
         if data is None:
             stat1 = {'mean': [0], 'median': [0], 'std': [0], 'max': [0], 'min': [0]}
@@ -159,53 +158,22 @@ class DataStatisticsProcess(Process):
         else:
             data_arr, _, _, _ = data.slice_data(slice_loc)
 
-        if 0:
-            data_arr = data_arr[np.isfinite(data_arr)]
-
-        # Calculating the exact median requires a copy and sort of the data
-        # which can be expensive for large data sets
-        if exact_median:
-            median = np.nanmedian
-        else:
-            median = self._approx_median
-
-        # Separate ROI and non-ROI cases to avoid making additional array copy
-        # when there is no ROI
+        # Statistics for all regions are calculated together in a single pass through the data
         if roi is not None:
-            roi_arr = roi.resample(data.grid).raw()
-
-            for region, name in roi.regions.items():
-                region_data = data_arr[roi_arr == region]
-                if region_data.size > 0:
-                    mean, med, std = np.nanmean(region_data), median(region_data), np.nanstd(region_data)
-                    mx, mn = np.nanmax(region_data), np.nanmin(region_data)
-                else:
-                    mean, med, std, mx, mn = 0, 0, 0, 0, 0
-
-                stat1['mean'].append(mean)
-                stat1['median'].append(med)
-                stat1['std'].append(std)
-                stat1['max'].append(mx)
-                stat1['min'].append(mn)
-                regions.append(name)
+            roi_data = roi.resample(data.grid)
+            if slice_loc is None:
+                roi_arr = roi_data.raw()
+            else:
+                roi_arr, _, _, _ = roi_data.slice_data(slice_loc)
+            regions = list(roi.regions.keys())
+            region_names = list(roi.regions.values())
         else:
-            mean, med, std = np.nanmean(data_arr), median(data_arr), np.nanstd(data_arr)
-            mx, mn = np.nanmax(data_arr), np.nanmin(data_arr)
-
-            stat1['mean'].append(mean)
-            stat1['median'].append(med)
-            stat1['std'].append(std)
-            stat1['max'].append(mx)
-            stat1['min'].append(mn)
-            regions.append("")
-
-        return stat1, regions
-
-    def _approx_median(self, arr):
-        if arr.size > 1e6:
-            indices = np.random.randint(0, arr.size, size=[int(1e6),])
-            arr = np.take(arr, indices)
-        return np.nanmedian(arr)
+            roi_arr, regions, region_names = None, None, [""]
+
+        stats = region_stats(data_arr, roi_arr, regions, exact_median=exact_median)
+        for key in stat1:
+            stat1[key] = list(stats[key])
+        return stat1, region_names
 
 class OverlayStatsProcess(DataStatisticsProcess):
     """
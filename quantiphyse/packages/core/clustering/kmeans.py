@@ -23,12 +23,24 @@ import numpy as np
 import sklearn.cluster as cl
 
 from quantiphyse.data import NumpyData
-from quantiphyse.processes import Process, normalisation, PCA
+from quantiphyse.processes import Process, normalisation
+from quantiphyse.processes.feat_pca import get_features
 from quantiphyse.utils import QpException
+from quantiphyse.utils.stats import region_stats, region_index
 
 class KMeansProcess(Process):
     """
     Clustering for a 4D volume
+
+    For large data sets, the clusters can be fitted to a random sample of voxels
+    (``max-voxels``) and/or using mini-batch K-Means which updates the clusters from
+    small batches of voxels rather than the whole data set at each iteration. All
+    voxels are then labelled using the fitted cluster centres.
+
+    The PCA reduction of 4D data is cached, so re-running with different clustering
+    options is quicker. The reduced data can also be output as a 4D data set (``output-features``)
+    which can be saved, reloaded and clustered later without repeating the reduction
+    (``reduction: none``)
     """
 
     PROCESS_NAME = "KMeans"
@@ -42,34 +54,67 @@ class KMeansProcess(Process):
         n_clusters = options.pop('n-clusters', 5)
         invert_roi = options.pop('invert-roi', False)
         output_name = options.pop('output-name', data.name + '_clusters')
+        algorithm = options.pop('algorithm', 'kmeans').lower()
+        n_init = options.pop('n-init', 10)
+        max_voxels = options.pop('max-voxels', None)
+        batch_size = options.pop('batch-size', 1000)
         
-        kmeans_data, mask = data.mask(roi, invert=invert_roi, output_flat=True, output_mask=True)
         start1 = time.time()
 
         if data.nvols > 1:
+            # The mask is obtained from a single volume as the PCA reduction extracts
+            # voxel data from the full data set in chunks
+            _, mask = data.mask(roi, vol=0, invert=invert_roi, output_flat=True, output_mask=True)
+
             # Do PCA reduction
             norm_data = options.pop('norm-data', True)
             norm_type = options.pop('norm-type', "sigenh")
             n_pca = options.pop('n-pca', 5)
             reduction = options.pop('reduction', 'pca')
+            pca_solver = options.pop('pca-solver', 'auto')
 
             if reduction == "pca":
                 self.log("Using PCA dimensionality reduction")
-                pca = PCA(n_components=n_pca, norm_input=True, norm_type=norm_type,
-                          norm_modes=norm_data)
-                kmeans_data = pca.get_training_features(kmeans_data)
+                _, kmeans_data = get_features(data, mask, n_components=n_pca, norm_input=True, norm_type=norm_type,
+                                              norm_modes=norm_data, solver=pca_solver)
+            elif reduction == "none":
+                self.log("Using data volumes as features")
+                kmeans_data = data.raw()[mask > 0]
             else:
                 raise QpException("Unknown reduction method: %s" % reduction)
+
+            features_name = options.pop('output-features', None)
+            if features_name:
+                features = np.zeros(list(data.grid.shape) + [kmeans_data.shape[1]], dtype=np.float32)
+                features[mask > 0] = kmeans_data
+                self.ivm.add(NumpyData(features, grid=data.grid, name=features_name))
         else:
+            kmeans_data, mask = data.mask(roi, invert=invert_roi, output_flat=True, output_mask=True)
             kmeans_data = kmeans_data[:, np.newaxis]
 
-        kmeans = cl.KMeans(init='k-means++', n_clusters=n_clusters, n_init=10, n_jobs=1)
-        kmeans.fit(kmeans_data)
+        if algorithm == "kmeans":
+            kmeans = cl.KMeans(init='k-means++', n_clusters=n_clusters, n_init=n_init)
+        elif algorithm == "minibatch":
+            self.log("Using mini-batch K-Means with batch size %i" % batch_size)
+            kmeans = cl.MiniBatchKMeans(init='k-means++', n_clusters=n_clusters, n_init=n_init,
+                                        batch_size=batch_size)
+        else:
+            raise QpException("Unknown clustering algorithm: %s" % algorithm)
+
+        if max_voxels and kmeans_data.shape[0] > max_voxels:
+            # Fit to a random sample of voxels, then label all voxels in a single pass
+            self.log("Fitting clusters to a sample of %i out of %i voxels" % (max_voxels, kmeans_data.shape[0]))
+            sample = np.sort(np.random.choice(kmeans_data.shape[0], max_voxels, replace=False))
+            kmeans.fit(kmeans_data[sample])
+            labels = kmeans.predict(kmeans_data)
+        else:
+            kmeans.fit(kmeans_data)
+            labels = kmeans.labels_
         
         self.log("Elapsed time: %s" % (time.time() - start1))
 
         label_image = np.zeros(data.grid.shape, dtype=np.int)
-        label_image[mask] = kmeans.labels_ + 1
+        label_image[mask] = labels + 1
         self.ivm.add(NumpyData(label_image, grid=data.grid, name=output_name, roi=True), make_current=True)
 
 class MeanValuesProcess(Process):
@@ -86,12 +131,14 @@ class MeanValuesProcess(Process):
         roi = self.get_roi(options, data.grid)
         output_name = options.pop('output-name', data.name + "_means")
 
+        # Means of all regions (and volumes) are calculated in a single pass. As with
+        # np.mean, the mean of a region containing NaN values is NaN
         in_data = data.raw()
+        regions = list(roi.regions.keys())
+        means = region_stats(in_data, roi.raw(), regions, per_volume=True, ignore_nan=False)["mean"]
+        region_idx = region_index(roi.raw(), regions)
+        in_region = region_idx >= 0
         out_data = np.zeros(in_data.shape)
-        for region in roi.regions:
-            if data.ndim > 3:
-                out_data[roi.raw() == region] = np.mean(in_data[roi.raw() == region], axis=0)
-            else:
-                out_data[roi.raw() == region] = np.mean(in_data[roi.raw() == region])
+        out_data[in_region] = means[region_idx[in_region]].reshape(out_data[in_region].shape)
 
         self.ivm.add(NumpyData(out_data, grid=data.grid, name=output_name), make_current=True)
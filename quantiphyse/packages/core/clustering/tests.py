@@ -3,7 +3,8 @@ import unittest
 
 import numpy as np
 
-from quantiphyse.processes import Process
+from quantiphyse.data import NumpyData
+from quantiphyse.processes import Process, feat_pca
 from quantiphyse.test import WidgetTest, ProcessTest
 
 from .widgets import ClusteringWidget
@@ -134,6 +135,106 @@ class KMeansProcessTest(ProcessTest):
         self.assertTrue("clusters_4d" in self.ivm.rois)
         self.assertTrue(os.path.exists(os.path.join(self.output_dir, "case", "4dclusters.nii.gz")))
 
+    def testMiniBatch(self):
+        yaml = """
+  - KMeans:
+        data: data_4d
+        n-clusters: 3
+        algorithm: minibatch
+        batch-size: 100
+        output-name: clusters_4d
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        self.assertEqual(len(self.ivm.rois["clusters_4d"].regions), 3)
+
+    def testIncrementalPca(self):
+        yaml = """
+  - KMeans:
+        data: data_4d
+        roi: mask
+        n-clusters: 3
+        pca-solver: incremental
+        output-name: clusters_4d
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        clusters = self.ivm.rois["clusters_4d"].raw()
+        self.assertEqual(len(self.ivm.rois["clusters_4d"].regions), 3)
+        self.assertTrue(np.all(clusters[self.mask > 0] > 0))
+        self.assertTrue(np.all(clusters[self.mask == 0] == 0))
+
+    def testFeatureCache(self):
+        yaml = """
+  - KMeans:
+        data: data_4d
+        roi: mask
+        n-clusters: 3
+        output-name: clusters_3
+        output-features: features
+
+  - KMeans:
+        data: data_4d
+        roi: mask
+        n-clusters: 4
+        output-name: clusters_4
+"""
+        feat_pca.clear_feature_cache()
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        self.assertEqual(len(self.ivm.rois["clusters_4"].regions), 4)
+        # PCA reduction is only done once
+        self.assertEqual(len(feat_pca._FEATURE_CACHE), 1)
+        features = self.ivm.data["features"]
+        self.assertEqual(features.nvols, 5)
+        self.assertTrue(np.all(features.raw()[self.mask == 0] == 0))
+
+    def testSavedFeatures(self):
+        yaml = """
+  - KMeans:
+        data: data_4d
+        roi: mask
+        n-clusters: 3
+        output-features: features
+
+  - Save:
+        features:
+
+  - Load:
+        data:
+            %s: saved_features
+
+  - KMeans:
+        data: saved_features
+        roi: mask
+        n-clusters: 3
+        reduction: none
+        output-name: clusters_saved
+""" % os.path.join(self.output_dir, "case", "features.nii")
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        clusters = self.ivm.rois["clusters_saved"].raw()
+        self.assertEqual(len(self.ivm.rois["clusters_saved"].regions), 3)
+        self.assertTrue(np.all(clusters[self.mask == 0] == 0))
+
+    def testMaxVoxels(self):
+        yaml = """
+  - KMeans:
+        data: data_3d
+        roi: mask
+        n-clusters: 3
+        max-voxels: 50
+        output-name: clusters_3d
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        # All voxels in the ROI are labelled, not just the sample
+        clusters = self.ivm.rois["clusters_3d"].raw()
+        self.assertTrue(np.count_nonzero(self.mask) > 50)
+        self.assertTrue(np.all(clusters[self.mask > 0] > 0))
+        self.assertTrue(np.all(clusters[self.mask == 0] == 0))
+        self.assertEqual(len(self.ivm.rois["clusters_3d"].regions), 3)
+
 class MeanValuesProcessTest(ProcessTest):
 
     def test3d(self):
@@ -146,6 +247,40 @@ class MeanValuesProcessTest(ProcessTest):
         self.run_yaml(yaml)
         self.assertEqual(self.status, Process.SUCCEEDED)
         self.assertTrue("data_roi_mean" in self.ivm.data)
+        means = self.ivm.data["data_roi_mean"].raw()
+        self.assertAlmostEqual(means[self.mask > 0][0], np.mean(self.data_3d[self.mask > 0]), delta=0.001)
+        self.assertTrue(np.all(means[self.mask == 0] == 0))
+
+    def test4d(self):
+        yaml = """
+  - MeanValues:
+        data: data_4d
+        roi: mask
+        output-name: data_roi_mean
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        means = self.ivm.data["data_roi_mean"].raw()
+        self.assertEqual(list(means.shape), list(self.data_4d.shape))
+        for vol in range(self.data_4d.shape[3]):
+            self.assertAlmostEqual(means[..., vol][self.mask > 0][0], np.mean(self.data_4d[..., vol][self.mask > 0]), delta=0.001)
+
+    def testNan(self):
+        # As with np.mean, the mean of a region containing NaN is NaN
+        data = np.copy(self.data_4d)
+        data[..., 1][self.mask > 0] = np.nan
+        self.ivm.add(NumpyData(data, grid=self.grid, name="data_nan"))
+        yaml = """
+  - MeanValues:
+        data: data_nan
+        roi: mask
+        output-name: data_roi_mean
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        means = self.ivm.data["data_roi_mean"].raw()
+        self.assertTrue(np.all(np.isnan(means[..., 1][self.mask > 0])))
+        self.assertAlmostEqual(means[..., 0][self.mask > 0][0], np.mean(self.data_4d[..., 0][self.mask > 0]), delta=0.001)
 
 if __name__ == '__main__':
     unittest.main()
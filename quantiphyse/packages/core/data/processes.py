@@ -16,12 +16,56 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+from multiprocessing.pool import ThreadPool
+
 import numpy as np
 import scipy.ndimage
 
 from quantiphyse.data import NumpyData, DataGrid
 from quantiphyse.utils import QpException
 from quantiphyse.processes import Process
+from quantiphyse.processes.process import get_pool_size
+
+def _area_weights(n_in, factor):
+    """
+    Weights for downsampling along one axis by averaging over the input voxels
+    which overlap each output voxel, weighted by the size of the overlap
+
+    :return: Array of weights with shape [output size, input size]
+    """
+    n_out = max(1, int(n_in / factor))
+    out_edges = np.arange(n_out + 1) * float(factor)
+    in_edges = np.arange(n_in + 1)
+    lower = np.maximum(out_edges[:-1, np.newaxis], in_edges[np.newaxis, :-1])
+    upper = np.minimum(out_edges[1:, np.newaxis], in_edges[np.newaxis, 1:])
+    weights = np.clip(upper - lower, 0, None)
+    return weights / np.sum(weights, axis=1, keepdims=True)
+
+def _downsample(data, factors):
+    """
+    Downsample a 3D volume by taking the mean over blocks of voxels
+
+    Integer factors use the mean over non-overlapping blocks, obtained by reshaping the
+    data. Non-integer factors use area weighted averaging. In either case, input voxels 
+    beyond the last complete output voxel are ignored.
+
+    :param data: 3D Numpy array
+    :param factors: Sequence of 3 downsampling factors
+    :return: Downsampled data as float32 Numpy array
+    """
+    data = np.asarray(data)
+    if all([factor == int(factor) and dim >= factor for factor, dim in zip(factors, data.shape)]):
+        factors = [int(factor) for factor in factors]
+        new_shape = [dim // factor for dim, factor in zip(data.shape, factors)]
+        blocks = data[tuple([slice(0, dim*factor) for dim, factor in zip(new_shape, factors)])]
+        blocks = blocks.reshape([new_shape[0], factors[0], new_shape[1], factors[1], new_shape[2], factors[2]])
+        return np.mean(blocks, axis=(1, 3, 5), dtype=np.float64).astype(np.float32)
+    else:
+        for axis, factor in enumerate(factors):
+            if factor != 1:
+                weights = _area_weights(data.shape[axis], factor)
+                data = np.moveaxis(np.tensordot(weights, data, axes=([1], [axis])), 0, axis)
+        return data.astype(np.float32)
 
 class ResampleProcess(Process):
     """ 
@@ -50,9 +94,8 @@ class ResampleProcess(Process):
         # Upsampling can use scipy.ndimage.zoom
         # Downsampling is nore naturally implemented as a mean over subvoxels using Numpy slicing
         #
-        # Note that factor is an integer for now. It could easily be a float for upsampling but
-        # this would break the downsampling algorithm (and make it significanlty more complex to
-        # implement)
+        # Both up and down sampling are done one volume at a time, writing into a preallocated
+        # output array, so no temporary arrays the size of the output are required
         #
         # This is all pretty messy now especially with the '2d only' option.
         if resample_type == "data":
@@ -65,13 +108,17 @@ class ResampleProcess(Process):
             output_data = data.resample(grid, order=order)
         elif resample_type == "up":
             # Upsampling will need to use interpolation
-            orig_data = data.raw()
             zooms = [factor for idx in range(3)]
             if only2d:
                 zooms[2] = 1
-            if data.ndim == 4:
-                zooms.append(1)
-            output_data = scipy.ndimage.zoom(orig_data, zooms, order=order)
+            new_shape = [int(round(dim * zoom)) for dim, zoom in zip(data.grid.shape, zooms)]
+            output_data = np.zeros(new_shape + [data.nvols], dtype=data.volume(0).dtype)
+
+            def _upsample(vol):
+                scipy.ndimage.zoom(data.volume(vol), zooms, output=output_data[..., vol], order=order)
+            self._map_volumes(_upsample, data.nvols)
+            if data.ndim == 3:
+                output_data = output_data[..., 0]
 
             # Work out new grid origin
             voxel_offset = [float(factor-1)/(2*factor) for idx in range(3)]
@@ -88,33 +135,20 @@ class ResampleProcess(Process):
             output_data = NumpyData(output_data, grid=output_grid, name=output_name)
         elif resample_type == "down":
             # Downsampling takes a mean of the voxels inside the new larger voxel
-            # Only uses integral factor at present
-            orig_data = data.raw()
-            new_shape = [max(1, int(dim_size / factor)) for  dim_size in orig_data.shape[:3]]
-            if data.ndim == 4:
-                new_shape.append(orig_data.shape[3])
+            factors = [factor for idx in range(3)]
             if only2d:
-                new_shape[2] = orig_data.shape[2]
+                factors[2] = 1
+            new_shape = [max(1, int(dim / factor)) for dim, factor in zip(data.grid.shape, factors)]
 
             # Note that output data must be float data type even if original data was integer
-            output_data = np.zeros(new_shape, dtype=np.float32)
-            num_samples = 0
-            for start1 in range(factor):
-                for start2 in range(factor):
-                    for start3 in range(factor):
-                        if start1 >= new_shape[0]*factor or start2 >= new_shape[1]*factor or start3 >= new_shape[2]*factor:
-                            continue
-                        slices = [
-                            slice(start1, new_shape[0]*factor, factor),
-                            slice(start2, new_shape[1]*factor, factor),
-                            slice(start3, new_shape[2]*factor, factor),
-                        ]
-                        if only2d:
-                            slices[2] = slice(None)
-                        downsampled_data=orig_data[slices]
-                        output_data += downsampled_data
-                        num_samples += 1
-            output_data /= num_samples
+            output_data = np.zeros(new_shape + [data.nvols], dtype=np.float32)
+
+            def _downsample_vol(vol):
+                output_data[..., vol] = _downsample(data.volume(vol), factors)
+            self._map_volumes(_downsample_vol, data.nvols)
+            if data.ndim == 3:
+                output_data = output_data[..., 0]
+
             # FIXME this will not work for 2D data
             voxel_offset = [0.5*(factor-1), 0.5*(factor-1), 0.5*(factor-1)]
             if only2d:
@@ -132,3 +166,19 @@ class ResampleProcess(Process):
             raise QpException("Unknown resampling type: %s" % resample_type)
 
         self.ivm.add(output_data, name=output_name, make_current=True, roi=data.roi and order == 0)
+
+    def _map_volumes(self, fn, nvols):
+        """
+        Call a function for each volume index
+
+        Volumes are processed in parallel using threads, which is effective because
+        the Scipy and Numpy functions used do not hold the GIL during the computation
+        """
+        if nvols == 1:
+            fn(0)
+        else:
+            pool = ThreadPool(min(nvols, get_pool_size()))
+            try:
+                pool.map(fn, range(nvols))
+            finally:
+                pool.close()
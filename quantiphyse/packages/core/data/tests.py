@@ -1,6 +1,7 @@
 import unittest
 
 import numpy as np
+import scipy.ndimage
 
 from quantiphyse.data import DataGrid
 from quantiphyse.test.widget_test import WidgetTest
@@ -182,6 +183,57 @@ class ResampleProcessTest(ProcessTest):
         self.run_yaml(yaml)
         self.assertEqual(self.status, Process.SUCCEEDED)
         self.assertTrue("testdata_resampled" in self.ivm.data)
-   
+
+    def testDownsample4d(self):
+        yaml = """
+  - Resample:
+      data: data_4d
+      type: down
+      factor: 2
+      output-name: testdata_down
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        data = self.data_4d
+        new_shape = [dim // 2 for dim in data.shape[:3]]
+        cropped = data[:new_shape[0]*2, :new_shape[1]*2, :new_shape[2]*2]
+        expected = cropped.reshape([new_shape[0], 2, new_shape[1], 2, new_shape[2], 2, data.shape[3]]).mean(axis=(1, 3, 5))
+        self.assertTrue(np.allclose(self.ivm.data["testdata_down"].raw(), expected, atol=1e-5))
+
+    def testDownsampleNonInteger(self):
+        yaml = """
+  - Resample:
+      data: data_3d
+      type: down
+      factor: 1.5
+      output-name: testdata_down
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        data = self.data_3d.astype(np.float64)
+        output = self.ivm.data["testdata_down"].raw()
+        self.assertEqual(list(output.shape), [int(dim / 1.5) for dim in data.shape])
+        # First output voxel along each axis covers the first input voxel and half the second
+        weights = np.array([1, 0.5])
+        expected = np.einsum("i,j,k,ijk", weights, weights, weights, data[:2, :2, :2]) / np.sum(weights)**3
+        self.assertAlmostEqual(output[0, 0, 0], expected, places=5)
+
+    def testUpsample4d(self):
+        yaml = """
+  - Resample:
+      data: data_4d
+      type: up
+      factor: 2
+      order: 1
+      output-name: testdata_up
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        output = self.ivm.data["testdata_up"].raw()
+        self.assertEqual(list(output.shape), [dim * 2 for dim in self.data_4d.shape[:3]] + [self.data_4d.shape[3]])
+        for vol in range(self.data_4d.shape[3]):
+            expected = scipy.ndimage.zoom(self.data_4d[..., vol], 2, order=1)
+            self.assertTrue(np.allclose(output[..., vol], expected))
+
 if __name__ == '__main__':
     unittest.main()
@@ -50,7 +50,7 @@ class ResampleDataWidget(QpWidget):
         self.data = self.optbox.add("Data to resample", DataOption(self.ivm), key="data")
         self.resample_type = self.optbox.add("Resampling method", ChoiceOption(["On to grid from another data set", "Upsample", "Downsample"], ["data", "up", "down"]), key="type")
         self.grid_data = self.optbox.add("Use grid from", DataOption(self.ivm), key="grid")
-        self.factor = self.optbox.add("Factor", NumericOption(default=2, minval=2, maxval=10, intonly=True), key="factor")
+        self.factor = self.optbox.add("Factor", NumericOption(default=2, minval=1, maxval=10, decimals=1, hardmin=True), key="factor")
         self.slicewise = self.optbox.add("2D only", BoolOption(), key="2d")
         self.order = self.optbox.add("Interpolation", ChoiceOption(["Nearest neighbour", "Linear", "Quadratic", "Cubic"], [0, 1, 2, 3], default=1), key="order")
         self.output_name = self.optbox.add("Output name", OutputNameOption(src_data=self.data, suffix="_res"), key="output-name")
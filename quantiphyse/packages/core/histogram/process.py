@@ -19,6 +19,7 @@ import six
 
 from quantiphyse.data.extras import MatrixExtra
 from quantiphyse.utils import QpException
+from quantiphyse.utils.stats import region_histogram
 from quantiphyse.processes import Process
 
 import numpy as np
@@ -26,6 +27,9 @@ import numpy as np
 class HistogramProcess(Process):
     """
     Calculate histogram for a data set 
+
+    Multi-volume data is processed one volume at a time and histograms for all ROI
+    regions are accumulated together, so only one volume of data is in memory at once
     """
     
     PROCESS_NAME = "Histogram"
@@ -56,29 +60,25 @@ class HistogramProcess(Process):
 
         yvals, col_headers = {}, ["left", "right", "centre",]
         for data in data_items:
-            if vol is not None:
-                rawdata = data.volume(vol)
-            else:
-                rawdata = data.raw()
             hrange = [dmin, dmax]
-            if dmin is None: hrange[0] = np.min(rawdata)
-            if dmax is None: hrange[1] = np.max(rawdata)
+            if dmin is None or dmax is None:
+                data_range = data.range(vol)
+                if dmin is None: hrange[0] = data_range[0]
+                if dmax is None: hrange[1] = data_range[1]
 
             if roi is None:
-                roi_fordata = np.ones(data.grid.shape)
-                regions = {1 : ""}
+                roi_fordata, regions = None, {1 : ""}
             else:
                 roi_fordata = roi.resample(data.grid).raw()
                 regions = roi.regions
 
-            for region, region_name in regions.items():
-                if sel_region is not None and region != sel_region:
-                    self.debug("Ignoring region %i", region)
-                    continue
+            if sel_region is not None:
+                self.debug("Ignoring regions other than %i", sel_region)
+                regions = dict([(region, name) for region, name in regions.items() if region == sel_region])
 
-                region_data = rawdata[roi_fordata == region]
-                data_vals, edges = np.histogram(region_data, bins=bins, range=hrange, density=prob)
-                    
+            region_hists, edges = region_histogram(self._volumes(data, vol), roi_fordata, list(regions.keys()),
+                                                   bins=bins, hrange=hrange, density=prob)
+            for data_vals, region_name in zip(region_hists, regions.values()):
                 if region_name:
                     name = "%s\n%s" % (data.name, region_name)
                 else:
@@ -99,3 +99,13 @@ class HistogramProcess(Process):
             extra = MatrixExtra(output_name, rows, col_headers=col_headers)
             self.debug(str(extra))
             self.ivm.add_extra(output_name, extra)
+
+    def _volumes(self, data, vol):
+        """
+        Generate the data volumes to include in the histogram
+        """
+        if vol is not None:
+            yield data.volume(vol)
+        else:
+            for idx in range(data.nvols):
+                yield data.volume(idx)
@@ -18,6 +18,8 @@ limitations under the License.
 import os
 import unittest
 
+import numpy as np
+
 from quantiphyse.processes import Process
 from quantiphyse.test import ProcessTest
 
@@ -39,5 +41,46 @@ class HistogramProcessTest(ProcessTest):
         self.assertTrue("testdata_hist" in self.ivm.extras)
         self.assertTrue(os.path.exists(os.path.join(self.output_dir, "case", "testdata_hist.tsv")))
 
+    def _hist_values(self, name):
+        extra = self.ivm.extras[name]
+        arr = np.array(extra.arr, dtype=np.float64)
+        edges = np.append(arr[:, 0], arr[-1, 1])
+        return edges, arr[:, 3:]
+
+    def test4d(self):
+        yaml = """
+  - Histogram:
+        data: data_4d
+        bins: 20
+        output-name: testdata_hist
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        edges, values = self._hist_values("testdata_hist")
+        data = self.ivm.data["data_4d"].raw()
+        expected, expected_edges = np.histogram(data, 20, range=(np.min(data), np.max(data)))
+        self.assertTrue(np.allclose(edges, expected_edges))
+        self.assertTrue(np.allclose(values[:, 0], expected))
+
+    def test4dRoiVolume(self):
+        yaml = """
+  - Histogram:
+        data: data_4d
+        bins: 10
+        vol: 3
+        min: 0
+        max: 0.5
+        output-name: testdata_hist
+        roi: mask
+"""
+        self.run_yaml(yaml)
+        self.assertEqual(self.status, Process.SUCCEEDED)
+        edges, values = self._hist_values("testdata_hist")
+        data = self.ivm.data["data_4d"].volume(3)
+        mask = self.ivm.data["mask"].raw()
+        expected, _ = np.histogram(data[mask > 0], 10, range=(0, 0.5))
+        self.assertTrue(np.allclose(edges, np.linspace(0, 0.5, 11)))
+        self.assertTrue(np.allclose(values[:, 0], expected))
+
 if __name__ == '__main__':
     unittest.main()
@@ -131,6 +131,11 @@ class OverviewWidget(QpWidget):
         self.data_list = DataListWidget(self)
         layout.addWidget(self.data_list)
 
+        self._memory_label = QtGui.QLabel()
+        layout.addWidget(self._memory_label)
+        self.ivm.sig_memory.connect(self._memory_changed)
+        self._memory_changed(self.ivm.memory_usage())
+
         hbox = QtGui.QHBoxLayout()
         
         self._up_btn = self._btn(hbox, QtGui.QIcon(get_icon("up.png")), "Raise data set in viewing order", self._up)
@@ -160,6 +165,12 @@ class OverviewWidget(QpWidget):
         hbox.addWidget(btn)
         return btn
 
+    def _memory_changed(self, usage):
+        text = "Data in memory: %s" % _format_size(sum(usage.values()))
+        if self.ivm.memory_budget is not None:
+            text += " (limit %s)" % _format_size(self.ivm.memory_budget)
+        self._memory_label.setText(text)
+
     def _viewer_options(self):
         ViewerOptions(self, self.ivl).exec_()
 
@@ -250,6 +261,9 @@ class OverviewWidget(QpWidget):
                     last_data.view.z_order = current_z
                 last_data = data
 
+def _format_size(nbytes):
+    return "%.1f Mb" % (float(nbytes) / (1024*1024))
+
 class DataListWidget(QtGui.QTableView):
     """
     Table showing loaded volumes
@@ -288,6 +302,7 @@ class DataListWidget(QtGui.QTableView):
         self.ivm.sig_main_data.connect(self._update_vis_icons)
         self.ivm.sig_current_data.connect(self._set_current)
         self.ivm.sig_current_roi.connect(self._set_current)
+        self.ivm.sig_memory.connect(self._memory_changed)
 
     @property
     def selected(self):
@@ -329,7 +344,8 @@ class DataListWidget(QtGui.QTableView):
         items = [
             QtGui.QStandardItem(""),
             QtGui.QStandardItem(data.name),
-            QtGui.QStandardItem(fname)
+            QtGui.QStandardItem(fname),
+            QtGui.QStandardItem(_format_size(data.resident_size)),
         ]
 
         if fname:
@@ -347,12 +363,13 @@ class DataListWidget(QtGui.QTableView):
             scroll_pos = self.verticalScrollBar().value()
 
             self.model.clear()
-            self.model.setColumnCount(3)
-            self.model.setHorizontalHeaderLabels(["", "Name", "File"])
+            self.model.setColumnCount(4)
+            self.model.setHorizontalHeaderLabels(["", "Name", "File", "Memory"])
             self.model.setHeaderData(0, QtCore.Qt.Horizontal, self._vis_icon, QtCore.Qt.DecorationRole)
             self.horizontalHeader().setResizeMode(0, QtGui.QHeaderView.ResizeToContents)
             self.horizontalHeader().setResizeMode(1, QtGui.QHeaderView.ResizeToContents)
             self.horizontalHeader().setResizeMode(2, QtGui.QHeaderView.Stretch)
+            self.horizontalHeader().setResizeMode(3, QtGui.QHeaderView.ResizeToContents)
             for row, data in enumerate(sorted(self.ivm.data.values(), key=lambda x: -x.view.z_order)):
                 self.model.appendRow(self._get_table_items(data))
 
@@ -365,6 +382,12 @@ class DataListWidget(QtGui.QTableView):
         finally:
             self.blockSignals(False)
 
+    def _memory_changed(self, usage):
+        for row in range(self.model.rowCount()):
+            name_item, memory_item = self.model.item(row, 1), self.model.item(row, 3)
+            if name_item is not None and memory_item is not None:
+                memory_item.setText(_format_size(usage.get(name_item.text(), 0)))
+
     def _update_vis_icons(self):
         for row, data in enumerate(sorted(self.ivm.data.values(), key=lambda x: -x.view.z_order)):
             self._update_vis_icon(row, data)
@@ -20,7 +20,7 @@ import numpy as np
 from quantiphyse.data.extras import MatrixExtra
 from quantiphyse.utils import QpException
 from quantiphyse.processes import Process
-from quantiphyse.processes.feat_pca import PcaFeatReduce
+from quantiphyse.processes.feat_pca import get_features
 
 class PcaProcess(Process):
     """
@@ -42,15 +42,16 @@ class PcaProcess(Process):
         norm_type = options.pop('norm-type', "sigenh")
         norm_output = options.pop('norm-output', False)
         n_components = options.pop('n-components', 5)
+        solver = options.pop('solver', 'auto')
 
         if data.ndim != 4:
             raise QpException("PCA reduction possible on 4D data only")
         elif data.nvols <= n_components:
             raise QpException("Number of PCA components must be less than number of data volumes")
 
-        pca = PcaFeatReduce(n_components=n_components, norm_input=norm_input, norm_type=norm_type, norm_modes=norm_output)
-        
-        feature_images = pca.get_training_features(data.raw(), roi.raw(), feature_volume=True)
+        pca, feature_images = get_features(data, roi.raw(), feature_volume=True, n_components=n_components,
+                                           norm_input=norm_input, norm_type=norm_type, norm_modes=norm_output,
+                                           solver=solver)
         for comp_idx in range(n_components):
             name = "%s%i" % (output_name, comp_idx)
             self.ivm.add(feature_images[:, :, :, comp_idx], grid=data.grid, name=name, make_current=(comp_idx == 0))
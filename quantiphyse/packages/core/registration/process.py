@@ -41,6 +41,9 @@ from quantiphyse.data import NumpyData, QpData
 from quantiphyse.data.extras import Extra
 from quantiphyse.utils import get_plugins, set_local_file_path, QpException
 from quantiphyse.processes import Process
+from quantiphyse.processes.process import get_pool_size
+
+from .reg_method import RegMethod
 
 LOG = logging.getLogger(__name__)
 
@@ -134,15 +137,45 @@ def _run_reg(worker_id, queue, method_name, mode, reg_data, ref_data, options):
         traceback.print_exc()
         return worker_id, False, sys.exc_info()[1]
 
+def _run_reg_vols(worker_id, queue, method_name, reg_data, ref_data, options, vols, out_data):
+    """
+    Register a subset of the volumes of multi-volume data, writing the output
+    into a shared array
+    """
+    try:
+        set_local_file_path()
+        method = get_reg_method(method_name)
+        transforms, log = method.reg_vols(reg_data, ref_data, vols, out_data, dict(options), queue)
+        return worker_id, True, (transforms, log)
+    except:
+        traceback.print_exc()
+        return worker_id, False, sys.exc_info()[1]
+
+def _default_4d(method, mode):
+    """
+    :return: True if a registration method uses the default 4D registration for
+             the mode given, i.e. registers each volume independently
+    """
+    default = method.reg_4d.__func__ is RegMethod.reg_4d.__func__
+    if mode == "moco":
+        default = default and method.moco.__func__ is RegMethod.moco.__func__
+    return default
+
 class RegProcess(Process):
     """
     Asynchronous background process to run registration / motion correction
+
+    If the registration method uses the default 4D registration / motion correction,
+    volumes are registered in parallel using the shared worker pool. The output
+    volumes are written to a single shared array so the result is identical to
+    registering them in turn.
     """
 
     PROCESS_NAME = "Reg"
 
     def __init__(self, ivm, **kwargs):
         Process.__init__(self, ivm, worker_fn=_run_reg, **kwargs)
+        self._vol_chunks = None
 
     def run(self, options):
         self.debug("Run")
@@ -198,18 +231,85 @@ class RegProcess(Process):
         # Function input data must be passed as list of arguments for multiprocessingmethod = get_reg_method(method_name)
         options_pass = dict(options)
         options.clear()
-        self.start_bg([method_name, mode, reg_data, ref_data, options_pass])
+
+        method = get_reg_method(method_name)
+        self._vol_chunks = None
+        if method is not None and len(reg_data) == 1 and regdata.ndim == 4 and _default_4d(method, mode):
+            self._start_parallel(method_name, mode, regdata, ref_data, options_pass)
+        else:
+            self._worker_fn = _run_reg
+            self.start_bg([method_name, mode, reg_data, ref_data, options_pass])
+
+    def _start_parallel(self, method_name, mode, regdata, ref_data, options):
+        """
+        Start registration of each volume of multi-volume data in parallel
+
+        Each volume is a separate task so progress is reported as volumes are completed
+        """
+        self._log_header = ""
+        if mode == "moco":
+            self._log_header += "Running motion correction\n\n"
+            self._log_header += "Default MOCO implementation using multiple 3d registrations\n"
+            options["output-space"] = "reg"
+            options.pop("output-suffix", None)
+        else:
+            self._log_header += "Running 4D registration\n\n"
+            options.pop("output-suffix", None)
+        self._log_header += "Default 4D registration using multiple 3d registrations\n"
+
+        if options.get("output-space", "ref") == "ref":
+            self._output_grid = ref_data.grid
+        else:
+            self._output_grid = regdata.grid
+        self._regdata = regdata
+        self._vol_chunks = [[vol,] for vol in range(regdata.nvols)]
+        self._out_data = self.alloc_shared(list(self._output_grid.shape) + [regdata.nvols], dtype=np.float64)
+        self.debug("Registering %i volumes in parallel", regdata.nvols)
+
+        self._worker_fn = _run_reg_vols
+        self.start_bg([method_name, regdata, ref_data, options, self._out_data],
+                      n_workers=min(regdata.nvols, get_pool_size()), n_chunks=regdata.nvols)
+        
+    def split_args(self, n_workers, args):
+        if self._vol_chunks is None:
+            return Process.split_args(self, n_workers, args)
+
+        # Volumes are divided between the tasks. Other arguments, including the 
+        # shared output array, are passed to every task unchanged
+        method_name, regdata, ref_data, options, out_data = args
+        return [[idx, self._queue, method_name, regdata, ref_data, options, vols, out_data] 
+                for idx, vols in enumerate(self._vol_chunks)]
 
     def timeout(self, queue):
         if queue.empty(): return
         while not queue.empty():
             complete = queue.get()
-        self.sig_progress.emit(complete)
+        if self._vol_chunks is None:
+            # Progress of parallel registration is reported as each volume completes
+            self.sig_progress.emit(complete)
+
+    def _parallel_output(self, worker_output):
+        """
+        Combine the output of parallel registration of volumes
+
+        :return: Same output as a single registration worker
+        """
+        transforms, log = [], self._log_header
+        for vols_transforms, vols_log in worker_output:
+            transforms += vols_transforms
+            log += vols_log
+
+        registered = NumpyData(self._out_data.copy(), grid=self._output_grid, name=self._regdata.name)
+        registered = _normalize_output(self._regdata, registered, "")
+        return [registered,], transforms, log
 
     def finished(self, worker_output):
         """ Add output data to the IVM and set the log """
         if self.status == Process.SUCCEEDED:
-            registered_data, transform, log = worker_output[0]
+            if self._vol_chunks is not None:
+                registered_data, transform, log = self._parallel_output(worker_output)
+            else:
+                registered_data, transform, log = worker_output[0]
             # Output name applies to the registration input data
             registered_data[0].name = self._output_name
             self.log(log)
@@ -95,8 +95,10 @@ class RegMethod(LogSource):
         """
         4D Registration
 
-        The default implementation simply registers each volume of the data independently. However,
-        implementations can supply their own more optimal implementation if appropriate
+        The default implementation simply registers each volume of the data independently 
+        using ``reg_vols``. When this default is used by the registration process, volumes
+        are divided between the workers in the shared pool. However, implementations can 
+        supply their own more optimal implementation if appropriate
 
         :param reg_data: 4D QpData containing data to register.
         :param ref_data: 3D QpData containing reference data.
@@ -124,12 +126,36 @@ class RegMethod(LogSource):
             output_space = reg_data
         out_data = np.zeros(list(output_space.grid.shape) + [reg_data.nvols])
 
-        transforms = []
         log = "Default 4D registration using multiple 3d registrations\n"
-        for vol in range(reg_data.shape[-1]):
-            log += "Registering volume %i of %i\n" % (vol+1, reg_data.shape[-1])
+        transforms, vols_log = cls.reg_vols(reg_data, ref_data, range(reg_data.nvols), out_data, options, queue)
+        log += vols_log
+        return NumpyData(out_data, grid=output_space.grid, name=reg_data.name), transforms, log
+
+    @classmethod
+    def reg_vols(cls, reg_data, ref_data, vols, out_data, options, queue):
+        """
+        Register selected volumes of 4D data independently using ``reg_3d``
+
+        This is used by the default implementation of ``reg_4d`` and allows the volumes
+        to be divided between multiple workers. It should not normally need to be overridden
+
+        :param reg_data: 4D QpData containing data to register.
+        :param ref_data: 3D QpData containing reference data.
+        :param vols: Sequence of volume indices to register
+        :param out_data: Numpy array with volumes in the last dimension. Registered volumes
+                         are written to this array in the output space given in ``options``
+        :param options: Method options as dictionary
+        :param queue: Queue object which method may put progress information on to. Progress 
+                      is given as the fraction of ``vols`` which have been registered
+
+        :return Tuple of sequence of transformations, one for each volume in ``vols``
+                (see ``reg_4d``) and log information as a string
+        """
+        transforms = []
+        log = ""
+        for idx, vol in enumerate(vols):
+            log += "Registering volume %i of %i\n" % (vol+1, reg_data.nvols)
             reg_vol = NumpyData(reg_data.volume(vol), grid=reg_data.grid, name="regvol")
-            #self.debug("Vol %i of %i" % (vol+1, reg_data.shape[-1]))
             if vol == options.get("ignore-idx", -1):
                 # Ignore this index (e.g. because it is the same as the ref volume)
                 if options.get("output-space", "ref") != "reg":
@@ -137,16 +163,15 @@ class RegMethod(LogSource):
                 out_data[..., vol] = reg_vol.raw()
                 transforms.append(None)
             else:
-                #self.debug("Calling reg_3d", cls, cls.reg_3d)
                 # We did not remove output-space from the options so regdata should
                 # come back in the appropriate space
                 regdata, transform, vol_log = cls.reg_3d(reg_vol, ref_data, options, queue)
                 out_data[..., vol] = regdata.raw()
                 transforms.append(transform)
                 log += vol_log
-            queue.put(float(vol)/reg_data.shape[-1])
+            queue.put(float(idx)/len(vols))
 
-        return NumpyData(out_data, grid=output_space.grid, name=reg_data.name), transforms, log
+        return transforms, log
 
     @classmethod
     def moco(cls, moco_data, ref, options, queue):
@@ -1,5 +1,7 @@
 from .widget import RoiBuilderWidget
+from .tests import RoiBuilderWidgetTest, RoiHistoryTest, RegionGrowerTest, WalkerSegmentationTest
 
 QP_MANIFEST = {
     "widgets" : [RoiBuilderWidget,],
+    "widget-tests" : [RoiBuilderWidgetTest, RoiHistoryTest, RegionGrowerTest, WalkerSegmentationTest],
 }
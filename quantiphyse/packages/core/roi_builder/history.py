@@ -0,0 +1,188 @@
+"""
+Quantiphyse - Undo/redo history for the ROI builder
+
+Each change is stored as the indices of the voxels which were modified,
+with their values before and after the change. Changes made by the ROI
+tools are typically a few contiguous regions of a single label, so the
+indices and values are run-length encoded.
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division, unicode_literals, absolute_import, print_function
+
+import numpy as np
+
+#: Default maximum memory in bytes used to store the undo/redo history
+MAX_HISTORY_SIZE = 100 * 1024 * 1024
+
+def _encode_runs(values):
+    """
+    Run-length encode a 1D array
+
+    :return: Tuple of array of the value of each run, array of run lengths
+    """
+    if values.size == 0:
+        return values, np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(np.concatenate([[True], values[1:] != values[:-1]]))
+    lengths = np.diff(np.append(starts, values.size))
+    return values[starts], lengths
+
+def _decode_runs(run_values, lengths):
+    """ Inverse of ``_encode_runs`` """
+    return np.repeat(run_values, lengths)
+
+class RoiChange(object):
+    """
+    A change to ROI data
+
+    Only voxels whose value is actually changed are stored. Indices are
+    flat (C-order) indices into the ROI data, encoded as runs of consecutive
+    indices. The previous and new values are run-length encoded.
+    """
+
+    def __init__(self, indices, old_values, new_values):
+        """
+        :param indices: Flat indices of changed voxels in increasing order
+        :param old_values: Values of these voxels before the change
+        :param new_values: Values of these voxels after the change
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        self.nvoxels = indices.size
+        # Runs of consecutive indices have a constant value of index - position
+        self._index_runs = _encode_runs(indices - np.arange(indices.size))
+        self._old_runs = _encode_runs(np.asarray(old_values))
+        self._new_runs = _encode_runs(np.asarray(new_values))
+
+    @classmethod
+    def from_selection(cls, data, indices, values):
+        """
+        Create a change which sets the values of selected voxels
+
+        Selected voxels which already have the required value are not included
+
+        :param data: ROI data array which will be changed
+        :param indices: Flat indices of selected voxels. May be unsorted and contain duplicates
+        :param values: New value for each selected voxel, or a single value for all
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        values = np.broadcast_to(np.asarray(values, dtype=data.dtype), indices.shape)
+        if np.any(np.diff(indices) <= 0):
+            indices, first = np.unique(indices, return_index=True)
+            values = values[first]
+        old_values = np.take(data, indices)
+        changed = old_values != values
+        return cls(indices[changed], old_values[changed], values[changed])
+
+    @property
+    def size(self):
+        """ Approximate memory used to store the change in bytes """
+        return sum([arr.nbytes for runs in (self._index_runs, self._old_runs, self._new_runs) for arr in runs])
+
+    @property
+    def indices(self):
+        """ Flat indices of changed voxels """
+        offsets = _decode_runs(*self._index_runs)
+        return offsets + np.arange(offsets.size)
+
+    def apply(self, data):
+        """ Apply the change to ROI data in place """
+        np.put(data, self.indices, _decode_runs(*self._new_runs))
+
+    def revert(self, data):
+        """ Restore ROI data to its state before the change """
+        np.put(data, self.indices, _decode_runs(*self._old_runs))
+
+class RoiHistory(object):
+    """
+    Undo/redo history of changes to ROI data
+
+    The oldest changes are discarded when the memory used exceeds a maximum
+    size. The most recent change is always kept however large it is.
+    """
+
+    def __init__(self, max_size=None):
+        """
+        :param max_size: Maximum memory to use in bytes. If not specified,
+                         ``MAX_HISTORY_SIZE`` is used
+        """
+        if max_size is None:
+            max_size = MAX_HISTORY_SIZE
+        self.max_size = max_size
+        self._undo = []
+        self._redo = []
+
+    @property
+    def size(self):
+        """ Approximate memory used to store the history in bytes """
+        return sum([change.size for change in self._undo + self._redo])
+
+    @property
+    def can_undo(self):
+        return len(self._undo) > 0
+
+    @property
+    def can_redo(self):
+        return len(self._redo) > 0
+
+    def __len__(self):
+        return len(self._undo)
+
+    def clear(self):
+        """ Discard all history """
+        self._undo, self._redo = [], []
+
+    def record(self, change):
+        """
+        Add a change which has been applied to the data. Any changes
+        which had been undone can no longer be redone
+
+        :param change: RoiChange
+        """
+        if change.nvoxels == 0:
+            return
+        self._undo.append(change)
+        self._redo = []
+        size = self.size
+        while size > self.max_size and len(self._undo) > 1:
+            size -= self._undo.pop(0).size
+
+    def undo(self, data):
+        """
+        Revert the most recent change
+
+        :param data: ROI data array to modify in place
+        :return: True if a change was undone
+        """
+        if not self._undo:
+            return False
+        change = self._undo.pop()
+        change.revert(data)
+        self._redo.append(change)
+        return True
+
+    def redo(self, data):
+        """
+        Re-apply the most recently undone change
+
+        :param data: ROI data array to modify in place
+        :return: True if a change was redone
+        """
+        if not self._redo:
+            return False
+        change = self._redo.pop()
+        change.apply(data)
+        self._undo.append(change)
+        return True
@@ -0,0 +1,252 @@
+"""
+Quantiphyse - Threshold-based region growing for the ROI builder
+
+A voxel is in the region grown from a seed if it can be reached from the seed
+through neighbouring voxels whose values are all within a lower and upper threshold.
+
+For a fixed lower threshold, each voxel has a 'joining' value - the smallest upper
+threshold for which it is in the region. This is the minimax path cost from the seed,
+which is calculated by greyscale reconstruction by erosion. Sorting the voxels by this
+value means the region for any upper threshold is a prefix of the sorted voxels, so
+moving the upper threshold does not require the region to be grown again. The same
+applies to the lower threshold for a fixed upper threshold by negating the data.
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division, unicode_literals, absolute_import, print_function
+
+import numpy as np
+import scipy.ndimage
+from skimage.morphology import reconstruction
+
+from quantiphyse.utils import LogSource
+
+#: Initial distance in voxels from the seed to the edge of the tile searched.
+#: The tile size is doubled whenever the region reaches its edge
+INITIAL_TILE_SIZE = 16
+
+def _bbox(indices, shape):
+    """
+    :return: Tuple of slices bounding the voxels with the given flat indices into
+             an array of ``shape``, or None if there are no voxels
+    """
+    if len(indices) == 0:
+        return None
+    coords = np.unravel_index(indices, shape)
+    return tuple(slice(int(np.min(coord)), int(np.max(coord))+1) for coord in coords)
+
+def _on_edge(region, data_edges):
+    """
+    :return: True if a region within a tile touches an edge of the tile which is not
+             also the edge of the data
+    """
+    for axis, (start, end) in enumerate(data_edges):
+        if (not start and np.any(np.take(region, 0, axis=axis))) or (not end and np.any(np.take(region, -1, axis=axis))):
+            return True
+    return False
+
+class _FloodIndex(object):
+    """
+    Voxels of a tile reachable from the seed, ordered by the upper threshold
+    at which they join the seed's region, given a fixed lower threshold
+
+    To index by the lower threshold, the data and thresholds are negated
+    """
+
+    def __init__(self, tile, seed, lower, data_edges):
+        """
+        :param tile: Tile of data as float64 array
+        :param seed: Position of seed within tile
+        :param lower: Fixed lower threshold
+        :param data_edges: Sequence of (start, end) booleans for each axis, True if the
+                           tile edge is also the edge of the data
+        """
+        # Voxels below the lower threshold (or NaN) can never be included
+        mask = np.where(tile >= lower, tile, np.inf)
+        marker = np.full(tile.shape, np.inf)
+        marker[tuple(seed)] = mask[tuple(seed)]
+        cost = reconstruction(marker, mask, "erosion", scipy.ndimage.generate_binary_structure(3, 1))
+
+        reachable = np.flatnonzero(np.isfinite(cost))
+        self.order = reachable[np.argsort(cost.flat[reachable], kind="stable")]
+        self.costs = cost.flat[self.order]
+
+        # The region is only complete while it does not reach the edge of the tile,
+        # unless the edge of the tile is also the edge of the data
+        self.edge_cost = np.inf
+        for axis, (start, end) in enumerate(data_edges):
+            if not start:
+                self.edge_cost = min(self.edge_cost, np.min(np.take(cost, 0, axis=axis)))
+            if not end:
+                self.edge_cost = min(self.edge_cost, np.min(np.take(cost, -1, axis=axis)))
+
+    def count(self, upper):
+        """
+        :return: Number of voxels in the region with the given upper threshold
+        """
+        return np.searchsorted(self.costs, upper, side="right")
+
+class RegionGrower(LogSource):
+    """
+    Grows regions from a seed point for varying thresholds
+
+    The region is maintained in an ROI array, which is updated in place as the
+    thresholds change. Where possible, only voxels which are added to or removed
+    from the region are modified.
+
+    Building an index is slower than finding the region for a single pair of
+    thresholds, so it is only done when one of the thresholds changes. Initially,
+    or if both change at once, the region is found by connected component labelling.
+
+    After each update, ``changed_bbox`` is a tuple of slices bounding the voxels which
+    were added to or removed from the region, or None if the region did not change.
+    """
+
+    def __init__(self, data, seed, max_distance, roi):
+        """
+        :param data: 3D Numpy array
+        :param seed: Position of seed voxel
+        :param max_distance: Maximum distance in voxels along each axis from the seed
+        :param roi: Integer array with same shape as ``data`` in which region is marked with 1.
+                    This is expected to be zero initially
+        """
+        LogSource.__init__(self)
+        self._data = data
+        self._seed = [int(v) for v in seed]
+        self._max_distance = max_distance
+        self._tile_size = min(INITIAL_TILE_SIZE, max_distance)
+        self.roi = roi
+        # Flood indices for fixed lower and upper thresholds, as tuple of
+        # (fixed threshold, tile size, index, global voxel indices)
+        self._indices = {True : None, False : None}
+        self._thresholds = None
+        self._shown = None
+        self.changed_bbox = None
+
+    @property
+    def seed_value(self):
+        """ Data value at the seed voxel """
+        return self._data[tuple(self._seed)]
+
+    def update(self, lower, upper):
+        """
+        Update the region for new thresholds
+
+        :return: Number of voxels in the region
+        """
+        if self._data.dtype.kind == "f":
+            # Compare with thresholds at the precision of the data, as Numpy does
+            lower, upper = self._data.dtype.type(lower), self._data.dtype.type(upper)
+        previous, self._thresholds = self._thresholds, (lower, upper)
+        if previous == self._thresholds:
+            self.changed_bbox = None
+            return self._shown[1]
+        elif previous is None or (previous[0] != lower and previous[1] != upper):
+            # Building an index is only worthwhile if one threshold is being changed
+            # repeatedly, so just find the region for these thresholds
+            region = self._label(lower, upper)
+            self._show(region, len(region))
+            return len(region)
+
+        # Use the index for the threshold which has changed, building it if it
+        # is not valid for the current value of the other threshold
+        by_upper = previous[1] != upper
+        fixed, moving = (lower, upper) if by_upper else (-upper, -lower)
+        current = self._indices[by_upper]
+        if current is None or current[0] != fixed or (moving >= current[2].edge_cost and current[1] < self._max_distance):
+            tile_size = self._tile_size
+            while 1:
+                index, global_order = self._build(fixed, tile_size, by_upper)
+                if moving < index.edge_cost or tile_size == self._max_distance:
+                    break
+                tile_size = min(tile_size * 2, self._max_distance)
+            current = (fixed, tile_size, index, global_order)
+            self._indices[by_upper] = current
+            self._tile_size = max(self._tile_size, tile_size)
+
+        count = current[2].count(moving)
+        self._show(current[3], count)
+        return count
+
+    def _tile(self, tile_size):
+        """
+        :return: Tuple of slices defining tile, position of seed within tile, sequence of
+                 (start, end) booleans for each axis, True if the tile edge is also the data edge
+        """
+        slices, seed, data_edges = [], [], []
+        for pos, size in zip(self._seed, self._data.shape):
+            start, end = max(0, pos - tile_size), min(size, pos + tile_size + 1)
+            slices.append(slice(start, end))
+            seed.append(pos - start)
+            data_edges.append((start == 0, end == size))
+        return tuple(slices), seed, data_edges
+
+    def _global_indices(self, indices, slices):
+        """ Convert voxel indices within a tile to indices into the whole data """
+        shape = [sl.stop - sl.start for sl in slices]
+        coords = np.unravel_index(indices, shape)
+        coords = [coord + sl.start for coord, sl in zip(coords, slices)]
+        return np.ravel_multi_index(coords, self._data.shape)
+
+    def _label(self, lower, upper):
+        """
+        Find the region for a pair of thresholds by connected component labelling
+
+        :return: Indices of region voxels in the whole data
+        """
+        tile_size = self._tile_size
+        while 1:
+            slices, seed, data_edges = self._tile(tile_size)
+            tile = self._data[slices]
+            labelled, _ = scipy.ndimage.label(np.logical_and(tile >= lower, tile <= upper))
+            region = labelled == labelled[tuple(seed)]
+            if labelled[tuple(seed)] == 0:
+                region[...] = False
+            if tile_size == self._max_distance or not _on_edge(region, data_edges):
+                break
+            tile_size = min(tile_size * 2, self._max_distance)
+        self._tile_size = tile_size
+        return self._global_indices(np.flatnonzero(region), slices)
+
+    def _build(self, fixed, tile_size, by_upper):
+        slices, seed, data_edges = self._tile(tile_size)
+        tile = self._data[slices].astype(np.float64)
+        if not by_upper:
+            tile = -tile
+        self.debug("Building flood index: tile size %i, upper=%s", tile_size, by_upper)
+        index = _FloodIndex(tile, seed, fixed, data_edges)
+        return index, self._global_indices(index.order, slices)
+
+    def _show(self, order, count):
+        """
+        Update the ROI to show the first ``count`` voxels of an array of voxel indices
+        """
+        if self._shown is not None and self._shown[0] is order:
+            shown_count = self._shown[1]
+            if count > shown_count:
+                changed = order[shown_count:count]
+                np.put(self.roi, changed, 1)
+            else:
+                changed = order[count:shown_count]
+                np.put(self.roi, changed, 0)
+        else:
+            changed = order[:count]
+            if self._shown is not None:
+                np.put(self.roi, self._shown[0][:self._shown[1]], 0)
+                changed = np.concatenate([self._shown[0][:self._shown[1]], changed])
+            np.put(self.roi, order[:count], 1)
+        self._shown = (order, count)
+        self.changed_bbox = _bbox(changed, self.roi.shape)
@@ -0,0 +1,281 @@
+"""
+Quantiphyse - Tests for ROI builder widget
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import unittest
+
+import numpy as np
+import scipy.ndimage
+
+from quantiphyse.test import WidgetTest
+
+from .widget import RoiBuilderWidget, TOOLS
+from .history import RoiChange, RoiHistory
+from .region_grow import RegionGrower
+from .walker import WalkerSegmentation, seed_bbox
+
+NAME = "test_roi"
+
+class RoiBuilderWidgetTest(WidgetTest):
+
+    def widget_class(self):
+        return RoiBuilderWidget
+
+    def setUp(self):
+        WidgetTest.setUp(self)
+        self.ivm.add(np.zeros(self.grid.shape, dtype=int), grid=self.grid, roi=True, name=NAME)
+        self.w.options.option("roi").value = NAME
+        self.processEvents()
+        self.roidata = self.ivm.data[NAME].raw()
+
+    def testAddVolume(self):
+        self.w.modify(vol=self.mask, mode=self.w.ADD)
+        self.assertTrue(np.all(self.roidata == self.mask))
+        self.assertTrue(self.w._undo_btn.isEnabled())
+        self.assertFalse(self.w._redo_btn.isEnabled())
+        self.assertFalse(self.error)
+
+    def testUndoRedo(self):
+        self.w.modify(vol=self.mask, mode=self.w.ADD)
+        self.w.modify(points=[[0, 0, 0], [1, 2, 3], [1, 2, 3]], mode=self.w.ADD)
+        after = np.copy(self.roidata)
+
+        self.w._undo_btn.clicked.emit()
+        self.assertTrue(np.all(self.roidata == self.mask))
+        self.w._undo_btn.clicked.emit()
+        self.assertTrue(np.all(self.roidata == 0))
+        self.assertFalse(self.w._undo_btn.isEnabled())
+        self.assertTrue(self.w._redo_btn.isEnabled())
+
+        self.w._redo_btn.clicked.emit()
+        self.w._redo_btn.clicked.emit()
+        self.assertTrue(np.all(self.roidata == after))
+        self.assertFalse(self.w._redo_btn.isEnabled())
+        self.assertFalse(self.error)
+
+    def testSlice(self):
+        selection = np.ones(self.grid.shape[:2], dtype=int)
+        self.w.modify(slice2d=(selection, 2, 1), mode=self.w.ADD)
+        self.assertTrue(np.all(self.roidata[:, :, 1] == 1))
+        self.assertEqual(np.count_nonzero(self.roidata), selection.size)
+
+        self.w.undo()
+        self.assertTrue(np.all(self.roidata == 0))
+        self.assertFalse(self.error)
+
+    def testEraseMask(self):
+        self.roidata[...] = 1
+        self.w.modify(vol=self.mask, mode=self.w.ERASE)
+        self.assertTrue(np.all(self.roidata == 1 - self.mask))
+        self.w.undo()
+        self.w.modify(vol=self.mask, mode=self.w.MASK)
+        self.assertTrue(np.all(self.roidata == self.mask))
+        self.w.undo()
+        self.assertTrue(np.all(self.roidata == 1))
+        self.assertFalse(self.error)
+
+    def testNewChangeClearsRedo(self):
+        self.w.modify(vol=self.mask, mode=self.w.ADD)
+        self.w.undo()
+        self.w.modify(points=[[0, 0, 0]], mode=self.w.ADD)
+        self.assertFalse(self.w._redo_btn.isEnabled())
+        self.assertFalse(self.error)
+
+    def testRoiKeptInMemory(self):
+        # The ROI being built is modified in place so it must not be removed from memory
+        self.ivm.add(self.data_3d, grid=self.grid, name="data_3d", make_main=True)
+        self.ivm.set_current_roi(None)
+        self.ivm.memory_budget = 0
+        self.ivm.check_memory()
+        self.assertTrue(self.ivm.data[NAME].raw() is self.roidata)
+        self.w.modify(vol=self.mask, mode=self.w.ADD)
+        self.ivm.check_memory()
+        self.assertTrue(np.all(self.ivm.data[NAME].raw() == self.mask))
+
+        # Once the builder is deactivated the ROI can be removed from memory
+        self.w.deactivate()
+        self.assertEqual(self.ivm.memory_usage()[NAME], 0)
+        self.assertTrue(np.all(self.ivm.data[NAME].raw() == self.mask))
+        self.assertFalse(self.error)
+
+    def testBucket(self):
+        self.ivm.add(self.data_3d, grid=self.grid, name="data_3d", make_current=True)
+        bucket = [tool for tool in TOOLS if tool.name == "Bucket"][0]
+        bucket.btn.clicked.emit()
+        self.processEvents()
+        temp_roi = self.ivm.rois["_temp_bucket"]
+        count = np.count_nonzero(temp_roi.raw())
+        self.assertTrue(count > 0)
+
+        # Changing a threshold updates the temporary ROI in place
+        bucket.uthresh.val_edit.setText("0")
+        bucket.uthresh.val_edit.editingFinished.emit()
+        self.processEvents()
+        self.assertTrue(self.ivm.rois["_temp_bucket"] is temp_roi)
+        self.assertTrue(np.count_nonzero(temp_roi.raw()) <= count)
+
+        bucket._add()
+        self.assertTrue(np.all(self.roidata[temp_roi.raw() > 0] == 1))
+        self.assertFalse("_temp_bucket" in self.ivm.rois)
+        self.assertFalse(self.error)
+
+class RoiHistoryTest(unittest.TestCase):
+
+    def testChangeEncoded(self):
+        data = np.zeros((10, 10, 10), dtype=int)
+        data[2:5, ...] = 2
+        # A block of voxels is a single run of indices and values
+        change = RoiChange.from_selection(data, np.arange(500, 700), 3)
+        self.assertEqual(change.nvoxels, 200)
+        self.assertEqual(len(change._index_runs[0]), 1)
+        self.assertEqual(list(change.indices), list(range(500, 700)))
+
+        orig = np.copy(data)
+        change.apply(data)
+        self.assertTrue(np.all(data.flat[500:700] == 3))
+        change.revert(data)
+        self.assertTrue(np.all(data == orig))
+
+    def testUnchangedNotStored(self):
+        data = np.zeros((10, 10, 10), dtype=int)
+        data.flat[:50] = 1
+        change = RoiChange.from_selection(data, [70, 10, 60, 60], 1)
+        self.assertEqual(list(change.indices), [60, 70])
+
+    def testMaxSize(self):
+        data = np.zeros(1000, dtype=int)
+        history = RoiHistory(max_size=1)
+        for idx in range(3):
+            change = RoiChange.from_selection(data, np.arange(0, 1000, 2), idx+1)
+            change.apply(data)
+            history.record(change)
+        # Most recent change is always kept
+        self.assertEqual(len(history), 1)
+        self.assertTrue(history.undo(data))
+        self.assertTrue(np.all(data[::2] == 2))
+        self.assertFalse(history.undo(data))
+
+class RegionGrowerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = scipy.ndimage.gaussian_filter(np.random.rand(40, 40, 40), 2).astype(np.float32)
+        self.seed = (20, 18, 22)
+        self.seed_value = self.data[self.seed]
+
+    def _expected(self, lower, upper, max_distance=100):
+        slices = tuple([slice(max(0, pos-max_distance), pos+max_distance+1) for pos in self.seed])
+        tile = self.data[slices]
+        labelled, _ = scipy.ndimage.label(np.logical_and(tile >= lower, tile <= upper))
+        seed = tuple([pos - sl.start for pos, sl in zip(self.seed, slices)])
+        expected = np.zeros(self.data.shape, dtype=int)
+        expected[slices] = labelled == labelled[seed]
+        return expected
+
+    def _check(self, grower, lower, upper, max_distance=100):
+        lower, upper = self.seed_value + lower, self.seed_value + upper
+        previous = np.copy(grower.roi)
+        count = grower.update(lower, upper)
+        expected = self._expected(lower, upper, max_distance)
+        self.assertTrue(np.all(grower.roi == expected))
+        self.assertEqual(count, np.count_nonzero(expected))
+
+        # Changed voxels are all within the bounding box
+        changed = grower.roi != previous
+        if grower.changed_bbox is None:
+            self.assertFalse(np.any(changed))
+        else:
+            changed[grower.changed_bbox] = False
+            self.assertFalse(np.any(changed))
+
+    def testThresholdChanges(self):
+        grower = RegionGrower(self.data, self.seed, 100, np.zeros(self.data.shape, dtype=int))
+        self.assertAlmostEqual(grower.seed_value, self.seed_value)
+        # Initial region, then upper threshold changes, then lower threshold changes
+        for lower, upper in [(-0.005, 0.005), (-0.005, 0.01), (-0.005, 0.002), (-0.005, 0.02),
+                             (-0.01, 0.02), (-0.001, 0.02), (-0.1, 0.02), (-0.1, 0.1), (-0.1, 0.1), (-0.1, 0.001)]:
+            self._check(grower, lower, upper)
+
+    def testMaxDistance(self):
+        grower = RegionGrower(self.data, self.seed, 5, np.zeros(self.data.shape, dtype=int))
+        for lower, upper in [(-0.1, 0.1), (-0.1, 0.2), (-0.2, 0.2)]:
+            self._check(grower, lower, upper, 5)
+
+class WalkerSegmentationTest(unittest.TestCase):
+
+    def setUp(self):
+        from quantiphyse.data import DataGrid, NumpyData
+        # Bright sphere in a noisy background
+        shape = (40, 40, 40)
+        coords = np.indices(shape) - np.array([20, 20, 20])[:, None, None, None]
+        self.sphere = np.sum(np.square(coords), axis=0) <= 25
+        data = self.sphere.astype(np.float32) + 0.05 * np.random.rand(*shape)
+        self.grid = DataGrid(shape, np.identity(4))
+        self.qpdata = NumpyData(data, grid=self.grid, name="data")
+        self.qpdata_4d = NumpyData(np.stack([data * idx for idx in range(1, 7)], axis=-1), grid=self.grid, name="data_4d")
+        self.labels = np.zeros(shape, dtype=int)
+        self.labels[20, 20, 20] = 1
+        self.labels[20, 20, 12] = 2
+
+    def testBbox(self):
+        self.assertTrue(seed_bbox(np.zeros((5, 5, 5)), 1) is None)
+        box = seed_bbox(self.labels, 10)
+        self.assertEqual(box, (slice(10, 31), slice(10, 31), slice(2, 31)))
+        box = seed_bbox(self.labels, 10, zaxis=1, zpos=20)
+        self.assertEqual(box, (slice(10, 31), slice(20, 21), slice(2, 31)))
+
+    def testSegment3d(self):
+        walker = WalkerSegmentation()
+        seg = walker.segment(self.qpdata, self.grid, self.labels, 10000)
+        self.assertEqual(seg.shape, self.sphere.shape)
+        self.assertTrue(np.all(seg == self.sphere))
+
+    def testSegmentSlice(self):
+        walker = WalkerSegmentation()
+        seg = walker.segment(self.qpdata, self.grid, self.labels, 10000, zaxis=1, zpos=20)
+        self.assertTrue(np.all(seg[:, 20, :] == self.sphere[:, 20, :]))
+        self.assertEqual(np.count_nonzero(seg), np.count_nonzero(self.sphere[:, 20, :]))
+
+    def testSegment4d(self):
+        walker = WalkerSegmentation()
+        seg = walker.segment(self.qpdata_4d, self.grid, self.labels, 10000)
+        self.assertTrue(np.all(seg == self.sphere))
+
+    def testFeaturesCached(self):
+        walker = WalkerSegmentation(padding=2)
+        box = seed_bbox(self.labels, 2)
+        features, multichannel = walker.features(self.qpdata_4d, self.grid, box)
+        self.assertTrue(multichannel)
+        self.assertEqual(features.shape, (5, 5, 13, 5))
+
+        # A box within the cached box uses the cached features
+        inner = (slice(19, 22), slice(19, 22), slice(19, 22))
+        inner_features, _ = walker.features(self.qpdata_4d, self.grid, inner)
+        self.assertTrue(np.all(inner_features == features[1:4, 1:4, 9:12]))
+        self.assertEqual(walker._cached[2], box)
+
+        # A box outside the cached box extends it
+        outer = (slice(18, 23), slice(18, 23), slice(20, 30))
+        walker.features(self.qpdata_4d, self.grid, outer)
+        self.assertEqual(walker._cached[2], (slice(18, 23), slice(18, 23), slice(10, 30)))
+
+        # Changing the data invalidates the cache
+        self.qpdata_4d.clear_cache()
+        walker.features(self.qpdata_4d, self.grid, inner)
+        self.assertEqual(walker._cached[2], inner)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -18,9 +18,9 @@ limitations under the License.
 
 from __future__ import division, unicode_literals, absolute_import, print_function
 
+import threading
+
 import numpy as np
-import skimage.segmentation
-import scipy.ndimage
 
 try:
     from PySide import QtGui, QtCore, QtGui as QtWidgets
@@ -31,7 +31,23 @@ from quantiphyse.data import NumpyData
 from quantiphyse.gui.widgets import OverlayCombo, RoiCombo, NumericOption, NumericSlider
 from quantiphyse.gui.viewer.pickers import PickMode
 from quantiphyse.utils import LogSource
-from quantiphyse.processes.feat_pca import PcaFeatReduce
+from .region_grow import RegionGrower
+from .walker import WalkerSegmentation
+
+class _WalkerNotifier(QtCore.QObject):
+    """
+    Emits random walker segmentations calculated in a background thread. A single
+    instance is used which is never deleted, so it is always safe to emit from the thread
+    """
+    sig_segmented = QtCore.Signal(object, object)
+
+_WALKER_NOTIFIER = None
+
+def _walker_notifier():
+    global _WALKER_NOTIFIER
+    if _WALKER_NOTIFIER is None:
+        _WALKER_NOTIFIER = _WalkerNotifier()
+    return _WALKER_NOTIFIER
 
 class Tool(LogSource):
     """
@@ -277,6 +293,9 @@ class WalkerTool(Tool):
     """
     Tool which uses the random walker method to select a region
 
+    Segmentation runs in a background thread and is restricted to the
+    neighbourhood of the selected points - see ``WalkerSegmentation``.
+
     FIXME this does not work properly in slice mode at the moment because the zaxis/pos 
     given by the picker does not necessarily correspond to the data axes.
     """
@@ -284,6 +303,8 @@ class WalkerTool(Tool):
         Tool.__init__(self, "Walker", "Automatic segmentation using the random walk algorithm")
         self.segmode = 0
         self.pickmode = 0
+        self._walker = WalkerSegmentation()
+        self._segmenting = False
 
     def interface(self):
         grid = Tool.interface(self)
@@ -308,9 +329,9 @@ class WalkerTool(Tool):
 
         self.beta = NumericOption("Diffusion difficulty", grid, 4, 0, intonly=True, maxval=20000, default=10000, step=1000)
 
-        btn = QtGui.QPushButton("Segment")
-        btn.clicked.connect(self._segment)
-        grid.addWidget(btn, 5, 0)
+        self._segment_btn = QtGui.QPushButton("Segment")
+        self._segment_btn.clicked.connect(self._segment)
+        grid.addWidget(self._segment_btn, 5, 0)
         btn = QtGui.QPushButton("Clear points")
         btn.clicked.connect(self._init)
         grid.addWidget(btn, 5, 1)
@@ -362,55 +383,45 @@ class WalkerTool(Tool):
                 self.labels[pos[0], pos[1], pos[2]] = label
                 
     def _segment(self):
-        data = self.ivm.data[self.ov_combo.currentText()].resample(self.builder.grid)
-        labels = self.labels
-
-        kwargs = {}
-        # Use voxel size correctly
-        spacing = [data.grid.spacing[0] / data.grid.spacing[0],
-                   data.grid.spacing[0] / data.grid.spacing[1],
-                   data.grid.spacing[0] / data.grid.spacing[2]]
-
-        arr = data.raw()
-        if arr.ndim > 3:
-            # Reduce 4D data to PCA modes
-            pca = PcaFeatReduce(n_components=5)
-            arr = pca.get_training_features(arr, feature_volume=True)
-            kwargs["multichannel"] = True
-        else:
-            # Normalize data
-            arr = (arr / (np.max(arr)-np.min(arr))) + np.min(arr)
-            kwargs["multichannel"] = False
+        if self._segmenting:
+            return
 
+        qpdata = self.ivm.data[self.ov_combo.currentText()]
+        zaxis, zpos = None, None
         if self.segmode == 0:
             # Segment using 2D slice only
             zaxis = self.ivl.picker.zaxis
             zpos = int(self.ivl.picker.zpos + 0.5)
-            #print(zaxis, zpos)
-            sl = [slice(None)] * 3
-            sl[zaxis] = zpos
-            arr = arr[sl]
-            labels = self.labels[sl]
-            del spacing[zaxis] 
-            #print(labels)
-            #print(np.count_nonzero(labels))
-            #print(np.count_nonzero(arr))
-
-        seg = skimage.segmentation.random_walker(arr, labels, beta=self.beta.spin.value(), 
-                                                 mode='cg_mg', spacing=spacing, **kwargs)
-
-        if self.segmode == 0:
-            # Create 3D volume using 2D slice
-            seg_3d = np.zeros(self.builder.grid.shape, dtype=np.int)
-            seg_3d[sl] = seg
-            seg = seg_3d
 
-        # Label 2 is used for 'outside region'
-        seg[seg == 2] = 0
-        
+        self._segmenting = True
+        self._segment_btn.setEnabled(False)
+        _walker_notifier().sig_segmented.connect(self._segmented)
+        args = (qpdata, self.builder.grid, np.copy(self.labels), self.beta.spin.value(), zaxis, zpos)
+        thread = threading.Thread(target=self._segment_worker, args=args)
+        thread.daemon = True
+        thread.start()
+
+    def _segment_worker(self, qpdata, grid, labels, beta, zaxis, zpos):
+        try:
+            seg = self._walker.segment(qpdata, grid, labels, beta, zaxis, zpos)
+            _WALKER_NOTIFIER.sig_segmented.emit(seg, None)
+        except Exception as exc: # pylint: disable=broad-except
+            # Reported in the GUI thread
+            _WALKER_NOTIFIER.sig_segmented.emit(None, exc)
+
+    def _segmented(self, seg, exc):
+        _walker_notifier().sig_segmented.disconnect(self._segmented)
+        self._segmenting = False
+        self._segment_btn.setEnabled(True)
+        if exc is not None:
+            raise exc
+
+        if list(seg.shape) != list(self.builder.grid.shape):
+            self.debug("ROI grid changed during segmentation - discarding")
+            return
         self.builder.modify(vol=seg, mode=self.builder.ADD)
         self._init()
-             
+
 class BucketTool(Tool):
     """
     Tool which performs a thresholded bucket fill
@@ -420,6 +431,8 @@ class BucketTool(Tool):
         Tool.__init__(self, "Bucket", "2D or 3D flood fill with thresholding")
         self.point = None
         self.vol = 0
+        self.roi = None
+        self._grower, self._grower_key = None, None
 
     def interface(self):
         grid = Tool.interface(self)
@@ -455,6 +468,7 @@ class BucketTool(Tool):
     def _init(self):
         self.ivl.set_picker(PickMode.SINGLE)
         self._point = None
+        self._grower, self._grower_key = None, None
         if "_temp_bucket" in self.ivm.rois:
             self.ivm.delete("_temp_bucket")
         self._show_builder_roi()
@@ -476,50 +490,31 @@ class BucketTool(Tool):
         self._update_roi()
     
     def _update_roi(self):
-        src_data = self.ivm.current_data.resample(self.builder.grid).volume(self.vol)
-        focus_value = src_data[self.point[0], self.point[1], self.point[2]]
-        thr_hi, thr_lo = focus_value + self.uthresh.value(), focus_value + self.lthresh.value()
-        # Heuristic optimization for large data sets. Start by looking at a tile +- 50 voxels
-        # around focus. If that contains the region, fine. If not, add 50 voxels to the tile
-        # size and go again until we get nothing on the boundary or end up taking the whole
-        # data set
-        max_tile_size = self.max_tile_size.value()
-        tile_size = min(50, max_tile_size)
-        while 1:
-            tile, offset = self._get_tile(src_data, self.point, tile_size, src_data.shape)
-            binarised = ((tile <= thr_hi) & (tile >= thr_lo)).astype(np.int)
-            labelled, _ = scipy.ndimage.measurements.label(binarised)
-            scipy_label = labelled[self.point[0]-offset[0], self.point[1]-offset[1], self.point[2]-offset[2]]
-            labelled[labelled != scipy_label] = 0
-            labelled[labelled == scipy_label] = 1
-            if labelled.shape == src_data.shape or tile_size == max_tile_size:
-                self.debug("Reached full size, breaking: ", labelled.shape, src_data.shape)
-                break
-            elif (np.count_nonzero(labelled[:, :, 0]) == 0 and 
-                  np.count_nonzero(labelled[:, :, -1]) == 0 and
-                  np.count_nonzero(labelled[:, 0, :]) == 0 and
-                  np.count_nonzero(labelled[:, -1, :]) == 0 and
-                  np.count_nonzero(labelled[0, :, :]) == 0 and
-                  np.count_nonzero(labelled[-1, :, :]) == 0):
-                self.debug("Nothing on boundary, breaking")
-                break
-            tile_size = min(tile_size + 50, max_tile_size)
-
-        self.roi = np.zeros(self.builder.grid.shape, dtype=np.int)
-        tile_shape = labelled.shape
-        self.roi[offset[0]:offset[0]+tile_shape[0], offset[1]:offset[1]+tile_shape[1], offset[2]:offset[2]+tile_shape[2]] = labelled
-        self.ivm.add(self.roi, name="_temp_bucket", grid=self.builder.grid, roi=True, make_current=True)
-        
-    def _get_tile(self, arr, centre, size, shape):
-        slices, offset = [], []
-        for i in range(3):
-            start, end = centre[i]-size, centre[i]+size
-            if start < 0: start = 0
-            if end > shape[i]: end = shape[i]
-            slices.append(slice(start, end))
-            offset.append(start)
-        self.debug("Tile: ", slices, offset)
-        return arr[slices], offset
+        # The region grower is reused while only the thresholds change, so moving
+        # a threshold slider does not require the region to be grown from scratch
+        data = self.ivm.current_data
+        max_distance = int(self.max_tile_size.value())
+        key = (id(data), data.version, tuple(self.point), self.vol, self.builder.grid, max_distance)
+        if key != self._grower_key:
+            src_data = data.resample(self.builder.grid).volume(self.vol)
+            self.roi = np.zeros(self.builder.grid.shape, dtype=int)
+            self._grower = RegionGrower(src_data, self.point, max_distance, self.roi)
+            self._grower_key = key
+
+        focus_value = self._grower.seed_value
+        count = self._grower.update(focus_value + self.lthresh.value(), focus_value + self.uthresh.value())
+        self.debug("Region contains %i voxels", count)
+
+        # The ROI array is modified in place, so the temporary ROI only needs to be
+        # added to the IVM if it is not already there. Otherwise only the temporary
+        # ROI is redrawn, and only in views whose slice intersects the changed voxels
+        temp_roi = self.ivm.rois.get("_temp_bucket", None)
+        if temp_roi is not None and temp_roi.raw() is self.roi:
+            if self._grower.changed_bbox is not None:
+                temp_roi.clear_cache()
+                self.ivl.redraw_data("_temp_bucket", self._grower.changed_bbox)
+        else:
+            self.ivm.add(self.roi, name="_temp_bucket", grid=self.builder.grid, roi=True, make_current=True)
 
     def _add(self):
         self.builder.modify(vol=self.roi, mode=self.builder.ADD)
@@ -0,0 +1,197 @@
+"""
+Quantiphyse - Random walker segmentation for the ROI builder
+
+Segmentation is restricted to a padded bounding box around the seed points,
+so the cost depends on the size of the structure being segmented rather than
+the size of the data. Features used by the random walker (PCA modes for 4D data)
+are cached, so adding seed points within the same region does not require
+them to be calculated again.
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division, unicode_literals, absolute_import, print_function
+
+import weakref
+
+import numpy as np
+import skimage
+import skimage.segmentation
+
+from quantiphyse.data import DataGrid
+from quantiphyse.utils import LogSource, QpException
+from quantiphyse.processes.feat_pca import PcaFeatReduce
+
+#: Number of voxels by which the bounding box of the seed points is extended on each side
+WALKER_PADDING = 10
+
+#: Number of PCA modes used as features for 4D data
+WALKER_PCA_COMPONENTS = 5
+
+def _channel_args(multichannel):
+    """
+    :return: Keyword arguments for ``random_walker`` indicating whether the last axis of
+             the features is a channel axis. Older versions of scikit-image use
+             ``multichannel``, newer versions only accept ``channel_axis``
+    """
+    skimage_version = tuple(int(v) for v in skimage.__version__.split(".")[:2])
+    if skimage_version < (0, 19):
+        return {"multichannel" : multichannel}
+    else:
+        return {"channel_axis" : -1 if multichannel else None}
+
+def seed_bbox(labels, padding, zaxis=None, zpos=None):
+    """
+    Get the bounding box of the seed points, extended by padding
+
+    :param labels: 3D array in which seed points are labelled with non-zero values
+    :param padding: Number of voxels to extend the box by on each side
+    :param zaxis: If specified, only seed points in the slice ``zpos`` along this
+                  axis are included and the box is one voxel thick along this axis
+    :return: Tuple of slices, or None if there are no seed points
+    """
+    if zaxis is not None:
+        sl = [slice(None)] * 3
+        sl[zaxis] = slice(zpos, zpos+1)
+        labels = labels[tuple(sl)]
+
+    coords = np.nonzero(labels)
+    if len(coords[0]) == 0:
+        return None
+
+    box = []
+    for dim, coord in enumerate(coords):
+        if dim == zaxis:
+            box.append(slice(zpos, zpos+1))
+        else:
+            box.append(slice(max(0, np.min(coord) - padding), min(labels.shape[dim], np.max(coord) + padding + 1)))
+    return tuple(box)
+
+def _contains(outer, inner):
+    return all([o.start <= i.start and o.stop >= i.stop for o, i in zip(outer, inner)])
+
+def _union(box1, box2):
+    return tuple([slice(min(s1.start, s2.start), max(s1.stop, s2.stop)) for s1, s2 in zip(box1, box2)])
+
+def _box_grid(grid, box):
+    """
+    :return: DataGrid covering a box within a grid
+    """
+    affine = np.dot(grid.affine, np.array([
+        [1, 0, 0, box[0].start],
+        [0, 1, 0, box[1].start],
+        [0, 0, 1, box[2].start],
+        [0, 0, 0, 1],
+    ], dtype=np.float64))
+    return DataGrid([sl.stop - sl.start for sl in box], affine, units=grid.units)
+
+class WalkerSegmentation(LogSource):
+    """
+    Random walker segmentation of data on a grid, restricted to the neighbourhood of the seeds
+
+    Features for the most recently segmented box are cached. If a later box lies within it,
+    the cached features are used. Otherwise features are calculated for a box containing
+    both, so the cached region grows as seed points are added.
+    """
+
+    def __init__(self, padding=None):
+        """
+        :param padding: Number of voxels around the seed points to include in the
+                        segmentation. If not specified, ``WALKER_PADDING`` is used
+        """
+        LogSource.__init__(self)
+        if padding is None:
+            padding = WALKER_PADDING
+        self.padding = padding
+        # Tuple of cache key, weak reference to data, box, features
+        self._cached = None
+
+    def features(self, qpdata, grid, box):
+        """
+        Get the features used by the random walker within a box
+
+        :param qpdata: QpData object
+        :param grid: DataGrid on which the segmentation is being performed
+        :param box: Tuple of slices defining the box within ``grid``
+        :return: Tuple of feature array for box, True if the features are multichannel
+        """
+        key = (id(qpdata), qpdata.version, grid.affine.tobytes(), tuple(grid.shape))
+        cached = self._cached
+        if cached is not None and (cached[0] != key or cached[1]() is not qpdata):
+            cached = None
+
+        if cached is not None and _contains(cached[2], box):
+            self.debug("Using cached random walker features")
+        else:
+            if cached is not None:
+                box = _union(cached[2], box)
+            cached = (key, weakref.ref(qpdata), box, self._calc_features(qpdata, grid, box))
+            self._cached = cached
+
+        cached_box, features = cached[2], cached[3]
+        sl = tuple([slice(b.start - c.start, b.stop - c.start) for b, c in zip(box, cached_box)])
+        return features[sl], qpdata.nvols > 1
+
+    def _calc_features(self, qpdata, grid, box):
+        self.debug("Calculating random walker features for box %s", box)
+        arr = qpdata.resample(_box_grid(grid, box)).raw()
+        if arr.ndim > 3:
+            # Reduce 4D data to PCA modes
+            pca = PcaFeatReduce(n_components=WALKER_PCA_COMPONENTS)
+            return pca.get_training_features(arr, feature_volume=True)
+        else:
+            # Normalize data
+            arr = arr.astype(np.float32)
+            drange = np.max(arr) - np.min(arr)
+            if drange > 0:
+                arr = (arr - np.min(arr)) / drange
+            return arr
+
+    def segment(self, qpdata, grid, labels, beta, zaxis=None, zpos=None):
+        """
+        Perform segmentation
+
+        :param qpdata: QpData object containing the data to segment
+        :param grid: DataGrid on which to perform the segmentation
+        :param labels: Integer array with shape of ``grid`` in which seed points inside the
+                       region are labelled 1 and seed points outside the region are labelled 2
+        :param beta: Random walker diffusion difficulty
+        :param zaxis: If specified, segment in a 2D slice only, at position ``zpos`` on this axis
+        :return: Integer array with shape of ``grid`` in which the region is labelled 1
+        """
+        box = seed_bbox(labels, self.padding, zaxis, zpos)
+        if box is None:
+            raise QpException("No points have been selected")
+        features, multichannel = self.features(qpdata, grid, box)
+        box_labels = labels[box]
+
+        # Use voxel size correctly
+        spacing = [grid.spacing[0] / grid.spacing[0],
+                   grid.spacing[0] / grid.spacing[1],
+                   grid.spacing[0] / grid.spacing[2]]
+        if zaxis is not None:
+            features = np.squeeze(features, axis=zaxis)
+            box_labels = np.squeeze(box_labels, axis=zaxis)
+            del spacing[zaxis]
+
+        seg = skimage.segmentation.random_walker(features, box_labels, beta=beta, mode='cg_mg',
+                                                 spacing=spacing, **_channel_args(multichannel))
+        if zaxis is not None:
+            seg = np.expand_dims(seg, axis=zaxis)
+
+        # Label 2 is used for 'outside region'
+        ret = np.zeros(grid.shape, dtype=int)
+        ret[box] = seg == 1
+        return ret
@@ -20,8 +20,6 @@ limitations under the License.
 
 from __future__ import division, unicode_literals, absolute_import, print_function
 
-import collections
-
 import numpy as np
 
 try:
@@ -35,6 +33,7 @@ from quantiphyse.gui.widgets import QpWidget, TitleWidget
 from quantiphyse.gui.viewer.pickers import PickMode
 from quantiphyse.utils import get_icon, QpException
 
+from .history import RoiChange, RoiHistory
 from .tools import CrosshairsTool, PenTool, WalkerTool, PainterTool, EraserTool, RectTool, EllipseTool, PolygonTool, PickTool, BucketTool
 
 DESC = """
@@ -54,11 +53,12 @@ class RoiBuilderWidget(QpWidget):
     def __init__(self, **kwargs):
         super(RoiBuilderWidget, self).__init__(name="ROI Builder", icon="roi_builder", desc=DESC,  
                                                group="ROIs", **kwargs)
-        self._history = collections.deque(maxlen=10)
+        self._history = RoiHistory()
         self._tool = None
         self.grid = None
         self.roi = None
         self.roiname = None
+        self._pinned_roi = None
 
     def init_ui(self):
         layout = QtGui.QVBoxLayout()
@@ -101,6 +101,18 @@ class RoiBuilderWidget(QpWidget):
         self._undo_btn.setFixedSize(32, 32)
         self.tools_grid.addWidget(self._undo_btn, y, x)
 
+        x += 1
+        if x == cols:
+            y += 1
+            x = 0
+        self._redo_btn = QtGui.QPushButton()
+        self._redo_btn.clicked.connect(self.redo)
+        self._redo_btn.setEnabled(False)
+        self._redo_btn.setIcon(QtGui.QIcon(get_icon("redo")))
+        self._redo_btn.setToolTip("Redo last undone action")
+        self._redo_btn.setFixedSize(32, 32)
+        self.tools_grid.addWidget(self._redo_btn, y, x)
+
         hbox.addWidget(self._toolbox)
         self._toolbox.setEnabled(False)
         hbox.addStretch(1)
@@ -128,6 +140,14 @@ class RoiBuilderWidget(QpWidget):
         self.ivl.set_picker(PickMode.SINGLE)
         if self._tool is not None:
             self._tool.deselected()
+        self._pin_roi(None)
+
+    @property
+    def roidata(self):
+        """
+        Data array of the ROI being built, which is modified in place
+        """
+        return self.ivm.data[self.roiname].raw()
 
     def modify(self, vol=None, slice2d=None, points=None, mode=None):
         """
@@ -143,68 +163,68 @@ class RoiBuilderWidget(QpWidget):
         """
         label = self.options.option("label").value
         self.debug("label=%i", label)
-
-        # For undo functionality: selection is an object specifying which
-        # points or ROI region were selected, data_orig is a corresponding
-        # object which contains the data before the operation occurred.
-        selection, data_orig = None, None
+        roidata = self.roidata
+
+        # The change is specified as the flat indices of the affected voxels
+        # and their new value. For undo/redo functionality only the voxels which
+        # are actually changed are recorded, with their previous values
+        if mode == self.ADD:
+            value = label
+        elif mode in (self.ERASE, self.MASK):
+            value = 0
+        else:
+            raise ValueError("Invalid mode: %i" % mode)
 
         if points is not None:
-            selection = points
-            data_orig = [self.roidata[point[0], point[1], point[2]] for point in points]
-            for point in points:
-                if mode == self.ADD:
-                    self.roidata[point[0], point[1], point[2]] = label
-                elif mode == self.ERASE:
-                    self.roidata[point[0], point[1], point[2]] = 0
-                else:
-                    raise ValueError("Invalid mode: %i" % mode)
+            if mode == self.MASK:
+                raise ValueError("Invalid mode for points: %i" % mode)
+            points = np.array(points, dtype=np.int64).reshape(-1, 3)
+            in_bounds = np.all(np.logical_and(points >= 0, points < roidata.shape), axis=1)
+            indices = np.ravel_multi_index(points[in_bounds].T, roidata.shape)
         else:
-            # change_subset is a Numpy selection of the points to be
-            # affected, data_new is a corresponding binary array identifying
-            # the selected points in this subset to modify.
             if vol is not None:
-                # Selection left as None to indicate whole volume
                 selected_points = vol
-                change_subset = self.roidata
+                current = roidata
             elif slice2d is not None:
                 selected_points, axis, pos = slice2d
                 slices = [slice(None)] * 3
                 slices[axis] = pos
-                change_subset = self.roidata[slices]
-                # Selection is the axis index and position
-                selection = (axis, pos)
+                current = roidata[tuple(slices)]
             else:
                 raise ValueError("Neither volume nor slice nor points provided")
 
-            data_orig = np.copy(change_subset)
-            if mode == self.ADD:
-                self.debug("Adding: %i", np.count_nonzero(selected_points))
-                change_subset[selected_points > 0] = label
-            elif mode == self.ERASE:
-                self.debug("Erasing: %i", np.count_nonzero(selected_points))
-                change_subset[selected_points > 0] = 0
-            elif mode == self.MASK:
-                self.debug("Masking: %i", np.count_nonzero(selected_points))
-                change_subset[selected_points == 0] = 0
+            # Only voxels whose value will change are affected, so e.g. masking does
+            # not need to consider every voxel outside the selection
+            if mode == self.MASK:
+                affected = np.logical_and(np.asarray(selected_points) == 0, current != value)
             else:
-                raise ValueError("Invalid mode: %i" % mode)
-        
-        # Save the previous state of the data in the history list
-        self._history.append((selection, data_orig))
-        self._undo_btn.setEnabled(True)
+                affected = np.logical_and(np.asarray(selected_points) > 0, current != value)
+
+            if vol is not None:
+                indices = np.flatnonzero(affected)
+            else:
+                coords = list(np.nonzero(affected))
+                coords.insert(axis, np.full(coords[0].shape, pos, dtype=np.int64))
+                indices = np.ravel_multi_index(coords, roidata.shape)
+
+        change = RoiChange.from_selection(roidata, indices, value)
+        self.debug("Changing %i voxels to %i", change.nvoxels, value)
+        change.apply(roidata)
+        self._history.record(change)
+        self._update_history_btns()
         
         # Update the ROI - note that the regions may have been affected so make
         # sure they are regenerated
         self._update_regions()
         self.ivl.redraw()
-        self.debug("Now have %i nonzero", np.count_nonzero(self.roidata))
+        self.debug("Now have %i nonzero", np.count_nonzero(roidata))
 
     def _update_regions(self):
         """
         ROI regions may have been created or added so regenerate them but put 
         back existing label names
         """
+        self.ivm.data[self.roiname].clear_cache()
         current_regions = self.ivm.data[self.roiname].metadata.pop("roi_regions", {})
         new_regions = self.ivm.data[self.roiname].regions
         for label, desc in current_regions.items():
@@ -216,28 +236,26 @@ class RoiBuilderWidget(QpWidget):
         Undo the last change
         """
         self.debug("ROI undo: %i", len(self._history))
-        if not self._history: 
-            return
+        if self._history.undo(self.roidata):
+            self._history_changed()
 
-        selection, data_orig = self._history.pop()
-
-        # For selection, None indicates whole volume, tuple indicates
-        # an (axis, pos) slice, otherwise we have a sequence of points
-        if selection is None:
-            self.roidata[:] = data_orig
-        elif isinstance(selection, tuple):
-            axis, pos = selection
-            slices = [slice(None)] * 3
-            slices[axis] = pos
-            self.roidata[slices] = data_orig
-        else:
-            for point, orig_value in zip(selection, data_orig):
-                self.roidata[point[0], point[1], point[2]] = orig_value
+    def redo(self):
+        """
+        Redo the last change which was undone
+        """
+        self.debug("ROI redo")
+        if self._history.redo(self.roidata):
+            self._history_changed()
 
+    def _history_changed(self):
         self._update_regions()
         self.ivl.redraw()
         self.debug("Now have %i nonzero", np.count_nonzero(self.roidata))
-        self._undo_btn.setEnabled(len(self._history) > 0)
+        self._update_history_btns()
+
+    def _update_history_btns(self):
+        self._undo_btn.setEnabled(self._history.can_undo)
+        self._redo_btn.setEnabled(self._history.can_redo)
       
     def _label_changed(self):
         self.debug("Label changed")
@@ -276,9 +294,27 @@ class RoiBuilderWidget(QpWidget):
             current_label = self.options.option("label").value
             if self.roiname != roi.name or current_label not in regions.keys():
                 self.options.option("label").value = min(list(regions.keys()) + [1, ])
+            if self.roiname != roi.name:
+                # History is a set of changes to the previous ROI's data
+                self._history.clear()
+                self._update_history_btns()
             self.roiname = roi.name
             self.grid = roi.grid
-            self.roidata = roi.raw()
+            self._pin_roi(roi)
+        else:
+            self._pin_roi(None)
+
+    def _pin_roi(self, roi):
+        """
+        Keep the ROI being built in memory, as it is modified in place
+        """
+        if roi is self._pinned_roi:
+            return
+        if self._pinned_roi is not None and self.ivm.data.get(self._pinned_roi.name, None) is self._pinned_roi:
+            self.ivm.unpin(self._pinned_roi.name)
+        self._pinned_roi = roi
+        if roi is not None:
+            self.ivm.pin(roi.name)
 
     def _new_roi(self):
         dialog = QtGui.QDialog(self)
@@ -308,8 +344,8 @@ class RoiBuilderWidget(QpWidget):
 
             # Throw away old history. FIXME is this right, should we keep existing data and history?
             # Also should we cache old history in case we go back to this ROI?
-            self._history = []
-            self._undo_btn.setEnabled(False)
+            self._history.clear()
+            self._update_history_btns()
             self.options.option("roi").value = roiname
 
     def _tool_selected(self, tool):
@@ -1,9 +1,11 @@
 from .process import SmoothingProcess
 from .widget import SmoothingWidget
 from .tests import SmoothingWidgetTests
+from .process_tests import SmoothingProcessTest
 
 QP_MANIFEST = {
     "widgets" : [SmoothingWidget,],
     "widget-tests" : [SmoothingWidgetTests,],
+    "process-tests" : [SmoothingProcessTest,],
     "processes" : [SmoothingProcess,]
 }
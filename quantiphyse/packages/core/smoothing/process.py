@@ -18,13 +18,90 @@ limitations under the License.
 
 import numpy as np
 import scipy.ndimage.filters
+import scipy.signal
 
 from quantiphyse.processes import Process
 from quantiphyse.data import NumpyData
+from quantiphyse.utils import QpException
+
+#: Minimum sigma in voxels for which the recursive filter is used. The recursive
+#: approximation is poor for small sigmas (e.g. the error is around 9% of the peak
+#: of the impulse response at sigma=1) so the standard filter is used instead.
+#: Above this value the error is within about 4% of the impulse response peak, and
+#: within about 3% of the data range for typical image data
+IIR_MIN_SIGMA = 3.0
+
+# Equivalent numpy padding modes for scipy.ndimage boundary modes
+_PAD_MODES = {
+    "reflect" : "symmetric",
+    "nearest" : "edge",
+    "mirror" : "reflect",
+    "wrap" : "wrap",
+    "constant" : "constant",
+}
+
+def _iir_coeffs(sigma):
+    """
+    Coefficients of the recursive approximation to a Gaussian filter
+
+    From Young & van Vliet, "Recursive implementation of the Gaussian filter",
+    Signal Processing 44 (1995) 139-151
+
+    :return: Tuple of numerator, denominator coefficients for a single direction
+    """
+    if sigma >= 2.5:
+        q = 0.98711*sigma - 0.96330
+    else:
+        q = 3.97156 - 4.14554*np.sqrt(1 - 0.26891*sigma)
+
+    b0 = 1.57825 + 2.44413*q + 1.4281*q**2 + 0.422205*q**3
+    b1 = 2.44413*q + 2.85619*q**2 + 1.26661*q**3
+    b2 = -(1.4281*q**2 + 1.26661*q**3)
+    b3 = 0.422205*q**3
+    gain = 1 - (b1 + b2 + b3) / b0
+    return np.array([gain]), np.array([1, -b1/b0, -b2/b0, -b3/b0])
+
+def _iir_filter1d(data, sigma, axis, mode="reflect"):
+    """
+    Recursive Gaussian filter along one axis
+
+    The filter is run forwards and then backwards. The cost does not depend on 
+    sigma so this is much faster than the standard filter for large sigmas. Edges 
+    are handled by padding the data using the boundary mode, by the same amount as 
+    the truncated kernel of the standard filter.
+
+    :param mode: Boundary mode, as for ``scipy.ndimage.gaussian_filter``
+    """
+    if mode not in _PAD_MODES:
+        raise QpException("Unknown boundary mode: %s" % mode)
+    npad = int(4*sigma + 0.5)
+    padding = [(0, 0)] * data.ndim
+    padding[axis] = (npad, npad)
+    data = np.pad(data, padding, mode=_PAD_MODES[mode])
+
+    numer, denom = _iir_coeffs(sigma)
+    zi_shape = [1] * data.ndim
+    zi_shape[axis] = len(denom) - 1
+    zi = scipy.signal.lfilter_zi(numer, denom).reshape(zi_shape)
+
+    edge = [slice(None)] * data.ndim
+    edge[axis] = slice(0, 1)
+    fwd, _ = scipy.signal.lfilter(numer, denom, data, axis=axis, zi=zi*data[tuple(edge)])
+    fwd = np.flip(fwd, axis)
+    bwd, _ = scipy.signal.lfilter(numer, denom, fwd, axis=axis, zi=zi*fwd[tuple(edge)])
+
+    crop = [slice(None)] * data.ndim
+    crop[axis] = slice(npad, data.shape[axis] - npad)
+    return np.flip(bwd, axis)[tuple(crop)]
 
 class SmoothingProcess(Process):
     """
     Simple process for Gaussian smoothing
+
+    Volumes are smoothed one at a time in single precision so only the output and a 
+    few volumes of working space are required. Non-finite values are handled using 
+    normalized convolution, which requires a second filter pass, but only for volumes
+    which actually contain non-finite values.
     """
     PROCESS_NAME = "Smooth"
 
@@ -39,6 +116,11 @@ class SmoothingProcess(Process):
         order = options.pop("order", 0)
         mode = options.pop("boundary-mode", "reflect")
         sigma = options.pop("sigma", 1.0)
+        method = options.pop("method", "fir").lower()
+        if method not in ("fir", "iir"):
+            raise QpException("Unknown smoothing method: %s" % method)
+        if method == "iir" and order != 0:
+            raise QpException("Recursive smoothing does not support derivative filters")
 
         # Sigma is in mm so scale with data voxel sizes
         if isinstance(sigma, (int, float)):
@@ -47,26 +129,50 @@ class SmoothingProcess(Process):
             sigmas = [float(sig) / size for sig, size in zip(sigma, data.grid.spacing)]
 
         # Smooth multiple volumes independently
-        if data.nvols > 1:
-            sigmas += [0, ]
-
-        #output = scipy.ndimage.filters.gaussian_filter(data.raw(), sigmas, order=order, mode=mode)
-        output = self._norm_conv(data.raw(), sigmas, order=order, mode=mode)
+        output = np.zeros(list(data.grid.shape) + [data.nvols,], dtype=np.float32)
+        for vol in range(data.nvols):
+            voldata = np.array(data.volume(vol), dtype=np.float32)
+            output[..., vol] = self._norm_conv(voldata, sigmas, method, order=order, mode=mode)
+            self.sig_progress.emit(float(vol+1) / data.nvols)
+
+        if data.nvols == 1:
+            output = output[..., 0]
         self.ivm.add(NumpyData(output, grid=data.grid, name=output_name), make_current=True)
 
-    def _norm_conv(self, data, sigma, **kwargs):
-      """
-      Normalized convolution
-
-      This is a way to compensate for data having nan/infinite values.
-      Taken from stackoverflow.com/questions/18697532/gaussian-filtering-a-image-with-nan-in-python
-      """
-      v = data.copy()
-      v[~np.isfinite(data)] = 0
-      vv = scipy.ndimage.filters.gaussian_filter(v, sigma, **kwargs)
-
-      w = 0*data.copy()+1
-      w[~np.isfinite(data)] = 0
-      ww = scipy.ndimage.filters.gaussian_filter(w, sigma, **kwargs)
-      
-      return vv/ww
+    def _norm_conv(self, data, sigma, method, **kwargs):
+        """
+        Normalized convolution
+
+        This is a way to compensate for data having nan/infinite values.
+        Taken from stackoverflow.com/questions/18697532/gaussian-filtering-a-image-with-nan-in-python
+
+        If all values are finite this is the same as simply applying the filter
+        so the weight image is not required.
+        """
+        finite = np.isfinite(data)
+        if np.all(finite):
+            return self._filter(data, sigma, method, **kwargs)
+
+        data[~finite] = 0
+        smoothed = self._filter(data, sigma, method, **kwargs)
+        weights = self._filter(finite.astype(np.float32), sigma, method, **kwargs)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            np.divide(smoothed, weights, out=smoothed)
+        return smoothed
+
+    def _filter(self, data, sigma, method, **kwargs):
+        """
+        Gaussian filter a single volume of data
+
+        :param method: ``fir`` to use the standard filter, ``iir`` to use the recursive
+                       approximation for axes where sigma is at least ``IIR_MIN_SIGMA`` voxels
+        """
+        if method == "fir":
+            return scipy.ndimage.filters.gaussian_filter(data, sigma, output=np.float32, **kwargs)
+
+        fir_sigma = [sig if sig < IIR_MIN_SIGMA else 0 for sig in sigma]
+        output = scipy.ndimage.filters.gaussian_filter(data, fir_sigma, output=np.float32, **kwargs)
+        for axis, sig in enumerate(sigma):
+            if sig >= IIR_MIN_SIGMA:
+                output = _iir_filter1d(output, sig, axis, kwargs.get("mode", "reflect")).astype(np.float32)
+        return output
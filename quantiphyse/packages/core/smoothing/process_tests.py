@@ -0,0 +1,86 @@
+"""
+Quantiphyse - Tests for smoothing process
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+import numpy as np
+import scipy.ndimage
+
+from quantiphyse.data import NumpyData
+from quantiphyse.test import ProcessTest
+from quantiphyse.utils import QpException
+
+from .process import SmoothingProcess, IIR_MIN_SIGMA
+
+# Maximum difference between the recursive and standard filters, as a fraction
+# of the data range, when sigma is at least IIR_MIN_SIGMA voxels
+IIR_TOLERANCE = 0.04
+
+class SmoothingProcessTest(ProcessTest):
+
+    testshape = (20, 20, 20)
+
+    def _smooth(self, data, **options):
+        self.ivm.add(NumpyData(data, grid=self.grid, name="data"))
+        options.update({"data" : "data", "output-name" : "smoothed"})
+        SmoothingProcess(self.ivm).run(options)
+        return self.ivm.data["smoothed"].raw()
+
+    def _assert_close(self, smoothed, expected, data):
+        self.assertTrue(np.all(np.isfinite(smoothed)))
+        maxdiff = np.max(np.abs(smoothed - expected))
+        self.assertTrue(maxdiff <= IIR_TOLERANCE * np.ptp(data), "Difference %f too large" % maxdiff)
+
+    def testIir(self):
+        for sigma in (IIR_MIN_SIGMA, 5.0):
+            for mode in ("reflect", "nearest", "wrap", "constant"):
+                smoothed = self._smooth(self.data_3d, sigma=sigma, method="iir", **{"boundary-mode" : mode})
+                expected = scipy.ndimage.gaussian_filter(self.data_3d, sigma, mode=mode)
+                self._assert_close(smoothed, expected, self.data_3d)
+
+    def testIirSmallSigma(self):
+        # Below the minimum sigma the standard filter is used
+        sigma = IIR_MIN_SIGMA / 2
+        smoothed = self._smooth(self.data_3d, sigma=sigma, method="iir")
+        expected = scipy.ndimage.gaussian_filter(self.data_3d, sigma)
+        self.assertTrue(np.allclose(smoothed, expected, atol=1e-5))
+
+    def testIir4d(self):
+        # Volumes are smoothed independently
+        sigma = IIR_MIN_SIGMA
+        smoothed = self._smooth(self.data_4d, sigma=sigma, method="iir")
+        self.assertEqual(smoothed.shape, self.data_4d.shape)
+        for vol in range(self.data_4d.shape[3]):
+            expected = scipy.ndimage.gaussian_filter(self.data_4d[..., vol], sigma)
+            self._assert_close(smoothed[..., vol], expected, self.data_4d[..., vol])
+
+    def testIirNan(self):
+        # Non-finite values are excluded using normalized convolution
+        sigma = IIR_MIN_SIGMA
+        data = np.copy(self.data_3d)
+        data[5:8, 5:8, 5:8] = np.nan
+        data[0, 0, 0] = np.inf
+        smoothed = self._smooth(data, sigma=sigma, method="iir")
+
+        finite = np.isfinite(data)
+        zeroed = np.where(finite, data, 0)
+        expected = (scipy.ndimage.gaussian_filter(zeroed, sigma) /
+                    scipy.ndimage.gaussian_filter(finite.astype(np.float32), sigma))
+        self._assert_close(smoothed, expected, self.data_3d)
+
+    def testIirDerivative(self):
+        self.ivm.add(NumpyData(self.data_3d, grid=self.grid, name="data"))
+        with self.assertRaises(QpException):
+            SmoothingProcess(self.ivm).run({"data" : "data", "sigma" : IIR_MIN_SIGMA, "method" : "iir", "order" : 1})
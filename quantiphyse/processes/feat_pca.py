@@ -18,38 +18,122 @@ limitations under the License.
 
 from __future__ import division, print_function, absolute_import
 
+import logging
+import hashlib
+import weakref
+from collections import OrderedDict
+
 import numpy as np
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
 from scipy.ndimage.filters import gaussian_filter1d
 
 from quantiphyse.utils import QpException, LogSource
 from . import normalisation as norm
 
-def _flat_data_to_image(data, roi):
-    # return features in image format
-    image_shape = list(roi.shape)
-    if data.ndim == 2:
-        image_shape.append(data.shape[1])
-    image = np.zeros(image_shape)
-    image[roi] = data
-    return image
+#: Approximate size in bytes of the chunks of voxel data which are processed 
+#: at one time by the incremental solver and when projecting data onto the modes
+CHUNK_SIZE = 64*1024*1024
+
+#: Normalisation methods which act on each voxel independently so the data can be
+#: normalised in chunks. Other methods require all the data to be normalised together
+VOXELWISE_NORM = ("sigenh",)
+
+#: Maximum total size in bytes of the features kept by ``get_features()``
+FEATURE_CACHE_SIZE = 256*1024*1024
+
+LOG = logging.getLogger(__name__)
+
+# Fitted PCA models and their features, most recently used last. Keys include 
+# the identity and version of the data so entries are not reused if the data 
+# is modified or replaced
+_FEATURE_CACHE = OrderedDict()
+
+def get_features(qpdata, roi=None, feature_volume=False, **kwargs):
+    """
+    Get PCA features for a data set, reusing a previously fitted model if possible
+
+    This avoids repeating the PCA reduction when a process is re-run with
+    options that do not affect it, e.g. the number of clusters for K-Means
+
+    :param qpdata: 4D QpData
+    :param roi: Optional 3D ROI array in the data grid
+    :param feature_volume: See ``PcaFeatReduce.get_training_features``
+    :param kwargs: Arguments for ``PcaFeatReduce``
+    :return: Tuple of fitted PcaFeatReduce and features as returned by 
+             ``PcaFeatReduce.get_training_features``. The features are shared 
+             with the cache so must not be modified
+    """
+    if roi is not None:
+        roi = np.array(roi, dtype=bool)
+        roi_key = (roi.shape, hashlib.sha1(np.packbits(roi)).hexdigest())
+    else:
+        roi_key = None
+    key = (id(qpdata), qpdata.version, roi_key, feature_volume, tuple(sorted(kwargs.items())))
+
+    entry = _FEATURE_CACHE.pop(key, None)
+    if entry is not None and entry[0]() is qpdata:
+        LOG.debug("Using cached PCA features for %s", qpdata.name)
+        _FEATURE_CACHE[key] = entry
+        return entry[1], entry[2]
+
+    pca = PcaFeatReduce(**kwargs)
+    features = pca.get_training_features(qpdata.raw(), roi, feature_volume=feature_volume)
+    _cache_features(key, (weakref.ref(qpdata), pca, features))
+    return pca, features
+
+def clear_feature_cache():
+    """
+    Remove all cached PCA models and features
+    """
+    _FEATURE_CACHE.clear()
+
+def _cache_features(key, entry):
+    """
+    Add features to the cache, removing entries for data which no longer exists
+    and least recently used entries if the cache is too big
+    """
+    for old_key, old_entry in list(_FEATURE_CACHE.items()):
+        if old_entry[0]() is None:
+            del _FEATURE_CACHE[old_key]
+
+    if entry[2].nbytes > FEATURE_CACHE_SIZE:
+        return
+
+    _FEATURE_CACHE[key] = entry
+    cache_size = sum([cached[2].nbytes for cached in _FEATURE_CACHE.values()])
+    while cache_size > FEATURE_CACHE_SIZE:
+        _, cached = _FEATURE_CACHE.popitem(last=False)
+        cache_size -= cached[2].nbytes
 
 class PcaFeatReduce(LogSource):
     """
     Extract PCA features from 4D image data
 
-    Thin wrapper around sklearn.decomposition.PCA
+    Thin wrapper around sklearn.decomposition.PCA. The ``incremental`` solver
+    uses sklearn.decomposition.IncrementalPCA to fit the modes to chunks of
+    voxels in turn so the full data set is not required in memory.
     """
 
-    def __init__(self, n_components, norm_modes=True, norm_input=False, norm_type='perc'):
+    def __init__(self, n_components, norm_modes=True, norm_input=False, norm_type='perc', solver="auto"):
         """
-        :param data: 4D image to be processed
-        :param roi: Optional sub region to extract
+        :param n_components: Number of PCA modes
+        :param norm_modes: If True, normalise features so each lies between 0 and 1
+        :param norm_input: If True, normalise input data using ``norm_type``
+        :param norm_type: Normalisation method - see ``normalisation.normalise``
+        :param solver: ``auto``, ``full`` or ``randomized`` to select the SVD solver used by 
+                       sklearn.decomposition.PCA, or ``incremental`` to fit in chunks of voxels
         """
         LogSource.__init__(self)
 
         # Variables
-        self.pca = PCA(n_components=n_components)
+        if solver == "incremental":
+            self.pca = IncrementalPCA(n_components=n_components)
+        elif solver in ("auto", "full", "randomized"):
+            self.pca = PCA(n_components=n_components, svd_solver=solver)
+        else:
+            raise QpException("Unknown PCA solver: %s" % solver)
+        self.n_components = n_components
+        self.solver = solver
         self.norm_modes = norm_modes
         self.norm_input = norm_input
         self.norm_type = norm_type
@@ -58,7 +142,8 @@ class PcaFeatReduce(LogSource):
         """
         Train PCA reduction on data and return features for each voxel
 
-        :param data: 4D data set
+        :param data: 4D data set. This may be a memory mapped array - with the incremental
+                     solver only one chunk of voxels is read into memory at a time
         :param roi: Optional 3D ROI
         :param smooth_timeseries: Optional sigma for 1D Gaussian smoothing of each voxel timeseries
         :param feature_volume: determines whether the features are returned as a list or an image
@@ -68,20 +153,21 @@ class PcaFeatReduce(LogSource):
                  Otherwise, 2D array whose first dimension is unmasked voxels and 2nd dimension
                  is the PCA components
         """
-        data_inmask, roi = self._mask(data, roi, smooth_timeseries)
+        roi = self._roi(data, roi)
+        # If the number of components is not given, all are used
+        n_components = self.n_components if self.n_components else data.shape[-1]
 
         self.debug("Using PCA dimensionality reduction")
-        reduced_data = self.pca.fit_transform(data_inmask)
-        self.debug("Number of components", reduced_data.shape[1])
-
-        if self.norm_modes:
-            self.debug("Normalising PCA modes between 0 and 1")
-            reduced_data = norm.normalise(reduced_data, "indiv")
-
-        if not feature_volume:
-            return reduced_data
+        if self.solver == "incremental":
+            if np.count_nonzero(roi) < n_components:
+                raise QpException("Number of voxels must be at least the number of PCA components")
+            for data_inmask, _ in self._chunks(data, roi, smooth_timeseries, min_voxels=n_components):
+                self.pca.partial_fit(data_inmask)
+        else:
+            self.pca.fit(self._mask(data, roi, smooth_timeseries))
+        self.debug("Number of components", self.pca.n_components_)
 
-        return _flat_data_to_image(reduced_data, roi)
+        return self._transform(data, roi, smooth_timeseries, feature_volume)
 
     def get_projected_test_features(self, data, roi=None, smooth_timeseries=None, feature_volume=False):
         """
@@ -96,23 +182,11 @@ class PcaFeatReduce(LogSource):
                  Otherwise, 2D array whose first dimension is unmasked voxels and 2nd dimension
                  is the PCA components
         """
-        data_inmask, roi = self._mask(data, roi, smooth_timeseries)
-        
         #Projecting the data using training set PCA
-        if data_inmask.shape[1] != self.pca.mean_.shape[0]:
+        if data.shape[-1] != self.pca.mean_.shape[0]:
             raise QpException("Input data length does not match previous training data")
             
-        reduced_data = self.pca.transform(data_inmask)
-
-        # Scaling features
-        if self.norm_modes:
-            self.debug("Normalising PCA modes")
-            reduced_data = norm.normalise(reduced_data, "indiv")
-
-        if not feature_volume:
-            return reduced_data
-        
-        return _flat_data_to_image(reduced_data, roi)
+        return self._transform(data, self._roi(data, roi), smooth_timeseries, feature_volume)
 
     def explained_variance(self, cumulative=False):
         """
@@ -143,16 +217,98 @@ class PcaFeatReduce(LogSource):
         #return np.squeeze(norm.normalise(np.expand_dims(self.pca.mean_, axis=0), "indiv"))
         return self.pca.mean_
 
-    def _mask(self, data, roi, smooth_timeseries):
+    def _roi(self, data, roi):
         if roi is None:
-            roi = np.ones(data.shape[0:-1], dtype=bool)
+            return np.ones(data.shape[0:-1], dtype=bool)
         else:
-            roi = np.array(roi, dtype=np.bool)
-        data_inmask = data[roi]
+            return np.array(roi, dtype=bool)
 
+    def _preprocess(self, data_inmask, smooth_timeseries):
         if self.norm_input:
             data_inmask = norm.normalise(data_inmask, self.norm_type)
 
         if smooth_timeseries is not None:
             data_inmask = gaussian_filter1d(data_inmask, sigma=smooth_timeseries, axis=-1)
-        return data_inmask, roi
+        return data_inmask
+
+    def _mask(self, data, roi, smooth_timeseries):
+        return self._preprocess(data[roi], smooth_timeseries)
+
+    def _chunks(self, data, roi, smooth_timeseries, min_voxels=1):
+        """
+        Generate preprocessed data for chunks of voxels
+
+        Chunks are slabs along the first axis containing approximately ``CHUNK_SIZE``
+        bytes of data within the ROI
+
+        :param min_voxels: Minimum number of voxels in a chunk
+        :return: Generator of tuple of 2D array of voxel data within the ROI, 
+                 (start, end) indices of the slab
+        """
+        voxel_size = data.shape[-1] * np.dtype(np.float64).itemsize
+        chunk_voxels = max(CHUNK_SIZE // voxel_size, min_voxels)
+        bounds = self._chunk_bounds(roi, chunk_voxels, min_voxels)
+        if self.norm_input and self.norm_type not in VOXELWISE_NORM:
+            # Normalisation depends on all of the data so do this first
+            self.debug("Normalising data in memory for normalisation method %s", self.norm_type)
+            data_inmask = self._mask(data, roi, smooth_timeseries)
+            offset = 0
+            for start, end in bounds:
+                nvoxels = np.count_nonzero(roi[start:end])
+                yield data_inmask[offset:offset+nvoxels], (start, end)
+                offset += nvoxels
+        else:
+            for start, end in bounds:
+                yield self._preprocess(np.asarray(data[start:end])[roi[start:end]], smooth_timeseries), (start, end)
+
+    def _chunk_bounds(self, roi, chunk_voxels, min_voxels):
+        """
+        :return: Sequence of (start, end) indices of slabs along the first axis each containing
+                 at least ``chunk_voxels`` voxels in the ROI, apart from the last which 
+                 contains at least ``min_voxels``
+        """
+        cumulative = np.cumsum(np.count_nonzero(roi.reshape(roi.shape[0], -1), axis=1))
+        bounds, start = [], 0
+        while start < len(cumulative):
+            done = cumulative[start-1] if start > 0 else 0
+            end = min(np.searchsorted(cumulative, done + chunk_voxels) + 1, len(cumulative))
+            bounds.append((start, end))
+            start = end
+
+        if len(bounds) > 1 and cumulative[-1] - cumulative[bounds[-1][0]-1] < min_voxels:
+            bounds[-2:] = [(bounds[-2][0], len(cumulative))]
+        return bounds
+
+    def _transform(self, data, roi, smooth_timeseries, feature_volume):
+        """
+        Project data onto the PCA modes in chunks, writing features directly into the output array
+        """
+        n_components = self.pca.n_components_
+        if feature_volume:
+            features = np.zeros(list(roi.shape) + [n_components], dtype=np.float32)
+        else:
+            features = np.zeros((np.count_nonzero(roi), n_components), dtype=np.float32)
+
+        offset = 0
+        fmin, fmax = np.full(n_components, np.inf), np.full(n_components, -np.inf)
+        for data_inmask, (start, end) in self._chunks(data, roi, smooth_timeseries):
+            if len(data_inmask) == 0:
+                continue
+            reduced_data = self.pca.transform(data_inmask)
+            if feature_volume:
+                features[start:end][roi[start:end]] = reduced_data
+            else:
+                features[offset:offset+len(reduced_data)] = reduced_data
+                offset += len(reduced_data)
+            fmin = np.minimum(fmin, np.min(reduced_data, axis=0))
+            fmax = np.maximum(fmax, np.max(reduced_data, axis=0))
+
+        if self.norm_modes:
+            # Equivalent to normalise(features, "indiv") applied to the voxels in the ROI
+            self.debug("Normalising PCA modes between 0 and 1")
+            features -= fmin.astype(np.float32)
+            features /= (fmax - fmin + 0.001).astype(np.float32)
+            if feature_volume:
+                features[~roi] = 0
+
+        return features
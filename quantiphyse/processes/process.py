@@ -13,12 +13,16 @@ Copyright (c) 2013-2018 University of Oxford
 """
 
 import os
+import atexit
+import signal
 import multiprocessing
 import multiprocessing.pool
 import threading
 import traceback
 import logging
 import re
+import collections
+import itertools
 from six.moves import queue as singleproc_queue
 
 import numpy as np
@@ -30,6 +34,8 @@ except ImportError:
 from quantiphyse.data import NumpyData, save
 from quantiphyse.utils import LogSource, QpException, get_plugins, set_local_file_path
 
+from .shared import SharedArray, share, resolve, retrieve, discard, remove_shared, remove_stale
+
 #: Axis to split along when splitting up data sets for multiprocessing
 #: Could be 0, 1 or 2, but 0 is probably optimal for Numpy arrays which are column-major by default
 SPLIT_AXIS = 0
@@ -37,11 +43,30 @@ SPLIT_AXIS = 0
 #: Whether to use multiprocessing - can be disabled for debugging
 MULTIPROC = True
 
+#: Number of worker processes in the shared pool. If None, use one per CPU
+POOL_SIZE = None
+
+#: Time in seconds that cancelled workers are given to stop before they are terminated
+CANCEL_GRACE_PERIOD = 2.0
+
 # Guard against processes which fail with massive logfiles
 MAX_LOG_SIZE=100000
 
 LOG = logging.getLogger(__name__)
 
+# Shared worker pool and manager used by all background processes. These are
+# created when first needed and kept for the lifetime of the application
+_POOL = None
+_MANAGER = None
+_POOL_LOCK = threading.RLock()
+
+# Number of running processes using each pool. A pool which has been replaced
+# (e.g. because a worker was terminated) is kept until no process is using it
+_POOL_USERS = {}
+
+# Used to give each run of a process a unique tag for its shared data files
+_RUN_COUNTER = itertools.count()
+
 def _worker_initialize():
     """
     Initializer function for multiprocessing workers.
@@ -51,6 +76,228 @@ def _worker_initialize():
     set_local_file_path()
     get_plugins()
 
+def get_pool():
+    """
+    Get the shared pool of worker processes, creating it if required
+
+    Workers are initialized once when the pool is created so plugin discovery is not
+    repeated for every background process.
+
+    :return: multiprocessing.Pool instance
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            # Shared data files left behind by earlier sessions which did not exit cleanly
+            remove_stale()
+            pool_size = get_pool_size()
+            LOG.debug("Creating worker pool with %i workers", pool_size)
+            _POOL = multiprocessing.Pool(pool_size, initializer=_worker_initialize)
+        return _POOL
+
+def get_pool_size():
+    """
+    :return: Number of worker processes in the shared pool
+    """
+    if POOL_SIZE:
+        return POOL_SIZE
+    else:
+        return multiprocessing.cpu_count()
+
+def get_manager():
+    """
+    Get the shared multiprocessing manager, creating it if required
+
+    This is used to create queues and other objects which need to be shared with
+    the worker pool. Creating a manager starts a server process so we keep one
+    for the lifetime of the application.
+    """
+    global _MANAGER
+    if _MANAGER is None:
+        _MANAGER = multiprocessing.Manager()
+    return _MANAGER
+
+def set_pool_size(pool_size):
+    """
+    Set the number of worker processes in the shared pool
+
+    If a pool already exists with a different size it is replaced - any processes
+    using it will be allowed to finish - and a new pool will be created when 
+    next required.
+
+    :param pool_size: Number of workers. If None or zero, use one worker per CPU
+    """
+    global POOL_SIZE
+    if pool_size != POOL_SIZE:
+        POOL_SIZE = pool_size
+        _retire_pool(_POOL)
+
+def shutdown_pool():
+    """
+    Terminate the shared worker pool and manager
+
+    This is called automatically on exit but may be called at any time. A new
+    pool will be created if another background process is started.
+    """
+    global _POOL, _MANAGER
+    with _POOL_LOCK:
+        for pool in set(list(_POOL_USERS.keys()) + [_POOL]):
+            if pool is not None:
+                pool.terminate()
+        _POOL = None
+        _POOL_USERS.clear()
+    if _MANAGER is not None:
+        _MANAGER.shutdown()
+        _MANAGER = None
+
+def _acquire_pool():
+    """
+    Get the shared pool for use by a process. It will not be terminated until
+    released, even if it is replaced by a new pool
+    """
+    with _POOL_LOCK:
+        pool = get_pool()
+        _POOL_USERS[pool] = _POOL_USERS.get(pool, 0) + 1
+        return pool
+
+def _release_pool(pool):
+    """
+    Release a pool obtained from ``_acquire_pool``, terminating it if it has been
+    replaced and is no longer in use
+    """
+    with _POOL_LOCK:
+        users = _POOL_USERS.pop(pool, 0) - 1
+        if users > 0:
+            _POOL_USERS[pool] = users
+        elif pool is not _POOL:
+            LOG.debug("Terminating replaced worker pool")
+            pool.terminate()
+
+def _retire_pool(pool):
+    """
+    Stop using a pool for new processes. It is terminated once it is no longer in use
+    """
+    global _POOL
+    with _POOL_LOCK:
+        if pool is None:
+            return
+        if pool is _POOL:
+            _POOL = None
+        if pool not in _POOL_USERS:
+            pool.terminate()
+
+atexit.register(shutdown_pool)
+
+class WorkerQueue(object):
+    """
+    Progress queue passed to worker functions
+
+    This wraps the real queue and checks the process cancellation flag whenever
+    progress is reported. If the process has been cancelled, ``put`` raises an 
+    exception so workers which report progress stop without needing any special
+    handling. Workers which do not report progress regularly may call ``cancelled()``
+    to check the flag themselves. 
+    
+    Workers which do neither will be terminated once ``CANCEL_GRACE_PERIOD`` has expired.
+    """
+    def __init__(self, queue, cancel_event):
+        self._queue = queue
+        self._cancel_event = cancel_event
+
+    def cancelled(self):
+        """
+        :return: True if the process has been cancelled or has failed
+        """
+        return self._cancel_event is not None and self._cancel_event.is_set()
+
+    def put(self, *args, **kwargs):
+        """
+        Put an item on the queue
+
+        :raise QpException: if the process has been cancelled
+        """
+        if self.cancelled():
+            raise QpException("Process was cancelled")
+        self._queue.put(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self._queue, name)
+
+class _TaskControl(object):
+    """
+    Objects shared between a process and its workers to support cancellation
+
+    :ivar cancel_event: Event which is set when the process is cancelled
+    :ivar worker_pids: Dictionary of task ID to the PID of the worker running it, or None
+                       if workers are not run in separate processes
+    :ivar lock: Lock which must be held when modifying ``worker_pids``
+    :ivar shared_tag: Tag used to name shared data files created for the process
+    """
+    def __init__(self, cancel_event, worker_pids=None, lock=None, shared_tag=None):
+        self.cancel_event = cancel_event
+        self.worker_pids = worker_pids
+        self.lock = lock
+        self.shared_tag = shared_tag
+
+def _run_worker(worker_fn, control, worker_id, queue, *args):
+    """
+    Run a worker function, supporting cancellation
+
+    The worker's PID is recorded while it is running its task so it can be terminated
+    if it does not respond to cancellation. The record is removed under the lock before
+    the worker moves on, so a recorded worker is always still running this task.
+    
+    When running in a separate process (``worker_pids`` is not None), 
+    arguments passed as shared memory are mapped before calling the worker 
+    function and large output data is returned via shared memory.
+    """
+    multiproc = control.worker_pids is not None
+    if multiproc:
+        with control.lock:
+            control.worker_pids[worker_id] = os.getpid()
+    try:
+        if control.cancel_event.is_set():
+            # Cancelled before the worker started - no need to run it at all
+            return worker_id, False, QpException("Process was cancelled")
+
+        result = worker_fn(worker_id, WorkerQueue(queue, control.cancel_event), *resolve(args))
+        if multiproc:
+            worker_id, success, output = result
+            if success:
+                result = worker_id, success, share(output, [], tag=control.shared_tag)
+        return result
+    finally:
+        if multiproc:
+            with control.lock:
+                control.worker_pids.pop(worker_id, None)
+
+def _terminate_workers(control, pool):
+    """
+    Terminate worker processes which are still running tasks of a cancelled process
+
+    Only workers still recorded against one of the process's tasks are terminated.
+    The lock is held while doing this, so they cannot move on to another task in
+    the meantime. If any are terminated, the pool is replaced since a terminated 
+    worker's task will never complete. Shared data files created for the process
+    are then removed, including any output of the terminated workers.
+    """
+    terminated = False
+    try:
+        with control.lock:
+            for worker_id in list(control.worker_pids.keys()):
+                pid = control.worker_pids.pop(worker_id, None)
+                if pid is not None and pid != os.getpid():
+                    LOG.debug("Terminating worker %i (pid %i)", worker_id, pid)
+                    os.kill(pid, signal.SIGTERM)
+                    terminated = True
+    except Exception:
+        # The manager may have been shut down, e.g. on exit
+        LOG.debug("Failed to terminate workers", exc_info=True)
+
+    if terminated:
+        _retire_pool(pool)
+    remove_shared(control.shared_tag)
+
 class Process(QtCore.QObject, LogSource):
     """
     A data processing task
@@ -87,6 +334,10 @@ class Process(QtCore.QObject, LogSource):
     second during execution. Typically this is used to monitor the workers and emit
     ``sig_progress``.
 
+    Workers are run in a pool of processes which is shared between all background processes
+    and created when first required (see ``get_pool()``). The size of the pool is set
+    by ``POOL_SIZE`` and can be changed using ``set_pool_size()``.
+
     ``sig_finished`` is always emitted when a process completes, whether synchronously or
     asynchronously. ``sig_progress`` is always emitted with a value of 1 when a process completes 
     successfully.
@@ -142,7 +393,9 @@ class Process(QtCore.QObject, LogSource):
                           It should return ``id``, True/False ``success`` and
                           an output object. If ``success=False`` the output
                           object should be an exception. Otherwise it can
-                          be any pickleable object (e.g. Numpy array)
+                          be any pickleable object (e.g. Numpy array). The
+                          queue is a ``WorkerQueue`` which raises an exception
+                          if the process is cancelled.
         """
         QtCore.QObject.__init__(self)
         LogSource.__init__(self)
@@ -166,6 +419,14 @@ class Process(QtCore.QObject, LogSource):
         self._pool = None
         self._worker_output = []
         self._queue = None
+        self._control = None
+        self._shared_tag = None
+        self._shared = []
+        self._worker_args = []
+        self._pending = collections.deque()
+        self._pending_lock = threading.Lock()
+        self._done_event = None
+        self._task_mode = False
 
     def execute(self, options):
         """
@@ -331,79 +592,149 @@ class Process(QtCore.QObject, LogSource):
         """
         return []
 
-    def start_bg(self, args, n_workers=1):
+    def start_bg(self, args, n_workers=1, n_chunks=None):
         """
         Start a set of background workers
         
         This would normally called by ``run()`` after setting up the arguments to pass to the 
         worker run function.
 
+        By default the arguments are split into ``n_workers`` chunks, one for each worker.
+        If ``n_chunks`` is given, the arguments are split into this number of chunks instead.
+        Chunks are queued and handed to workers as they become free, so no more than 
+        ``n_workers`` run at the same time, and ``sig_progress`` is emitted as each chunk
+        completes. Using more chunks than workers helps keep all the workers busy when 
+        the amount of work varies between chunks.
+
         :param args: Sequence of arguments to the worker run function. All must be pickleable objects
+        :param n_workers: Maximum number of workers to run at the same time. These are run on the 
+                          shared worker pool so may not all run in parallel if there are more
+                          workers than processes in the pool
+        :param n_chunks: Number of chunks to split the arguments into. If not specified, 
+                         one chunk per worker
         """
         # Only for background processes
         self._pool, self._queue = self._init_multiproc(n_workers)
+
+        self._task_mode = n_chunks is not None
+        if n_chunks is None:
+            n_chunks = n_workers
         
-        worker_args = self.split_args(n_workers, args)
-        self._worker_output = [None, ] * n_workers
+        worker_args = self.split_args(n_chunks, args)
+        self._worker_output = [None, ] * n_chunks
         self.status = Process.RUNNING
 
         if self._multiproc:
-            self._workers = []
-            for i in range(n_workers):
-                self.debug("Starting task %i/%s...", i+1, n_workers)
-                proc = self._pool.apply_async(self._worker_fn, worker_args[i], callback=self._worker_finished_cb)
-                self._workers.append(proc)
+            # Large data arguments are passed to the workers using shared memory
+            # rather than pickling. Memo ensures arguments passed to every worker
+            # are only published once
+            memo = {}
+            self._worker_args = [share(wargs, self._shared, memo, tag=self._get_shared_tag()) for wargs in worker_args]
+            self._workers = [None, ] * n_chunks
+            self._pending = collections.deque(range(n_chunks))
+            self._done_event = threading.Event()
+            for _ in range(min(n_workers, n_chunks)):
+                self._submit_next()
             
             if self._sync:
                 self.debug("Running background task synchronously")
-                for i in range(n_workers):
-                    self._workers[i].get()
+                while not self._done_event.wait(0.1):
+                    for worker in self._workers[:]:
+                        if worker is not None and worker.ready() and not worker.successful():
+                            # Re-raise the exception from a worker which failed to run
+                            worker.get()
             else:
                 self._restart_timer()
         else:
-            for i in range(n_workers):
-                result = self._worker_fn(*worker_args[i])
+            for i in range(n_chunks):
+                result = _run_worker(self._worker_fn, self._control, *worker_args[i])
                 self.timeout(self._queue)
-                if QtGui.qApp is not None: QtGui.qApp.processEvents()
+                if QtCore.QCoreApplication.instance() is not None: QtCore.QCoreApplication.instance().processEvents()
                 self._worker_finished_cb(result)
                 if self.status != Process.RUNNING: 
                     break
 
+    def _submit_next(self):
+        """
+        Submit the next pending chunk to the worker pool, if there is one
+        """
+        with self._pending_lock:
+            if not self._pending or self.status != Process.RUNNING:
+                return
+            task_id = self._pending.popleft()
+            run_args = [self._worker_fn, self._control] + list(self._worker_args[task_id])
+            # Release our reference to the arguments as the pool now has them
+            self._worker_args[task_id] = None
+
+        self.debug("Starting task %i/%i...", task_id+1, len(self._workers))
+        self._workers[task_id] = self._pool.apply_async(_run_worker, run_args, callback=self._worker_finished_cb)
+
+    def _split_bounds(self, n_chunks, length):
+        """
+        :return: Sequence of (start, end) indices along ``SPLIT_AXIS`` for each chunk
+        """
+        # Same chunk boundaries as np.array_split
+        bounds = []
+        for chunk in np.array_split(np.arange(length), n_chunks):
+            start = chunk[0] if len(chunk) > 0 else (bounds[-1][1] if bounds else 0)
+            bounds.append((start, start + len(chunk)))
+        return bounds
+
     def _init_multiproc(self, num_tasks):
         if self._multiproc:
-            LOG.debug("Initializing multiprocessing")
-            queue = multiprocessing.Manager().Queue()
-            pool_size = min(num_tasks, multiprocessing.cpu_count())
-            pool = multiprocessing.Pool(pool_size, initializer=_worker_initialize)
+            LOG.debug("Initializing multiprocessing for %i tasks", num_tasks)
+            manager = get_manager()
+            queue = manager.Queue()
+            self._control = _TaskControl(manager.Event(), manager.dict(), manager.Lock(), self._get_shared_tag())
+            pool = _acquire_pool()
         else:
             LOG.debug("Not using multiprocessing")
             queue = singleproc_queue.Queue()
+            self._control = _TaskControl(threading.Event())
             pool = None
         return pool, queue
 
     def cancel(self):
         """
         Cancel all workers. The status will be CANCELLED unless it is already complete
+
+        Workers are signalled to stop (see ``WorkerQueue``). Any which are still running
+        after ``CANCEL_GRACE_PERIOD`` seconds are terminated.
         """
         if self.status == Process.RUNNING:
             self.status = Process.CANCELLED
             self.exception = Exception("Process was cancelled")
-            if self._multiproc:
-                # FIXME this does not work. Not incredibly harmful because
-                # with status set to CANCELLED results are ignored anyway.
-                # But workers will continue to work. Maybe look into
-                # abortable_worker solution?
-                pass
-                #for p in self._workers:
-                #    p.terminate()
-                #    p.join(timeout=1.0)
-            else:
-                # Just setting the status is enough - no more workers
-                # will be started
-                pass
+            self._stop_workers()
 
         self._complete()
 
+    def _stop_workers(self):
+        """
+        Signal all workers to stop, and terminate any which do not stop within
+        the grace period
+        """
+        with self._pending_lock:
+            self._pending.clear()
+
+        if self._control is not None:
+            self._control.cancel_event.set()
+
+        if self._done_event is not None:
+            self._done_event.set()
+
+        # Data shared with the workers is no longer required. On POSIX systems
+        # workers which have already mapped it can continue to use it
+        for shared in self._shared:
+            shared.unlink()
+        self._shared = []
+
+        if self._multiproc and self._control is not None and self._control.worker_pids is not None:
+            # Note that we pass the control objects rather than using the attribute
+            # as references to workers are removed when the process completes
+            timer = threading.Timer(CANCEL_GRACE_PERIOD, _terminate_workers, args=(self._control, self._pool))
+            timer.daemon = True
+            timer.start()
+
     def timeout(self, queue):
         """
         Called every 1s while the process is running. 
@@ -440,21 +771,51 @@ class Process(QtCore.QObject, LogSource):
         
         :param args: Sequence of arguments to the worker run function. All must be pickleable objects.
                      By default Numpy arrays will be split along SPLIT_AXIS and a chunk passed to each
-                     worker.
+                     worker. Shared output arrays created by ``alloc_shared`` are split in the same way
+                     so each worker can write its output directly into the corresponding chunk.
         :param n_workers: Number of parallel worker processes to use
         """
         # First argument is worker ID, second is queue
         split_args = [list(range(n_workers)), [self._queue,] * n_workers]
 
         for arg in args:
-            if isinstance(arg, (np.ndarray, np.generic)):
-                split_args.append(np.array_split(arg, n_workers, SPLIT_AXIS))
+            if isinstance(arg, (np.ndarray, np.generic, SharedArray)) and len(arg.shape) > SPLIT_AXIS:
+                chunks = []
+                for start, end in self._split_bounds(n_workers, arg.shape[SPLIT_AXIS]):
+                    index = [slice(None)] * len(arg.shape)
+                    index[SPLIT_AXIS] = slice(start, end)
+                    if isinstance(arg, SharedArray):
+                        chunks.append(arg.chunk(index))
+                    else:
+                        chunks.append(arg[tuple(index)])
+                split_args.append(chunks)
             else:
                 split_args.append([arg,] * n_workers)
 
         # Transpose list of lists so first element is all the arguments for process 0, etc
         return list(map(list, zip(*split_args)))
 
+    def alloc_shared(self, shape, dtype=np.float32):
+        """
+        Allocate a shared output array which workers can write to directly
+
+        The returned SharedArray can be passed as an argument to ``start_bg``. Each
+        worker receives a writable Numpy array, split in the same way as other array 
+        arguments, and any data written to it is visible to this process
+        through the SharedArray's ``array()`` or ``copy()`` method. This avoids
+        having to return large output from the workers and recombine it. 
+        
+        The shared array is removed when the process completes so ``finished()`` 
+        should take a copy of the data it requires.
+
+        :param shape: Array shape
+        :param dtype: Numpy data type
+        :return: SharedArray instance
+        """
+        shared = SharedArray.create(shape, dtype, tag=self._get_shared_tag())
+        self._shared.append(shared)
+        return shared
+
     def recombine_data(self, data_list):
         """
         Recombine a sequence of data items into a single data item
@@ -523,17 +884,33 @@ class Process(QtCore.QObject, LogSource):
                 self.exception = exc
             
         # Get rid of all references to multprocessing workers and their output
-        # this is necessary to avoid memory and process leakage
+        # this is necessary to avoid memory leakage. The pool itself is shared 
+        # so is not closed
+        for shared in self._shared:
+            shared.unlink()
+        self._shared = []
+        self._shared_tag = None
         if self._pool is not None:
-            self._pool.close()
+            _release_pool(self._pool)
         self._pool = None
         self._workers = []
         self._queue = None
+        self._control = None
+        self._worker_args = []
         self._worker_output = []
         self.debug("Emitting sig_finished")
         self.sig_finished.emit(self.status, self._log, self.exception)
         self._completed = True
 
+    def _get_shared_tag(self):
+        """
+        :return: Tag used to name shared data files for the current run of the process,
+                 so they can all be removed if it is cancelled
+        """
+        if self._shared_tag is None:
+            self._shared_tag = "%i-%i" % (os.getpid(), next(_RUN_COUNTER))
+        return self._shared_tag
+
     def _restart_timer(self):
         self._timer = threading.Timer(1, self._timer_cb)
         self._timer.daemon = True
@@ -562,25 +939,36 @@ class Process(QtCore.QObject, LogSource):
         if self.status in (Process.FAILED, Process.CANCELLED):
             # If one process has already failed or been cancelled, ignore results of others
             self.debug("Ignoring worker, process already failed or cancelled")
+            discard(output)
             return
         elif success:
-            self._workers[worker_id] = None # FIXME why? Memory leak?
+            output = retrieve(output)
+            if worker_id < len(self._workers):
+                self._workers[worker_id] = None # FIXME why? Memory leak?
             if worker_id < len(self._worker_output):
                 self._worker_output[worker_id] = output
                 if None not in self._worker_output:
                     self.status = Process.SUCCEEDED
+                elif self._task_mode:
+                    complete = len([output for output in self._worker_output if output is not None])
+                    self.sig_progress.emit(float(complete) / len(self._worker_output))
+            if self._multiproc:
+                self._submit_next()
         else:
             # If one process fails, they all fail. Output is just the first exception to be caught
-            # FIXME cancel other workers?
+            # and other workers are stopped
             # FIXME log capture is ugly - better to have 'sig_failed' callback
             self.status = Process.FAILED
             self.exception = output
+            self._stop_workers()
             if hasattr(output, "log"):
                 self.log(output.log[:MAX_LOG_SIZE])
                 if len(output.log) > MAX_LOG_SIZE:
                     self.log("WARNING: Exception log was too large - truncated at %i chars" % MAX_LOG_SIZE)
 
         if self.status != Process.RUNNING:
+            if self._done_event is not None:
+                self._done_event.set()
             # Need to use invokeMethod here because the process callback is in a 
             # different thread and the IVM (called by _complete) is not threadsafe
             self.metaObject().invokeMethod(self, "_complete", QtCore.Qt.QueuedConnection)
@@ -0,0 +1,323 @@
+"""
+Quantiphyse - Shared memory transport for background process data
+
+Arguments and results of background workers are normally pickled, which
+for large data sets means several copies of the data in memory at once.
+Instead, large Numpy arrays and data items are written once to a memory-mapped
+temporary file and only a small handle is passed between processes. Where possible
+the file is created on a RAM-backed filesystem (/dev/shm) so no disk access occurs.
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import glob
+import errno
+import tempfile
+import logging
+
+import numpy as np
+
+from quantiphyse.data import NumpyData, QpData
+
+#: Arrays smaller than this size in bytes are pickled as normal
+MIN_SHARED_SIZE = 1024*1024
+
+#: Directory for shared data files. If None, use /dev/shm if available
+#: or otherwise the system temporary directory
+SHARED_DIR = None
+
+#: Prefix of shared data file names. The prefix is followed by a tag beginning 
+#: with the ID of the process which owns the file
+SHARED_PREFIX = "qp_shared_"
+
+LOG = logging.getLogger(__name__)
+
+def _shared_dir():
+    if SHARED_DIR is not None:
+        return SHARED_DIR
+    elif os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    else:
+        return tempfile.gettempdir()
+
+def _tag(tag):
+    if tag is None:
+        tag = str(os.getpid())
+    return tag
+
+def _pid_running(pid):
+    if os.name == "nt":
+        # os.kill cannot be used to check a process on Windows, and files 
+        # which are still in use cannot be removed in any case
+        return True
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError as exc:
+        # Any other error, e.g. process owned by another user, means it exists
+        return exc.errno != errno.ESRCH
+
+def remove_shared(tag):
+    """
+    Remove all shared data files created with a tag
+
+    This is used to clean up after workers which may have been terminated before
+    their output could be retrieved or discarded.
+
+    :param tag: Tag passed when the files were created
+    """
+    for fname in glob.glob(os.path.join(_shared_dir(), "%s%s_*" % (SHARED_PREFIX, _tag(tag)))):
+        try:
+            os.remove(fname)
+        except OSError:
+            LOG.debug("Failed to remove shared data file: %s", fname)
+
+def remove_stale():
+    """
+    Remove shared data files owned by processes which are no longer running,
+    e.g. because they crashed or were killed
+    """
+    for fname in glob.glob(os.path.join(_shared_dir(), SHARED_PREFIX + "*")):
+        owner = os.path.basename(fname)[len(SHARED_PREFIX):].split("_")[0].split("-")[0]
+        try:
+            pid = int(owner)
+        except ValueError:
+            continue
+        if not _pid_running(pid):
+            LOG.debug("Removing stale shared data file: %s", fname)
+            try:
+                os.remove(fname)
+            except OSError:
+                LOG.debug("Failed to remove shared data file: %s", fname)
+
+class SharedArray(object):
+    """
+    Handle to a Numpy array stored in a memory mapped file
+
+    The handle is small and cheap to pickle. The array is obtained in any process
+    using ``array()``. A handle may refer to a sub-region of the array using
+    ``chunk()``.
+
+    :ivar fname: File containing the array data
+    :ivar shape: Shape of the full array in the file
+    :ivar dtype: Numpy data type of the array
+    :ivar index: Tuple of slices selecting the part of the array this handle refers to
+    :ivar writable: If True, changes made through ``array()`` are visible to other
+                    processes. Otherwise changes are private to the process making them
+    """
+
+    def __init__(self, fname, shape, dtype, index=None, writable=False):
+        self.fname = fname
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).str
+        self.index = index
+        self.writable = writable
+
+    @classmethod
+    def create(cls, shape, dtype, writable=True, tag=None):
+        """
+        Create a new zero-filled shared array
+
+        :param shape: Array shape
+        :param dtype: Numpy data type
+        :param writable: See class documentation
+        :param tag: Optional tag included in the file name so files can be removed
+                    together using ``remove_shared``. Must start with the ID of the 
+                    process which owns the file. If not specified, the ID of the 
+                    current process is used
+        """
+        fd, fname = tempfile.mkstemp(prefix="%s%s_" % (SHARED_PREFIX, _tag(tag)), suffix=".dat", dir=_shared_dir())
+        os.close(fd)
+        shared = cls(fname, shape, dtype, writable=writable)
+        if shared.nbytes > 0:
+            mmap = np.memmap(fname, dtype=shared.dtype, mode="w+", shape=shared.shape)
+            del mmap
+        return shared
+
+    @classmethod
+    def from_array(cls, arr, writable=False, tag=None):
+        """
+        Create a shared array containing a copy of an existing array
+
+        :param arr: Numpy array
+        :param writable: See class documentation
+        :param tag: See ``create``
+        """
+        shared = cls.create(arr.shape, arr.dtype, writable=True, tag=tag)
+        if shared.nbytes > 0:
+            mmap = np.memmap(shared.fname, dtype=shared.dtype, mode="r+", shape=shared.shape)
+            mmap[...] = arr
+            mmap.flush()
+            del mmap
+        shared.writable = writable
+        return shared
+
+    @property
+    def nbytes(self):
+        """ Size of the full array in bytes """
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+    def chunk(self, index):
+        """
+        :param index: Tuple of slices selecting part of the array
+        :return: New SharedArray handle referring to part of this array
+        """
+        if self.index is not None:
+            raise RuntimeError("Cannot take a chunk of a shared array chunk")
+        return SharedArray(self.fname, self.shape, self.dtype, index=tuple(index), writable=self.writable)
+
+    def array(self):
+        """
+        :return: Numpy memmap array referring to the shared data. Note that the
+                 file must not be unlinked while the array is in use on platforms
+                 (e.g. Windows) which do not allow this
+        """
+        if self.nbytes == 0:
+            arr = np.zeros(self.shape, dtype=self.dtype)
+        else:
+            arr = np.memmap(self.fname, dtype=self.dtype, mode="r+" if self.writable else "c", shape=self.shape)
+        if self.index is not None:
+            arr = arr[self.index]
+        return arr
+
+    def copy(self):
+        """
+        :return: In-memory copy of the shared data
+        """
+        return np.array(self.array())
+
+    def unlink(self):
+        """
+        Remove the file holding the shared data.
+
+        On POSIX systems the data remains available to processes which have
+        already mapped it.
+        """
+        try:
+            os.remove(self.fname)
+        except OSError:
+            LOG.debug("Failed to remove shared data file: %s", self.fname)
+
+class SharedNumpyData(NumpyData):
+    """
+    NumpyData whose raw data is held in a SharedArray so it can be passed to
+    other processes without copying the data
+    """
+
+    def __init__(self, qpd, shared):
+        self._shared = shared
+        self.rawdata = shared.array()
+        QpData.__init__(self, qpd.name, qpd.grid, qpd.nvols, roi=qpd.roi, metadata=qpd.metadata, view=qpd.view)
+
+    def __getstate__(self):
+        state = QpData.__getstate__(self)
+        del state["rawdata"]
+        return state
+
+    def __setstate__(self, state):
+        QpData.__setstate__(self, state)
+        self.rawdata = self._shared.array()
+
+    def copy(self):
+        """
+        :return: NumpyData instance containing an in-memory copy of the data
+        """
+        return NumpyData(self._shared.copy(), grid=self.grid, name=self.name, roi=self.roi,
+                         metadata=self.metadata, view=self.view)
+
+def share(obj, published, memo=None, tag=None):
+    """
+    Replace large Numpy arrays and data items with shared memory equivalents
+
+    Lists and tuples are searched recursively. Other objects are returned unchanged
+
+    :param obj: Object to share
+    :param published: List to which any SharedArray instances created are appended,
+                      so they can be removed when no longer required
+    :param memo: Optional dictionary used to avoid publishing the same object twice
+    :param tag: Optional tag for shared data files - see ``SharedArray.create``
+    :return: Object which can be pickled without copying large data
+    """
+    if memo is None:
+        memo = {}
+    if id(obj) in memo:
+        return memo[id(obj)]
+
+    ret = obj
+    if isinstance(obj, (list, tuple)):
+        ret = type(obj)([share(item, published, memo, tag) for item in obj])
+    elif isinstance(obj, np.ndarray) and obj.nbytes >= MIN_SHARED_SIZE:
+        ret = SharedArray.from_array(obj, tag=tag)
+        published.append(ret)
+    elif isinstance(obj, QpData) and not isinstance(obj, SharedNumpyData):
+        rawdata = obj.raw()
+        if rawdata.nbytes >= MIN_SHARED_SIZE:
+            shared = SharedArray.from_array(rawdata, tag=tag)
+            published.append(shared)
+            ret = SharedNumpyData(obj, shared)
+
+    memo[id(obj)] = ret
+    return ret
+
+def resolve(obj):
+    """
+    Replace SharedArray handles with the arrays they refer to
+
+    This is used in a worker process to obtain the data passed to it. Lists and
+    tuples are searched recursively. SharedNumpyData does not need resolving as
+    its data is mapped on unpickling.
+    """
+    if isinstance(obj, (list, tuple)):
+        return type(obj)([resolve(item) for item in obj])
+    elif isinstance(obj, SharedArray):
+        return obj.array()
+    else:
+        return obj
+
+def retrieve(obj):
+    """
+    Replace shared data with in-memory copies and remove the shared files
+
+    This is used to obtain output from a worker process. Lists and tuples are searched
+    recursively.
+    """
+    if isinstance(obj, (list, tuple)):
+        return type(obj)([retrieve(item) for item in obj])
+    elif isinstance(obj, SharedArray):
+        ret = obj.copy()
+        obj.unlink()
+        return ret
+    elif isinstance(obj, SharedNumpyData):
+        ret = obj.copy()
+        obj._shared.unlink()
+        return ret
+    else:
+        return obj
+
+def discard(obj):
+    """
+    Remove the shared files for any shared data without retrieving it
+
+    This is used when worker output is being ignored, e.g. because the
+    process has been cancelled.
+    """
+    if isinstance(obj, (list, tuple)):
+        for item in obj:
+            discard(item)
+    elif isinstance(obj, SharedArray):
+        obj.unlink()
+    elif isinstance(obj, SharedNumpyData):
+        obj._shared.unlink()
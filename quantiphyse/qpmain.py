@@ -43,6 +43,8 @@ except ImportError:
 from quantiphyse.test import run_tests
 
 from quantiphyse.utils import QpException, set_local_file_path
+from quantiphyse.processes.process import set_pool_size
+from quantiphyse.data import volume_management
 from quantiphyse.utils.batch import BatchScript
 from quantiphyse.utils.logger import set_base_log_level
 from quantiphyse.utils.local import get_icon
@@ -82,12 +84,15 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('data', help='Load data files', nargs="*", type=str)
     parser.add_argument('--batch', help='Run batch file', default=None, type=str)
+    parser.add_argument('--batch-exit-status', help='Exit with a non-zero status if the batch file fails', action="store_true")
     parser.add_argument('--debug', help='Activate debug mode', action="store_true")
     parser.add_argument('--test-all', help='Run all tests', action="store_true")
     parser.add_argument('--test', help='Specify test suite to be run (default=run all)', default=None)
     parser.add_argument('--test-fast', help='Run only fast tests', action="store_true")
     parser.add_argument('--qv', help='Activate quick-view mode', action="store_true")
     parser.add_argument('--register', help='Force display of registration dialog', action="store_true")
+    parser.add_argument('--workers', help='Number of background worker processes (default=number of CPUs)', default=None, type=int)
+    parser.add_argument('--memory-limit', help='Memory in Mb to use for holding data before unused data is removed from memory (default=no limit)', default=None, type=int)
     args = parser.parse_args()
 
     # Apply global options
@@ -99,6 +104,13 @@ def main():
     # Set the local file path, used for finding icons, plugins, etc
     set_local_file_path()
 
+    # Size of the shared pool used by background processes
+    set_pool_size(args.workers)
+
+    # Memory budget for data
+    if args.memory_limit is not None:
+        volume_management.MEMORY_BUDGET = args.memory_limit * 1024 * 1024
+
     # Handle CTRL-C correctly
     signal.signal(signal.SIGINT, signal.SIG_DFL)
 
@@ -106,7 +118,7 @@ def main():
         # Batch runs need a QCoreApplication to avoid initializing the GUI - this
         # would fail when running on a displayless system 
         app = QtCore.QCoreApplication(sys.argv)
-        runner = BatchScript()
+        runner = BatchScript(exit_status=args.batch_exit_status)
         # Add delay to make sure script is run after the main loop starts, in case
         # batch script is completely synchronous
         QtCore.QTimer.singleShot(200, lambda: runner.execute({"yaml-file" : args.batch}))
@@ -0,0 +1,119 @@
+"""
+Quantiphyse - tests for batch scripts
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import sys
+import time
+
+try:
+    from PySide import QtCore
+except ImportError:
+    from PySide2 import QtCore
+
+from quantiphyse.utils.batch import Script
+from quantiphyse.test import ProcessTest
+
+TIMEOUT = 120
+
+class BatchScriptTest(ProcessTest):
+
+    def setUp(self):
+        if QtCore.QCoreApplication.instance() is None:
+            self.app = QtCore.QCoreApplication([])
+        ProcessTest.setUp(self)
+
+    def _run_cases(self, parallel, case_ids, failing_cases=()):
+        yaml = """
+OutputFolder: %s
+InputFolder: %s
+Parallel: %i
+
+Processing:
+  - Load:
+        data:
+            data_3d.nii.gz:
+  - Save:
+        data_3d: saved_data
+
+Cases:
+""" % (self.output_dir, self.input_dir, parallel)
+        for case_id in case_ids:
+            yaml += "  - %s:\n" % case_id
+            if case_id in failing_cases:
+                yaml += "      Load:\n        data:\n          missing_data.nii.gz:\n"
+
+        script = Script()
+        started, done = [], []
+        script.sig_start_case.connect(lambda case: started.append(case.case_id))
+        script.sig_done_case.connect(lambda case: done.append(case.case_id))
+        script.sig_finished.connect(self._script_finished)
+        script.execute({"yaml" : yaml})
+        start = time.time()
+        while script.status == Script.RUNNING:
+            self.processEvents()
+            time.sleep(0.1)
+            if time.time() - start > TIMEOUT:
+                script.cancel()
+                self.fail("Batch script timed out")
+        return script, started, done
+
+    def testSerial(self):
+        case_ids = ["case1", "case2"]
+        script, started, done = self._run_cases(1, case_ids)
+        self.assertEqual(self.status, Script.SUCCEEDED)
+        self.assertEqual(started, case_ids)
+        self.assertEqual(done, case_ids)
+        for case_id in case_ids:
+            self.assertTrue(os.path.exists(os.path.join(self.output_dir, case_id, "saved_data.nii")))
+
+    def testParallel(self):
+        case_ids = ["case1", "case2", "case3"]
+        script, started, done = self._run_cases(2, case_ids)
+        self.assertEqual(self.status, Script.SUCCEEDED)
+        self.assertEqual(sorted(started), case_ids)
+        self.assertEqual(sorted(done), case_ids)
+        for case in script._cases:
+            self.assertTrue("Processing case: %s" % case.case_id in case.output)
+            self.assertTrue(os.path.exists(os.path.join(self.output_dir, case.case_id, "saved_data.nii")))
+
+    def testSerialFailure(self):
+        case_ids = ["case1", "case2"]
+        script, started, done = self._run_cases(1, case_ids, failing_cases=["case1"])
+        self.assertEqual(done, case_ids)
+        self.assertEqual(script.failed_cases, ["case1"])
+
+    def testParallelFailure(self):
+        case_ids = ["case1", "case2", "case3"]
+        script, started, done = self._run_cases(2, case_ids, failing_cases=["case2"])
+        self.assertEqual(self.status, Script.SUCCEEDED)
+        self.assertEqual(sorted(done), case_ids)
+        self.assertEqual(script.failed_cases, ["case2"])
+        self.assertTrue("CASE FAILED" in script.get_log())
+
+    def testParallelFailedToStart(self):
+        executable = sys.executable
+        sys.executable = os.path.join(self.output_dir, "does_not_exist")
+        try:
+            case_ids = ["case1", "case2", "case3"]
+            script, started, done = self._run_cases(2, case_ids)
+        finally:
+            sys.executable = executable
+        # Every case is completed, as a failure
+        self.assertEqual(self.status, Script.SUCCEEDED)
+        self.assertEqual(sorted(done), case_ids)
+        self.assertEqual(sorted(script.failed_cases), case_ids)
@@ -0,0 +1,321 @@
+"""
+Quantiphyse - tests for background processes using the shared worker pool
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import os
+import glob
+import time
+import subprocess
+import sys
+import unittest
+
+import numpy as np
+
+try:
+    from PySide import QtCore
+except ImportError:
+    from PySide2 import QtCore
+
+from quantiphyse.data import ImageVolumeManagement, NumpyData, DataGrid
+from quantiphyse.processes import Process
+from quantiphyse.processes import process as process_module
+from quantiphyse.processes import shared
+
+NWORKERS = 3
+TIMEOUT = 30
+
+def _double_worker(worker_id, queue, data):
+    """ Worker function which doubles its input and reports the worker PID """
+    queue.put(1)
+    return worker_id, True, (data * 2, os.getpid())
+
+def _slow_worker(worker_id, queue, data, pids, cooperative):
+    """ 
+    Worker function which runs until cancelled. If ``cooperative`` it
+    reports progress regularly, otherwise it ignores cancellation
+    """
+    pids[worker_id] = os.getpid()
+    try:
+        while True:
+            time.sleep(0.1)
+            if cooperative:
+                queue.put(0.5)
+    except Exception as exc:
+        pids.pop(worker_id)
+        return worker_id, False, exc
+
+def _fail_worker(worker_id, queue, data, pids, cooperative):
+    """ Worker function which fails immediately on the first worker only """
+    if worker_id == 0:
+        return worker_id, False, RuntimeError("Worker failed")
+    else:
+        return _slow_worker(worker_id, queue, data, pids, cooperative)
+
+def _qpdata_worker(worker_id, queue, qpd, output):
+    """ 
+    Worker function which doubles a QpData, writing the output directly to a 
+    shared array, and also returning it as a new QpData
+    """
+    output[...] = qpd.raw() * 2
+    return worker_id, True, (isinstance(qpd.raw(), np.memmap), NumpyData(qpd.raw() * 2, grid=qpd.grid, name="doubled"))
+
+class DoubleProcess(Process):
+    """ Simple background process which doubles its input data """
+
+    def __init__(self, ivm, **kwargs):
+        Process.__init__(self, ivm, worker_fn=_double_worker, **kwargs)
+        self.output = None
+        self.pids = set()
+
+    def run(self, options):
+        self.start_bg([options.pop("data")], n_workers=options.pop("n-workers", NWORKERS), 
+                      n_chunks=options.pop("n-chunks", None))
+
+    def finished(self, worker_output):
+        if self.status == Process.SUCCEEDED:
+            self.output = self.recombine_data([output[0] for output in worker_output])
+            self.pids = set([output[1] for output in worker_output])
+
+class SharedProcess(Process):
+    """ Background process which passes data to the worker using shared memory """
+
+    def __init__(self, ivm, **kwargs):
+        Process.__init__(self, ivm, worker_fn=_qpdata_worker, **kwargs)
+        self.output = None
+
+    def run(self, options):
+        qpd = options.pop("data")
+        self._shared_output = self.alloc_shared(qpd.raw().shape)
+        self.start_bg([qpd, self._shared_output], n_workers=1)
+
+    def finished(self, worker_output):
+        if self.status == Process.SUCCEEDED:
+            self.mapped, self.output = worker_output[0]
+            self.shared_output = self._shared_output.copy()
+
+class SlowProcess(Process):
+    """ Background process which does not finish until it is cancelled """
+
+    def __init__(self, ivm, worker_fn=_slow_worker, **kwargs):
+        Process.__init__(self, ivm, worker_fn=worker_fn, **kwargs)
+        self.pids = process_module.get_manager().dict()
+
+    def run(self, options):
+        self.start_bg([options.pop("data"), self.pids, options.pop("cooperative", True)], n_workers=NWORKERS)
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+class BackgroundProcessTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # Make sure all workers can run at once regardless of the number of CPUs
+        cls.pool_size = process_module.POOL_SIZE
+        process_module.set_pool_size(NWORKERS)
+
+    @classmethod
+    def tearDownClass(cls):
+        process_module.set_pool_size(cls.pool_size)
+
+    def setUp(self):
+        if QtCore.QCoreApplication.instance() is None:
+            self.app = QtCore.QCoreApplication([])
+        self.ivm = ImageVolumeManagement()
+        self.data = np.random.rand(10, 10, 10)
+
+    def _wait(self, condition):
+        start = time.time()
+        while not condition():
+            QtCore.QCoreApplication.instance().processEvents()
+            time.sleep(0.05)
+            if time.time() - start > TIMEOUT:
+                self.fail("Timed out waiting for workers")
+
+    def _run(self, process, options):
+        process.execute(options)
+        start = time.time()
+        while not process._completed:
+            QtCore.QCoreApplication.instance().processEvents()
+            time.sleep(0.05)
+            if time.time() - start > TIMEOUT:
+                self.fail("Background process timed out")
+
+    def testOutput(self):
+        process = DoubleProcess(self.ivm)
+        self._run(process, {"data" : self.data})
+        self.assertEqual(process.status, Process.SUCCEEDED)
+        self.assertTrue(np.allclose(process.output, self.data * 2))
+
+    def testPoolReused(self):
+        pool = process_module.get_pool()
+        process = DoubleProcess(self.ivm)
+        self._run(process, {"data" : self.data})
+        self.assertTrue(process_module.get_pool() is pool)
+
+        process2 = DoubleProcess(self.ivm)
+        self._run(process2, {"data" : self.data})
+        self.assertEqual(process2.status, Process.SUCCEEDED)
+        self.assertTrue(process_module.get_pool() is pool)
+
+    def testMoreTasksThanWorkers(self):
+        process = DoubleProcess(self.ivm)
+        n_tasks = NWORKERS + 2
+        self._run(process, {"data" : self.data, "n-workers" : n_tasks})
+        self.assertEqual(process.status, Process.SUCCEEDED)
+        self.assertTrue(np.allclose(process.output, self.data * 2))
+
+    def testNoMultiproc(self):
+        process = DoubleProcess(self.ivm, multiproc=False)
+        self._run(process, {"data" : self.data})
+        self.assertEqual(process.status, Process.SUCCEEDED)
+        self.assertTrue(np.allclose(process.output, self.data * 2))
+        self.assertEqual(process.pids, set([os.getpid()]))
+
+    def testChunks(self):
+        progress = []
+        process = DoubleProcess(self.ivm)
+        process.sig_progress.connect(progress.append)
+        self._run(process, {"data" : self.data, "n-chunks" : 8})
+        self.assertEqual(process.status, Process.SUCCEEDED)
+        self.assertTrue(np.allclose(process.output, self.data * 2))
+        # Progress emitted as chunks complete, including 1 at the end
+        self.assertTrue(len(progress) > 1)
+        self.assertEqual(progress[-1], 1)
+
+    def testSync(self):
+        process = DoubleProcess(self.ivm, sync=True)
+        process.execute({"data" : self.data, "n-chunks" : 5})
+        # All workers have finished when execute returns
+        self.assertNotEqual(process.status, Process.RUNNING)
+        self._wait(lambda: process._completed)
+        self.assertEqual(process.status, Process.SUCCEEDED)
+        self.assertTrue(np.allclose(process.output, self.data * 2))
+
+    def testSharedData(self):
+        grid = DataGrid([64, 64, 64], np.identity(4))
+        data = np.random.rand(64, 64, 64).astype(np.float32)
+        self.assertTrue(data.nbytes >= shared.MIN_SHARED_SIZE)
+        process = SharedProcess(self.ivm)
+        self._run(process, {"data" : NumpyData(data, grid=grid, name="data")})
+        self.assertEqual(process.status, Process.SUCCEEDED)
+        self.assertTrue(process.mapped)
+        self.assertFalse(isinstance(process.output, shared.SharedNumpyData))
+        self.assertTrue(np.allclose(process.output.raw(), data * 2))
+        self.assertTrue(np.allclose(process.shared_output, data * 2))
+        self.assertEqual(process._shared, [])
+
+    def testSharedSplit(self):
+        data = np.random.rand(100, 64, 64)
+        self.assertTrue(data.nbytes >= shared.MIN_SHARED_SIZE)
+        process = DoubleProcess(self.ivm)
+        self._run(process, {"data" : data})
+        self.assertEqual(process.status, Process.SUCCEEDED)
+        self.assertTrue(np.allclose(process.output, data * 2))
+
+    def testCancelCooperative(self):
+        process = SlowProcess(self.ivm)
+        process.execute({"data" : self.data})
+        self._wait(lambda: len(process.pids) == NWORKERS)
+        process.cancel()
+        self.assertEqual(process.status, Process.CANCELLED)
+        # Workers should notice the cancellation and return
+        self._wait(lambda: len(process.pids) == 0)
+
+    def testCancelTerminate(self):
+        grace = process_module.CANCEL_GRACE_PERIOD
+        process_module.CANCEL_GRACE_PERIOD = 0.5
+        try:
+            pool = process_module.get_pool()
+            process = SlowProcess(self.ivm)
+            process.execute({"data" : self.data, "cooperative" : False})
+            self._wait(lambda: len(process.pids) == NWORKERS)
+            pids = list(process.pids.values())
+            process.cancel()
+            self.assertEqual(process.status, Process.CANCELLED)
+            # Workers ignore the cancellation so should be terminated
+            self._wait(lambda: not any([_pid_exists(pid) for pid in pids]))
+        finally:
+            process_module.CANCEL_GRACE_PERIOD = grace
+
+        # Pool is replaced, and the new pool is usable
+        self._wait(lambda: process_module.get_pool() is not pool)
+        process = DoubleProcess(self.ivm)
+        self._run(process, {"data" : self.data})
+        self.assertEqual(process.status, Process.SUCCEEDED)
+
+    def testTerminateRecordedOnly(self):
+        # Workers which have finished the cancelled task are not recorded against it
+        control = process_module._TaskControl(process_module.get_manager().Event(), 
+                                              process_module.get_manager().dict(),
+                                              process_module.get_manager().Lock())
+        process_module._run_worker(_double_worker, control, 0, process_module.get_manager().Queue(), self.data)
+        self.assertEqual(len(control.worker_pids), 0)
+
+        # A recorded worker is terminated and the pool in use is replaced
+        proc = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(60)"])
+        try:
+            pool = process_module.get_pool()
+            control.worker_pids[0] = proc.pid
+            process_module._terminate_workers(control, pool)
+            self.assertTrue(proc.wait(TIMEOUT) != 0)
+            self.assertFalse(process_module.get_pool() is pool)
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+
+    def testSharedRemovedOnCancel(self):
+        grace = process_module.CANCEL_GRACE_PERIOD
+        process_module.CANCEL_GRACE_PERIOD = 0.5
+        try:
+            data = np.random.rand(100, 64, 64)
+            process = SlowProcess(self.ivm)
+            process.execute({"data" : data, "cooperative" : False})
+            self._wait(lambda: len(process.pids) == NWORKERS)
+            tag = process._shared_tag
+            files = glob.glob(os.path.join(shared._shared_dir(), "%s%s_*" % (shared.SHARED_PREFIX, tag)))
+            self.assertTrue(len(files) > 0)
+            process.cancel()
+            self._wait(lambda: not any([os.path.exists(fname) for fname in files]))
+        finally:
+            process_module.CANCEL_GRACE_PERIOD = grace
+
+    def testRemoveStale(self):
+        proc = subprocess.Popen([sys.executable, "-c", "pass"])
+        proc.wait()
+        stale = shared.SharedArray.create((10,), np.float32, tag="%i-0" % proc.pid)
+        current = shared.SharedArray.create((10,), np.float32)
+        try:
+            shared.remove_stale()
+            self.assertFalse(os.path.exists(stale.fname))
+            self.assertTrue(os.path.exists(current.fname))
+        finally:
+            current.unlink()
+
+    def testFailureStopsWorkers(self):
+        process = SlowProcess(self.ivm, worker_fn=_fail_worker)
+        self._run(process, {"data" : self.data})
+        self.assertEqual(process.status, Process.FAILED)
+        # Remaining workers should be stopped
+        self._wait(lambda: len(process.pids) == 0)
+
+if __name__ == '__main__':
+    unittest.main()
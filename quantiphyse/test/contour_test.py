@@ -0,0 +1,74 @@
+"""
+Quantiphyse - tests for ROI contour extraction
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import unittest
+
+import numpy as np
+
+# Data package must be imported before GUI modules
+import quantiphyse.data
+from quantiphyse.gui.viewer.slice_viewer import label_boundaries
+
+def _segments(boundary):
+    """ Set of line segments, each a pair of end points in either order """
+    xdata, ydata = boundary
+    points = list(zip(xdata, ydata))
+    return set([frozenset(points[idx:idx+2]) for idx in range(0, len(points), 2)])
+
+def _square(x, y, size=1):
+    """ Segments around a square region of pixels """
+    corners = [(x, y), (x+size, y), (x+size, y+size), (x, y+size)]
+    segments = set()
+    for idx, start in enumerate(corners):
+        end = corners[(idx+1) % 4]
+        for step in range(size):
+            frac1, frac2 = float(step)/size, float(step+1)/size
+            segments.add(frozenset([
+                (start[0] + (end[0]-start[0])*frac1, start[1] + (end[1]-start[1])*frac1),
+                (start[0] + (end[0]-start[0])*frac2, start[1] + (end[1]-start[1])*frac2),
+            ]))
+    return segments
+
+class LabelBoundariesTest(unittest.TestCase):
+
+    def testEmpty(self):
+        self.assertEqual(label_boundaries(np.zeros((5, 5), dtype=np.int32)), {})
+
+    def testSinglePixel(self):
+        labels = np.zeros((5, 5), dtype=np.int32)
+        labels[2, 3] = 4
+        boundaries = label_boundaries(labels)
+        self.assertEqual(list(boundaries.keys()), [4])
+        self.assertEqual(_segments(boundaries[4]), _square(2, 3))
+
+    def testAdjacentRegions(self):
+        labels = np.zeros((6, 6), dtype=np.int32)
+        labels[1:3, 1:3] = 1
+        labels[3:5, 1:3] = 2
+        boundaries = label_boundaries(labels)
+        self.assertEqual(sorted(boundaries.keys()), [1, 2])
+        self.assertEqual(_segments(boundaries[1]), _square(1, 1, 2))
+        self.assertEqual(_segments(boundaries[2]), _square(3, 1, 2))
+
+    def testEdgeOfSlice(self):
+        labels = np.ones((3, 3), dtype=np.int32)
+        boundaries = label_boundaries(labels)
+        self.assertEqual(_segments(boundaries[1]), _square(0, 0, 3))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+"""
+Quantiphyse - tests for cached data histograms
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import unittest
+
+import numpy as np
+
+# Data package must be imported before GUI modules
+from quantiphyse.data import NumpyData, DataGrid
+from quantiphyse.gui.viewer import histogram_widget
+from quantiphyse.gui.viewer.histogram_widget import histogram_bins, volume_histogram
+
+GRIDSIZE = 10
+NVOLS = 3
+
+class VolumeHistogramTest(unittest.TestCase):
+
+    def setUp(self):
+        self.grid = DataGrid([GRIDSIZE, GRIDSIZE, GRIDSIZE], np.identity(4))
+        self.data = np.random.rand(GRIDSIZE, GRIDSIZE, GRIDSIZE, NVOLS)
+        self.data[0, 0, 0, 0] = np.nan
+        self.qpdata = NumpyData(self.data, grid=self.grid, name="data")
+
+    def testBins(self):
+        edges = histogram_bins(self.qpdata)
+        self.assertEqual(len(edges), histogram_widget.HIST_BINS + 1)
+        self.assertAlmostEqual(edges[0], np.nanmin(self.data))
+        self.assertAlmostEqual(edges[-1], np.nanmax(self.data))
+
+    def testIntBins(self):
+        qpdata = NumpyData(np.random.randint(-3, 7, (GRIDSIZE, GRIDSIZE, GRIDSIZE)), grid=self.grid, name="int")
+        edges = histogram_bins(qpdata)
+        self.assertEqual(list(edges), list(np.arange(-3.5, 7)))
+        _, counts = volume_histogram(qpdata, 0)
+        self.assertEqual(list(counts), list(np.bincount(qpdata.raw().ravel() + 3, minlength=10)))
+
+    def testVolume(self):
+        for vol in range(NVOLS):
+            edges, counts = volume_histogram(self.qpdata, vol)
+            voldata = self.qpdata.volume(vol)
+            expected, _ = np.histogram(voldata[np.isfinite(voldata)], bins=edges)
+            self.assertEqual(list(counts), list(expected))
+
+    def testCached(self):
+        hist = volume_histogram(self.qpdata, 1)
+        self.assertTrue(volume_histogram(self.qpdata, 1) is hist)
+
+        # Modifying the data changes its version so the histogram is recalculated
+        self.qpdata.raw()[..., 1] = 0.5
+        self.qpdata.clear_cache()
+        edges, counts = volume_histogram(self.qpdata, 1)
+        self.assertEqual(np.sum(counts), GRIDSIZE**3)
+        self.assertEqual(np.count_nonzero(counts), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,10 +16,14 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 
+import os
 import unittest
+import tempfile
+
 import numpy as np
 
 from quantiphyse.data import ImageVolumeManagement, NumpyData, DataGrid
+import quantiphyse.data.nifti as nifti
 
 GRIDSIZE = 5
 
@@ -183,5 +187,92 @@ class IVMTest(unittest.TestCase):
         self.assertEqual(self.ivm.main, self.ivm.data["test2"])
         self.assertTrue(np.all(self.ivm.data["test2"].raw() == qpd.raw()))
 
+    def testMemoryUsage(self):
+        shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        grid = DataGrid(shape, np.identity(4))
+        qpd = NumpyData(np.random.rand(*shape), name="test", grid=grid)
+        self.ivm.add(qpd)
+        self.assertEqual(self.ivm.memory_usage(), {"test" : qpd.raw().nbytes})
+
+    def testMemoryBudget(self):
+        shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        grid = DataGrid(shape, np.identity(4))
+        arrays = [np.random.rand(*shape) for idx in range(4)]
+        nbytes = NumpyData(arrays[0], name="test", grid=grid).raw().nbytes
+        self.ivm.memory_budget = 2 * nbytes
+        for idx, arr in enumerate(arrays):
+            self.ivm.add(NumpyData(arr, name="test%i" % idx, grid=grid))
+
+        # Main data and current data are kept, least recently used data is spilled
+        usage = self.ivm.memory_usage()
+        self.assertTrue(sum(usage.values()) <= self.ivm.memory_budget)
+        self.assertEqual(usage["test0"], nbytes)
+        self.assertEqual(usage["test1"], nbytes)
+        self.assertEqual(usage["test2"], 0)
+        self.assertEqual(usage["test3"], 0)
+
+        # Making data current reloads it and spills the least recently used data
+        self.ivm.set_current_data("test2")
+        self.ivm.data["test2"].raw()
+        self.ivm.check_memory()
+        usage = self.ivm.memory_usage()
+        self.assertEqual(usage["test1"], 0)
+        self.assertEqual(usage["test2"], nbytes)
+
+        # Spilled data is reloaded when required
+        for idx, arr in enumerate(arrays):
+            self.assertTrue(np.allclose(self.ivm.data["test%i" % idx].raw(), arr))
+
+    def testMemoryBudgetPinned(self):
+        shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        grid = DataGrid(shape, np.identity(4))
+        arrays = [np.random.rand(*shape) for idx in range(4)]
+        self.ivm.memory_budget = 0
+        for idx, arr in enumerate(arrays):
+            self.ivm.add(NumpyData(arr, name="test%i" % idx, grid=grid))
+        self.assertEqual(self.ivm.memory_usage()["test2"], 0)
+
+        # Pinned data is kept in memory, and the pin follows the data when renamed
+        pinned_data = self.ivm.data["test2"].raw()
+        self.ivm.pin("test2")
+        self.ivm.rename("test2", "pinned")
+        self.ivm.check_memory()
+        self.assertTrue(self.ivm.data["pinned"].raw() is pinned_data)
+        self.ivm.check_memory()
+        self.assertTrue(self.ivm.data["pinned"].raw() is pinned_data)
+
+        self.ivm.unpin("pinned")
+        self.assertEqual(self.ivm.memory_usage()["pinned"], 0)
+
+        # Unpinning deleted data does nothing
+        self.ivm.pin("test3")
+        self.ivm.delete("test3")
+        self.ivm.unpin("test3")
+
+    def testMemoryBudgetModifiedNifti(self):
+        shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        grid = DataGrid(shape, np.identity(4))
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, "test.nii")
+        nifti.save(NumpyData(np.zeros(shape), name="test", grid=grid), fname)
+
+        self.ivm.add(NumpyData(np.random.rand(*shape), name="main", grid=grid))
+        self.ivm.add(NumpyData(np.random.rand(*shape), name="current", grid=grid))
+        nifti_data = nifti.NiftiData(fname)
+        self.ivm.add(nifti_data, name="modified", make_current=False)
+        self.ivm.memory_budget = 0
+
+        # Data modified in place is not removed from memory
+        nifti_data.raw()[0, 0, 0] = 7
+        nifti_data.clear_cache()
+        self.ivm.check_memory()
+        self.assertEqual(nifti_data.raw()[0, 0, 0], 7)
+
+        # Unmodified data is re-read from the file
+        nifti_data = nifti.NiftiData(fname)
+        nifti_data.raw()[0, 0, 0] = 7
+        self.ivm.add(nifti_data, name="unmodified", make_current=False)
+        self.assertEqual(nifti_data.raw()[0, 0, 0], 0)
+
 if __name__ == '__main__':
     unittest.main()
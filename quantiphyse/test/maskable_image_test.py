@@ -0,0 +1,109 @@
+"""
+Quantiphyse - tests for masked image rendering
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import unittest
+
+import numpy as np
+
+try:
+    from PySide import QtGui, QtCore, QtGui as QtWidgets
+except ImportError:
+    from PySide2 import QtGui, QtCore, QtWidgets
+
+# Data package must be imported before GUI modules
+import quantiphyse.data
+from quantiphyse.gui.viewer.maskable_image import MaskableImage
+from quantiphyse.gui.colors import get_lut
+from quantiphyse.utils.enums import Boundary
+
+SHAPE = (20, 15)
+
+def _argb(img):
+    """ Rendered image as an array of ARGB bytes """
+    qimage = img.qimage
+    data = np.frombuffer(qimage.constBits(), dtype=np.ubyte, count=qimage.byteCount())
+    return data.reshape(qimage.height(), qimage.bytesPerLine() // 4, 4)[:, :qimage.width()].copy()
+
+class MaskableImageTest(unittest.TestCase):
+
+    def setUp(self):
+        if QtCore.QCoreApplication.instance() is None:
+            self.app = QtWidgets.QApplication([])
+        elif not isinstance(QtCore.QCoreApplication.instance(), QtWidgets.QApplication):
+            self.skipTest("Graphics items require a GUI application")
+
+    def _compare(self, image, levels, boundary, mask=None):
+        """ 
+        Check rendering via the lookup table matches direct rendering. RGB values 
+        of transparent pixels are not significant
+        """
+        img = MaskableImage()
+        img.setLookupTable(get_lut("jet", 200))
+        img.set_boundary_mode(boundary)
+        img.setImage(image, autoLevels=False)
+        img.mask = mask
+        img.setLevels(levels)
+        img.render()
+        self.assertTrue(img._indices is not None)
+        rendered = _argb(img)
+
+        img._render_direct(img.lut)
+        expected = _argb(img)
+        visible = expected[..., 3] > 0
+        self.assertTrue(np.all(rendered[..., 3] == expected[..., 3]))
+        self.assertTrue(np.all(rendered[visible] == expected[visible]))
+
+    def testInt(self):
+        image = np.random.randint(-5, 30, SHAPE).astype(np.int32)
+        for boundary in (Boundary.TRANS, Boundary.CLAMP, Boundary.LOWERTRANS, Boundary.UPPERTRANS):
+            self._compare(image, (5, 20), boundary)
+
+    def testIntMasked(self):
+        image = np.random.randint(0, 30, SHAPE).astype(np.int16)
+        mask = np.random.randint(0, 2, SHAPE)
+        self._compare(image, (5, 20), Boundary.TRANS, mask)
+        self._compare(image, (5, 20), Boundary.CLAMP, mask)
+
+    def testConstant(self):
+        image = np.full(SHAPE, 3.5)
+        self._compare(image, (0, 10), Boundary.TRANS)
+
+    def testLevelsChange(self):
+        img = MaskableImage()
+        img.setLookupTable(get_lut("jet", 200))
+        img.setImage(np.random.rand(*SHAPE) * 100, autoLevels=False)
+        img.setLevels((0, 100))
+        img.render()
+        indices = img._indices
+        img.setLevels((20, 50))
+        img.render()
+        # Image is not quantised again when only the levels change
+        self.assertTrue(img._indices is indices)
+
+    def testNonFinite(self):
+        image = np.random.rand(*SHAPE)
+        image[0, 0] = np.nan
+        img = MaskableImage()
+        img.setImage(image, autoLevels=False)
+        img.setLevels((0, 1))
+        img.render()
+        self.assertTrue(img._index_values is None)
+        self.assertFalse(img.qimage.isNull())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -19,10 +19,14 @@ limitations under the License.
 import os
 import unittest
 import tempfile
+import threading
 
 import numpy as np
+import scipy.ndimage
+import nibabel as nib
 
 from quantiphyse.data import NumpyData, DataGrid
+import quantiphyse.data.qpdata as qpdata
 import quantiphyse.data.nifti as nifti
 
 GRIDSIZE = 5
@@ -81,6 +85,14 @@ class NumpyDataTest(unittest.TestCase):
         mx, mn = np.max(self.floats), np.min(self.floats)
         self.assertAlmostEqual(qpd.range()[0], mn)
         self.assertAlmostEqual(qpd.range()[1], mx)
+
+    def testRangeCleared(self):
+        qpd = NumpyData(self.floats, grid=self.grid, name="test")
+        self.assertAlmostEqual(qpd.range()[1], np.max(self.floats))
+        # Modifying the data in place means the stored range is not used
+        qpd.raw()[0, 0, 0] = 2
+        qpd.clear_cache()
+        self.assertAlmostEqual(qpd.range()[1], 2)
         
     def testSet2dt(self):
         qpd = NumpyData(self.floats, grid=self.grid, name="test")
@@ -100,6 +112,101 @@ class NumpyDataTest(unittest.TestCase):
         for idx in range(NVOLS):
             self.assertTrue(np.allclose(qpd.volume(idx), self.floats4d[..., idx]))
         
+    def testUncache(self):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        self.assertEqual(qpd.resident_size, qpd.raw().nbytes)
+        qpd.uncache()
+        self.assertEqual(qpd.resident_size, 0)
+        self.assertEqual(qpd.dtype, np.float32)
+        self.assertEqual(qpd.resident_size, 0)
+        self.assertTrue(np.allclose(qpd.raw(), self.floats4d))
+        self.assertEqual(qpd.resident_size, qpd.raw().nbytes)
+
+    def testResampleCached(self):
+        qpd = NumpyData(self.floats, grid=self.grid, name="test")
+        grid = DataGrid([GRIDSIZE*2, GRIDSIZE*2, GRIDSIZE*2], np.identity(4) * 0.5)
+        resampled = qpd.resample(grid, order=1)
+        self.assertEqual(len(qpd._resample_cache), 1)
+        resampled2 = qpd.resample(grid, order=1)
+        self.assertEqual(len(qpd._resample_cache), 1)
+        self.assertTrue(np.all(resampled.raw() == resampled2.raw()))
+        self.assertFalse(resampled.raw() is resampled2.raw())
+
+        # Different interpolation order is cached separately
+        qpd.resample(grid, order=0)
+        self.assertEqual(len(qpd._resample_cache), 2)
+
+        # Modifying data in place requires the cache to be cleared
+        qpd.raw()[:] = 0
+        qpd.clear_cache()
+        self.assertEqual(len(qpd._resample_cache), 0)
+        self.assertTrue(np.all(qpd.resample(grid, order=1).raw() == 0))
+
+    def _resample_grid(self):
+        # Axis-aligned scaling and translation, avoiding co-ordinates exactly half way
+        # between voxels where the choice of nearest neighbour is arbitrary
+        affine = np.diag([0.7, 1.3, 0.45, 1])
+        affine[:3, 3] = [-0.37, 0.21, 0.13]
+        return DataGrid([8, 4, 11], affine), affine
+
+    def testResampleSeparable(self):
+        grid, affine = self._resample_grid()
+        for order in (0, 1):
+            expected = scipy.ndimage.affine_transform(self.floats, np.diagonal(affine)[:3], offset=affine[:3, 3],
+                                                      output_shape=grid.shape, order=order)
+            qpd = NumpyData(self.floats, grid=self.grid, name="test")
+            self.assertTrue(np.allclose(qpd.resample(grid, order=order).raw(), expected, atol=1e-6))
+
+    def testResampleSeparable4d(self):
+        grid, affine = self._resample_grid()
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        resampled = qpd.resample(grid, order=1).raw()
+        self.assertEqual(list(resampled.shape), list(grid.shape) + [NVOLS])
+        for vol in range(NVOLS):
+            expected = scipy.ndimage.affine_transform(self.floats4d[..., vol], np.diagonal(affine)[:3], offset=affine[:3, 3],
+                                                      output_shape=grid.shape, order=1)
+            self.assertTrue(np.allclose(resampled[..., vol], expected, atol=1e-6))
+
+    def testResampleRoi(self):
+        grid, affine = self._resample_grid()
+        qpd = NumpyData(self.ints, grid=self.grid, name="test", roi=True)
+        resampled = qpd.resample(grid)
+        expected = scipy.ndimage.affine_transform(self.ints, np.diagonal(affine)[:3], offset=affine[:3, 3],
+                                                  output_shape=grid.shape, order=0)
+        self.assertTrue(resampled.roi)
+        self.assertTrue(np.all(resampled.raw() == expected))
+
+    def testResampleNonOrthogonal(self):
+        grid, affine = self._resample_grid()
+        affine[0, 1] = 0.2
+        grid = DataGrid(grid.shape, affine)
+        qpd = NumpyData(self.floats, grid=self.grid, name="test")
+        expected = scipy.ndimage.affine_transform(self.floats, affine[:3, :3], offset=affine[:3, 3],
+                                                  output_shape=grid.shape, order=1)
+        self.assertTrue(np.allclose(qpd.resample(grid, order=1).raw(), expected, atol=1e-6))
+
+    def testVersion(self):
+        qpd = NumpyData(self.floats, grid=self.grid, name="test")
+        self.assertEqual(qpd.version, 0)
+        qpd.clear_cache()
+        self.assertEqual(qpd.version, 1)
+        # Removing data from memory does not change it
+        qpd.uncache()
+        self.assertEqual(qpd.version, 1)
+
+    def testResampleCacheSize(self):
+        resample_cache_size = qpdata.RESAMPLE_CACHE_SIZE
+        qpd = NumpyData(self.floats, grid=self.grid, name="test")
+        grid = DataGrid([GRIDSIZE*2, GRIDSIZE*2, GRIDSIZE*2], np.identity(4) * 0.5)
+        qpdata.RESAMPLE_CACHE_SIZE = qpd.resample(grid).raw().nbytes
+        try:
+            qpd.resample(grid, order=1)
+            self.assertEqual(len(qpd._resample_cache), 1)
+            self.assertEqual(list(qpd._resample_cache.keys())[0][2], 1)
+            self.assertEqual(qpd.resident_size, qpd.raw().nbytes * 9)
+        finally:
+            qpdata.RESAMPLE_CACHE_SIZE = resample_cache_size
+
     def testValue3d(self):
         qpd = NumpyData(self.floats, grid=self.grid, name="test")
         POS = [2, 3, 4]
@@ -160,5 +267,127 @@ class NiftiDataTest(unittest.TestCase):
         nifti_data = nifti.NiftiData(fname)
         nifti.save(nifti_data, fname)
 
+    def _save_4d(self, fname="test.nii"):
+        qpd = NumpyData(self.floats4d, grid=self.grid, name="test")
+        tempdir = tempfile.mkdtemp(prefix="qp")
+        fname = os.path.join(tempdir, fname)
+        nifti.save(qpd, fname)
+        return nifti.NiftiData(fname)
+
+    def testMmap(self):
+        mmap_min_size = nifti.MMAP_MIN_SIZE
+        nifti.MMAP_MIN_SIZE = 0
+        try:
+            nifti_data = self._save_4d()
+            self.assertTrue(isinstance(nifti_data.raw(), np.memmap))
+            self.assertTrue(np.allclose(nifti_data.raw(), self.floats4d))
+            self.assertTrue(np.allclose(nifti_data.volume(2), self.floats4d[..., 2]))
+            self.assertAlmostEqual(nifti_data.range()[0], np.min(self.floats4d), places=5)
+            self.assertAlmostEqual(nifti_data.range()[1], np.max(self.floats4d), places=5)
+        finally:
+            nifti.MMAP_MIN_SIZE = mmap_min_size
+
+    def testNoMmapCompressed(self):
+        mmap_min_size = nifti.MMAP_MIN_SIZE
+        nifti.MMAP_MIN_SIZE = 0
+        try:
+            nifti_data = self._save_4d("test.nii.gz")
+            self.assertFalse(isinstance(nifti_data.raw(), np.memmap))
+            self.assertTrue(np.allclose(nifti_data.raw(), self.floats4d))
+        finally:
+            nifti.MMAP_MIN_SIZE = mmap_min_size
+
+    def testVoxelNoLoad(self):
+        nifti_data = self._save_4d()
+        nifti_data.uncache()
+        POS = [2, 3, 4]
+        self.assertTrue(np.allclose(nifti_data.timeseries(POS), self.floats4d[POS[0], POS[1], POS[2], :]))
+        self.assertAlmostEqual(nifti_data.value(POS + [1,]), self.floats4d[POS[0], POS[1], POS[2], 1], places=5)
+        self.assertEqual(nifti_data.timeseries([GRIDSIZE, 0, 0]), [])
+        self.assertEqual(nifti_data.value([0, 0, GRIDSIZE]), 0)
+        # Neither the full data nor any volumes should have been loaded
+        self.assertTrue(nifti_data.rawdata is None)
+        self.assertTrue(nifti_data.voldata is None)
+
+    def testRangeNoLoad(self):
+        nifti_data = self._save_4d()
+        nifti_data.uncache()
+        self.assertAlmostEqual(nifti_data.range()[0], np.min(self.floats4d), places=5)
+        self.assertAlmostEqual(nifti_data.range()[1], np.max(self.floats4d), places=5)
+        # Range is found one volume at a time
+        self.assertTrue(nifti_data.rawdata is None)
+
+    def testDtypeNoLoad(self):
+        nifti_data = self._save_4d()
+        nifti_data.uncache()
+        self.assertEqual(nifti_data.dtype, np.float32)
+        self.assertTrue(nifti_data.rawdata is None)
+        self.assertEqual(nifti_data.dtype, nifti_data.raw().dtype)
+
+        # Scaled integer data is loaded as floating point
+        nii = nib.Nifti1Image(self.ints.astype(np.int16), self.grid.affine)
+        nii.header.set_slope_inter(2.0, 1.0)
+        fname = os.path.join(tempfile.mkdtemp(prefix="qp"), "scaled.nii")
+        nii.to_filename(fname)
+        nifti_data = nifti.NiftiData(fname)
+        nifti_data.uncache()
+        self.assertEqual(nifti_data.dtype.kind, "f")
+        self.assertTrue(nifti_data.rawdata is None)
+        self.assertEqual(nifti_data.dtype, nifti_data.raw().dtype)
+
+    def testVoxelCompressed(self):
+        # Compressed data is loaded rather than decompressing the file on every voxel lookup
+        nifti_data = self._save_4d("test.nii.gz")
+        nifti_data.uncache()
+        POS = [2, 3, 4]
+        self.assertTrue(np.allclose(nifti_data.timeseries(POS), self.floats4d[POS[0], POS[1], POS[2], :]))
+        self.assertTrue(nifti_data.rawdata is not None)
+        self.assertTrue(nifti_data._voxel_image is None)
+
+    def testVolumeCacheEviction(self):
+        volume_cache_size = nifti.VOLUME_CACHE_SIZE
+        try:
+            nifti_data = self._save_4d()
+            nifti.VOLUME_CACHE_SIZE = 2 * nifti_data.volume(0).nbytes
+            for vol in range(NVOLS):
+                self.assertTrue(np.allclose(nifti_data.volume(vol), self.floats4d[..., vol]))
+            # Only the two most recently used volumes are kept
+            self.assertEqual(len([vol for vol in nifti_data.voldata if vol is not None]), 2)
+            self.assertTrue(nifti_data.voldata[NVOLS-1] is not None)
+            self.assertTrue(nifti_data.voldata[NVOLS-2] is not None)
+        finally:
+            nifti.VOLUME_CACHE_SIZE = volume_cache_size
+
+    def testVolumeThreaded(self):
+        # Volumes may be read from background threads while the cache is evicting them
+        volume_cache_size = nifti.VOLUME_CACHE_SIZE
+        try:
+            nifti_data = self._save_4d()
+            nifti.VOLUME_CACHE_SIZE = nifti_data.volume(0).nbytes
+            errors = []
+            def _read_volumes(start):
+                try:
+                    for idx in range(50):
+                        vol = (start + idx) % NVOLS
+                        self.assertTrue(np.allclose(nifti_data.volume(vol), self.floats4d[..., vol]))
+                        nifti_data.slice_data(qpdata.OrthoSlice(nifti_data.grid, 2, 1), vol=vol)
+                except Exception as exc:
+                    errors.append(exc)
+            threads = [threading.Thread(target=_read_volumes, args=(start,)) for start in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(errors, [])
+        finally:
+            nifti.VOLUME_CACHE_SIZE = volume_cache_size
+
+    def testUncache(self):
+        nifti_data = self._save_4d()
+        nifti_data.raw()
+        nifti_data.uncache()
+        self.assertTrue(nifti_data.rawdata is None)
+        self.assertTrue(np.allclose(nifti_data.raw(), self.floats4d))
+
 if __name__ == '__main__':
     unittest.main()
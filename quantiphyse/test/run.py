@@ -6,8 +6,14 @@ from .ivm_test import IVMTest
 from .qpd_test import NumpyDataTest, NiftiDataTest
 from .slice_plane_test import OrthoSliceTest
 from .io_test import IoProcessTest
-
-class_tests = [IVMTest, NumpyDataTest, NiftiDataTest, OrthoSliceTest, IoProcessTest,]
+from .bg_process_test import BackgroundProcessTest
+from .batch_test import BatchScriptTest
+from .stats_test import RegionStatsTest
+from .contour_test import LabelBoundariesTest
+from .maskable_image_test import MaskableImageTest
+from .histogram_test import VolumeHistogramTest
+
+class_tests = [IVMTest, NumpyDataTest, NiftiDataTest, OrthoSliceTest, IoProcessTest, BackgroundProcessTest, BatchScriptTest, RegionStatsTest, LabelBoundariesTest, MaskableImageTest, VolumeHistogramTest,]
 
 def run_tests(test_filter=None):
     """
@@ -207,5 +207,27 @@ class OrthoSliceTest(unittest.TestCase):
             self.assertTrue(np.all(xdata[x,:] == x))
             self.assertTrue(np.all(zdata[:,x] == x))
 
+    def testObliqueModified(self):
+        grid = DataGrid((GRIDSIZE, GRIDSIZE, GRIDSIZE), np.identity(4))
+        plane = OrthoSlice(grid, ZAXIS, 1)
+
+        # Rotate data grid about X axis so slices are not orthogonal to the data
+        angle = np.radians(30)
+        affine = np.identity(4)
+        affine[1:3, 1:3] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+        datagrid = DataGrid((GRIDSIZE, GRIDSIZE, GRIDSIZE), affine)
+        qpd = NumpyData(np.full(datagrid.shape, 5.0), name="test", grid=datagrid)
+
+        sdata, smask, _, _ = qpd.slice_data(plane)
+        self.assertTrue(np.any(smask == 0))
+        self.assertTrue(np.all(sdata[smask > 0] == 5))
+
+        # Data minimum used to generate the mask must be updated when data is modified
+        qpd.raw()[:] = -5
+        qpd.clear_cache()
+        sdata2, smask2, _, _ = qpd.slice_data(plane)
+        self.assertTrue(np.all(smask2 == smask))
+        self.assertTrue(np.all(sdata2[smask2 > 0] == -5))
+
 if __name__ == '__main__':
     unittest.main()
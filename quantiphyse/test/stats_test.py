@@ -0,0 +1,138 @@
+"""
+Quantiphyse - tests for region statistics
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+import unittest
+
+import numpy as np
+
+from quantiphyse.utils import stats
+
+GRIDSIZE = 10
+NVOLS = 4
+REGIONS = [1, 2, 5]
+
+class RegionStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.shape = [GRIDSIZE, GRIDSIZE, GRIDSIZE]
+        self.data = np.random.rand(*self.shape)
+        self.data4d = np.random.rand(*(self.shape + [NVOLS,]))
+        # Region 5 is empty, label 3 is not one of the regions
+        self.labels = np.random.choice([0, 1, 2, 3], size=self.shape)
+
+    def _check(self, region_stats, region, arr):
+        self.assertAlmostEqual(region_stats["mean"][region], np.mean(arr))
+        self.assertAlmostEqual(region_stats["median"][region], np.median(arr))
+        self.assertAlmostEqual(region_stats["std"][region], np.std(arr))
+        self.assertAlmostEqual(region_stats["min"][region], np.min(arr))
+        self.assertAlmostEqual(region_stats["max"][region], np.max(arr))
+        self.assertEqual(region_stats["count"][region], arr.size)
+
+    def testCounts(self):
+        counts = stats.region_counts(self.labels, REGIONS)
+        self.assertEqual(list(counts), [np.count_nonzero(self.labels == region) for region in REGIONS])
+
+    def testNoRoi(self):
+        region_stats = stats.region_stats(self.data)
+        self._check(region_stats, 0, self.data)
+
+    def testRegions(self):
+        region_stats = stats.region_stats(self.data, self.labels, REGIONS, exact_median=True)
+        self._check(region_stats, 0, self.data[self.labels == 1])
+        self._check(region_stats, 1, self.data[self.labels == 2])
+        for key in ("mean", "median", "std", "min", "max", "count"):
+            self.assertEqual(region_stats[key][2], 0)
+
+    def testDefaultRegions(self):
+        region_stats = stats.region_stats(self.data, self.labels)
+        self.assertEqual(len(region_stats["mean"]), 3)
+        self._check(region_stats, 2, self.data[self.labels == 3])
+
+    def testNan(self):
+        self.data[0, 0, 0] = np.nan
+        self.labels[0, 0, 0] = 1
+        region_stats = stats.region_stats(self.data, self.labels, REGIONS)
+        self.assertAlmostEqual(region_stats["mean"][0], np.nanmean(self.data[self.labels == 1]))
+        self.assertEqual(region_stats["count"][0], np.count_nonzero(self.labels == 1) - 1)
+
+    def testNanNotIgnored(self):
+        self.data[0, 0, 0] = np.nan
+        self.labels[0, 0, 0] = 1
+        region_stats = stats.region_stats(self.data, self.labels, REGIONS, ignore_nan=False)
+        for key in ("mean", "median", "std", "min", "max"):
+            self.assertTrue(np.isnan(region_stats[key][0]))
+        self.assertEqual(region_stats["count"][0], np.count_nonzero(self.labels == 1))
+        self._check(region_stats, 1, self.data[self.labels == 2])
+
+    def test4dCombined(self):
+        region_stats = stats.region_stats(self.data4d, self.labels, REGIONS)
+        self._check(region_stats, 0, self.data4d[self.labels == 1])
+
+    def test4dPerVolume(self):
+        region_stats = stats.region_stats(self.data4d, self.labels, REGIONS, per_volume=True)
+        self.assertEqual(region_stats["mean"].shape, (len(REGIONS), NVOLS))
+        for vol in range(NVOLS):
+            self.assertAlmostEqual(region_stats["mean"][1, vol], np.mean(self.data4d[..., vol][self.labels == 2]))
+            self.assertAlmostEqual(region_stats["max"][1, vol], np.max(self.data4d[..., vol][self.labels == 2]))
+
+    def testPercentiles(self):
+        region_stats = stats.region_stats(self.data, self.labels, REGIONS, percentiles=[10, 90])
+        self.assertEqual(region_stats["percentiles"].shape, (len(REGIONS), 2))
+        self.assertAlmostEqual(region_stats["percentiles"][0, 0], np.percentile(self.data[self.labels == 1], 10))
+        self.assertAlmostEqual(region_stats["percentiles"][0, 1], np.percentile(self.data[self.labels == 1], 90))
+
+    def testApproxMedian(self):
+        max_median_samples = stats.MAX_MEDIAN_SAMPLES
+        stats.MAX_MEDIAN_SAMPLES = 100
+        try:
+            region_stats = stats.region_stats(self.data, self.labels, REGIONS)
+            # Min and max are still exact
+            self._check_approx(region_stats, 0, self.data[self.labels == 1])
+        finally:
+            stats.MAX_MEDIAN_SAMPLES = max_median_samples
+
+    def _check_approx(self, region_stats, region, arr):
+        self.assertAlmostEqual(region_stats["mean"][region], np.mean(arr))
+        self.assertAlmostEqual(region_stats["median"][region], np.median(arr), delta=0.2)
+        self.assertAlmostEqual(region_stats["min"][region], np.min(arr))
+        self.assertAlmostEqual(region_stats["max"][region], np.max(arr))
+
+    def testHistogram(self):
+        hist, edges = stats.region_histogram([self.data], self.labels, REGIONS, bins=10, hrange=(0, 1))
+        self.assertEqual(hist.shape, (len(REGIONS), 10))
+        for idx, region in enumerate(REGIONS):
+            expected, expected_edges = np.histogram(self.data[self.labels == region], 10, range=(0, 1))
+            self.assertEqual(list(hist[idx]), list(expected))
+        self.assertTrue(np.allclose(edges, expected_edges))
+
+    def testHistogramVolumes(self):
+        volumes = [self.data4d[..., vol] for vol in range(NVOLS)]
+        self.data4d[0, 0, 0, 0] = np.nan
+        hrange = (0.2, np.nanmax(self.data4d))
+        hist, _ = stats.region_histogram(volumes, bins=10, hrange=hrange)
+        data = self.data4d[~np.isnan(self.data4d)]
+        expected, _ = np.histogram(data, 10, range=hrange)
+        self.assertEqual(list(hist[0]), list(expected))
+
+    def testHistogramDensity(self):
+        hist, edges = stats.region_histogram([self.data], self.labels, REGIONS[:2], bins=10, hrange=(0, 1), density=True)
+        expected, _ = np.histogram(self.data[self.labels == 2], 10, range=(0, 1), density=True)
+        self.assertTrue(np.allclose(hist[1], expected))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -35,6 +35,9 @@ import traceback
 import time
 import collections
 import logging
+import copy
+import tempfile
+import multiprocessing
 
 import six
 import yaml
@@ -138,7 +141,17 @@ class Script(Process):
 
     A batch script can be run on a specified IVM, or it can be
     run on its cases. In this case a new IVM is created for
-    each case
+    each case.
+
+    If the generic option ``Parallel`` is greater than 1 and the script
+    is not being run on a specified IVM, up to this number of cases are
+    run at the same time, each in a separate Quantiphyse process. The output
+    of each case is captured and added to the log when the case completes.
+
+    Attributes:
+
+      failed_cases - IDs of cases in which a process failed, or whose case process
+                     failed to start or exited with an error
     """
 
     PROCESS_NAME = "Script"
@@ -174,6 +187,11 @@ class Script(Process):
         self._error_action = kwargs.get("error_action", Script.IGNORE)
         self._embed_log = kwargs.get("embed_log", False)
         self._output_items = []
+        self._yaml_root = {}
+        self._parallel = 1
+        self._case_processes = {}
+        self._cases_done = 0
+        self.failed_cases = []
 
         # Find all the process implementations
         self.known_processes = dict(BASIC_PROCESSES)
@@ -213,19 +231,36 @@ class Script(Process):
             root = {}
 
         # Can set mode=check to just validate the YAML
+        self._yaml_root = copy.deepcopy(root)
         self._load_yaml(root)
         self.debug(self._pipeline)
         self._output_items = []
+        self._parallel = int(self._generic_params.pop("Parallel", 1))
+        if self._parallel > 1 and (self.ivm is not None or len(self._cases) < 2):
+            self.debug("Not running cases in parallel")
+            self._parallel = 1
         mode = options.pop("mode", "run")
         if mode == "run":
             self.status = Process.RUNNING
             self._case_num = 0
-            self._next_case()
+            self.failed_cases = []
+            if self._parallel > 1:
+                self._cases_done = 0
+                for _ in range(self._parallel):
+                    self._start_case_process()
+            else:
+                self._next_case()
         elif mode != "check":
             raise QpException("Unknown mode: %s" % mode)
 
     def cancel(self):
-        if self._current_process is not None:
+        if self._case_processes:
+            self.status = Process.CANCELLED
+            self.exception = Exception("Script was cancelled")
+            for proc in list(self._case_processes.keys()):
+                proc.kill()
+            self._complete()
+        elif self._current_process is not None:
             self._current_process.cancel()
     
     def _load_yaml(self, root=None):
@@ -278,6 +313,96 @@ class Script(Process):
             self.status = Process.SUCCEEDED
             self._complete()
 
+    def _start_case_process(self):
+        """
+        Start the next case in a separate process, when running cases in parallel
+
+        The case is written out as a single-case batch file which is run using
+        the Quantiphyse command line. The worker pool size is divided between the
+        case processes so they do not compete for CPUs.
+        """
+        if self.status != self.RUNNING or self._case_num >= len(self._cases):
+            return
+
+        case = self._cases[self._case_num]
+        self._case_num += 1
+
+        case_root = copy.deepcopy(self._yaml_root)
+        case_root.pop("Parallel", None)
+        case_root["Cases"] = {case.case_id : case.params}
+        with tempfile.NamedTemporaryFile(mode="w", prefix="qp_case_", suffix=".yml", delete=False) as yaml_file:
+            yaml.dump(case_root, yaml_file, default_flow_style=False)
+            fname = yaml_file.name
+
+        args = []
+        if not getattr(sys, "frozen", False):
+            args += ["-m", "quantiphyse"]
+        args += ["--batch", fname, "--batch-exit-status", "--workers", str(max(1, multiprocessing.cpu_count() // self._parallel))]
+        if "--debug" in sys.argv:
+            args.append("--debug")
+
+        # Make sure the case process imports the same Quantiphyse package as we are using
+        env = QtCore.QProcessEnvironment.systemEnvironment()
+        pkgdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env.insert("PYTHONPATH", os.pathsep.join([os.path.dirname(pkgdir)] + [p for p in [env.value("PYTHONPATH")] if p]))
+
+        proc = QtCore.QProcess()
+        proc.setProcessEnvironment(env)
+        proc.setProcessChannelMode(QtCore.QProcess.MergedChannels)
+        proc.finished.connect(lambda exit_code, exit_status=None, proc=proc: self._case_process_finished(proc, exit_code))
+        # If the process fails to start, 'finished' is never emitted
+        if hasattr(proc, "errorOccurred"):
+            proc.errorOccurred.connect(lambda error, proc=proc: self._case_process_error(proc, error))
+        else:
+            proc.error.connect(lambda error, proc=proc: self._case_process_error(proc, error))
+        self._case_processes[proc] = (case, fname)
+
+        self.sig_start_case.emit(case)
+        self.debug("Starting case %s in separate process: %s %s", case.case_id, sys.executable, args)
+        proc.start(sys.executable, args)
+
+    def _case_process_error(self, proc, error):
+        if error == QtCore.QProcess.FailedToStart:
+            self._case_process_finished(proc, None)
+
+    def _case_process_finished(self, proc, exit_code):
+        """
+        :param exit_code: Exit code of the case process, or None if it failed to start
+        """
+        if proc not in self._case_processes:
+            return
+
+        case, fname = self._case_processes.pop(proc)
+        try:
+            os.remove(fname)
+        except OSError:
+            self.warn("Failed to remove temporary batch file: %s", fname)
+
+        case.output = bytes(proc.readAllStandardOutput()).decode("utf-8", "replace")
+        proc.deleteLater()
+        if self.status != self.RUNNING:
+            return
+
+        if exit_code is None:
+            case.output += "Failed to start case process: %s\n" % proc.errorString()
+        self.log(case.output)
+        if exit_code != 0:
+            self.failed_cases.append(case.case_id)
+            if exit_code is None:
+                self.log("CASE FAILED: could not start process\n")
+            else:
+                self.log("CASE FAILED: %i\n" % exit_code)
+        self.log("CASE COMPLETE\n")
+        self._cases_done += 1
+        self.sig_done_case.emit(case)
+        self.sig_progress.emit(float(self._cases_done) / len(self._cases))
+
+        self._start_case_process()
+        if not self._case_processes:
+            self.debug("All cases complete")
+            self.status = Process.SUCCEEDED
+            self._complete()
+
     def _start_case(self, case):
         if self.ivm is not None:
             self._current_ivm = self.ivm
@@ -375,6 +500,8 @@ class Script(Process):
         else:
             self.log("".join(traceback.format_exception_only(type(exception), exception)))
             self.log("\nFAILED: %i\n" % status)
+            if self._current_case is not None and self._current_case.case_id not in self.failed_cases:
+                self.failed_cases.append(self._current_case.case_id)
             if self._error_action == Script.IGNORE:
                 self.debug("Process failed - ignoring")
                 self._next_process()
@@ -412,6 +539,8 @@ class Case(object):
         if params is None:
             params = {}
         self.params = params
+        # Captured output when the case is run in a separate process
+        self.output = None
         # This would break compatibility so not for now
         #self.params["InputId"] = self.params.get("InputId", self.case_id)
 
@@ -428,6 +557,7 @@ class BatchScript(Script):
         self.stdout = stdout
         self.start = None
         self._quit_on_exit = kwargs.get("quit_on_exit", True)
+        self._exit_status = kwargs.get("exit_status", False)
 
         self.sig_start_case.connect(self._log_start_case)
         self.sig_done_case.connect(self._log_done_case)
@@ -438,11 +568,17 @@ class BatchScript(Script):
         self.sig_finished.connect(self._log_done_script)
 
     def _log_start_case(self, case):
+        if self._parallel > 1:
+            # Output from cases running in parallel is written in one block when 
+            # each case completes so it is not interleaved
+            return
         self.stdout.write("Processing case: %s\n" % case.case_id)
         sys.stdout.flush()
 
     def _log_done_case(self, case):
-        pass
+        if case.output is not None:
+            self.stdout.write(case.output)
+            sys.stdout.flush()
 
     def _log_start_process(self, process, params):
         self.start = time.time()
@@ -479,12 +615,19 @@ class BatchScript(Script):
     def _log_done_script(self):
         if self.status == Process.SUCCEEDED:
             self.stdout.write("Script finished\n")
+            if self.failed_cases:
+                self.stdout.write("Failed cases: %s\n" % ", ".join(self.failed_cases))
         else:
             self.stdout.write(" FAILED: %i\n" % self.status)
             self.warn(str(self.exception))
             self.debug("".join(traceback.format_exception_only(type(self.exception), self.exception)))
         sys.stdout.flush()
-        if self._quit_on_exit:
+        if self._quit_on_exit and self._exit_status:
+            # Exit code is non-zero if the script or any of its cases failed. This is used
+            # by case processes so the parent script can tell whether the case failed
+            success = self.status == Process.SUCCEEDED and not self.failed_cases
+            QtCore.QCoreApplication.instance().exit(0 if success else 1)
+        elif self._quit_on_exit:
             QtCore.QCoreApplication.instance().quit()
 
     def _save_text(self, text, fname, ext="txt"):
@@ -0,0 +1,238 @@
+"""
+Quantiphyse - Statistics of data within labelled regions
+
+The statistics of all regions are calculated together by grouping voxels
+by region label, rather than by extracting the data for each region in turn
+which requires a pass through the whole data set for each region.
+
+Copyright (c) 2013-2020 University of Oxford
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+    http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+
+from __future__ import division
+
+import numpy as np
+
+#: If an exact median is not required, medians and percentiles of regions with
+#: more than this number of values are estimated from a random sample of this size
+MAX_MEDIAN_SAMPLES = 1000000
+
+def region_index(labels, regions):
+    """
+    Get the index of the region each voxel is in
+
+    :param labels: Integer array of region labels
+    :param regions: Sequence of region labels of interest
+    :return: Array with the same shape as ``labels`` containing the index of
+             each voxel's region in ``regions``, or -1 if not in any of them
+    """
+    labels = np.asarray(labels).astype(np.int64)
+    regions = np.asarray(regions, dtype=np.int64)
+    if regions.size == 0:
+        return np.full(labels.shape, -1, dtype=np.int64)
+
+    # Lookup table from label to region index, offset so negative labels can be included
+    offset = min(0, np.min(regions))
+    lut = np.full(np.max(regions) - offset + 1, -1, dtype=np.int64)
+    lut[regions - offset] = np.arange(len(regions))
+
+    idx = labels - offset
+    outside = np.logical_or(idx < 0, idx >= len(lut))
+    idx[outside] = 0
+    ret = lut[idx]
+    ret[outside] = -1
+    return ret
+
+def region_counts(labels, regions):
+    """
+    Count the voxels in each region
+
+    :param labels: Integer array of region labels
+    :param regions: Sequence of region labels
+    :return: Array of voxel counts for each region in ``regions``
+    """
+    idx = region_index(labels, regions).ravel()
+    return np.bincount(idx[idx >= 0], minlength=len(regions))
+
+def region_stats(data, labels=None, regions=None, per_volume=False, exact_median=False, percentiles=(), ignore_nan=True):
+    """
+    Calculate summary statistics of data within each of a set of regions
+
+    By default NaN values are ignored, as in ``np.nanmean`` etc. Regions containing
+    no values have all statistics set to zero.
+
+    :param data: Numpy array. Leading dimensions must match the shape of ``labels``.
+                 Any remaining dimensions are treated as volumes
+    :param labels: Integer array of region labels. If None, statistics are calculated
+                   for all the data as a single region, with volumes in the 4th dimension
+    :param regions: Sequence of region labels. If None, all non-zero labels are used
+    :param per_volume: If True, calculate separate statistics for each volume of
+                       multi-volume data. Otherwise all volumes are combined
+    :param exact_median: If True, calculate exact medians and percentiles. Otherwise,
+                         these are estimated from a sample of large regions. See
+                         ``MAX_MEDIAN_SAMPLES``
+    :param percentiles: Sequence of additional percentiles (0-100) to calculate
+    :param ignore_nan: If False, statistics other than ``count`` are NaN for regions
+                       containing NaN values, as in ``np.mean`` etc.
+    :return: Dictionary of statistic name (``mean``, ``median``, ``std``, ``min``, ``max``,
+             ``count`` and ``percentiles``) to Numpy array. The first dimension is the
+             region, followed by the volume if ``per_volume`` is True. The last dimension
+             of ``percentiles`` corresponds to the requested percentiles
+    """
+    data = np.asarray(data)
+    if labels is None:
+        idx = np.zeros(data.shape[:3], dtype=np.int64)
+        nregions = 1
+    else:
+        if regions is None:
+            regions = [region for region in np.unique(labels) if region != 0]
+        idx = region_index(labels, regions)
+        nregions = len(regions)
+    nvols = int(np.prod(data.shape[idx.ndim:]))
+
+    # Group index of each value, with a separate group for each volume if required
+    voxel_idx = idx.ravel()
+    in_region = voxel_idx >= 0
+    values = data.reshape(voxel_idx.size, nvols)[in_region].ravel()
+    if per_volume:
+        groups = np.repeat(voxel_idx[in_region] * nvols, nvols) + np.tile(np.arange(nvols), np.count_nonzero(in_region))
+        ngroups = nregions * nvols
+    else:
+        groups = np.repeat(voxel_idx[in_region], nvols)
+        ngroups = nregions
+
+    not_nan = ~np.isnan(values)
+    nan_counts = None
+    if not np.all(not_nan):
+        if not ignore_nan:
+            nan_counts = np.bincount(groups[~not_nan], minlength=ngroups)
+        values, groups = values[not_nan], groups[not_nan]
+
+    stats = _group_stats(values.astype(np.float64), groups, ngroups, exact_median, percentiles)
+    if nan_counts is not None:
+        has_nan = nan_counts > 0
+        for name, stat in stats.items():
+            if name != "count":
+                stat[has_nan] = np.nan
+        stats["count"] = stats["count"] + nan_counts
+    if per_volume:
+        for name, stat in stats.items():
+            stats[name] = stat.reshape([nregions, nvols] + list(stat.shape[1:]))
+    return stats
+
+def _group_stats(values, groups, ngroups, exact_median, percentiles):
+    counts = np.bincount(groups, minlength=ngroups)
+    nonempty = counts > 0
+    safe_counts = np.maximum(counts, 1)
+
+    mean = np.bincount(groups, weights=values, minlength=ngroups) / safe_counts
+    var = np.bincount(groups, weights=np.square(values - mean[groups]), minlength=ngroups) / safe_counts
+    std = np.sqrt(var)
+
+    # Minimum, maximum and percentiles from values sorted by group, then value
+    starts = np.cumsum(counts) - counts
+    dmin, dmax = np.zeros(ngroups), np.zeros(ngroups)
+    if exact_median or values.size <= MAX_MEDIAN_SAMPLES:
+        sorted_values = values[np.lexsort((values, groups))]
+        dmin[nonempty] = sorted_values[starts[nonempty]]
+        dmax[nonempty] = sorted_values[starts[nonempty] + counts[nonempty] - 1]
+        sample_values, sample_starts, sample_counts = sorted_values, starts, counts
+    else:
+        # Minimum and maximum from values grouped by region. Sampling is only
+        # needed for the median and percentiles
+        grouped_values = values[np.argsort(groups, kind="stable")]
+        dmin[nonempty] = np.minimum.reduceat(grouped_values, starts[nonempty])
+        dmax[nonempty] = np.maximum.reduceat(grouped_values, starts[nonempty])
+
+        keep_prob = np.minimum(1, MAX_MEDIAN_SAMPLES / safe_counts)
+        keep = np.random.random_sample(values.size) < keep_prob[groups]
+        sample_groups = groups[keep]
+        sample_values = values[keep][np.lexsort((values[keep], sample_groups))]
+        sample_counts = np.bincount(sample_groups, minlength=ngroups)
+        sample_starts = np.cumsum(sample_counts) - sample_counts
+
+    percentiles = [50] + list(percentiles)
+    percentile_values = np.zeros((ngroups, len(percentiles)))
+    has_samples = sample_counts > 0
+    for col, percentile in enumerate(percentiles):
+        # Linear interpolation between closest ranks, as np.percentile
+        pos = sample_starts[has_samples] + (sample_counts[has_samples] - 1) * percentile / 100.0
+        lower = np.floor(pos).astype(np.int64)
+        upper = np.ceil(pos).astype(np.int64)
+        frac = pos - lower
+        percentile_values[has_samples, col] = sample_values[lower] * (1 - frac) + sample_values[upper] * frac
+
+    return {
+        "mean" : np.where(nonempty, mean, 0),
+        "median" : percentile_values[:, 0],
+        "std" : np.where(nonempty, std, 0),
+        "min" : dmin,
+        "max" : dmax,
+        "count" : counts,
+        "percentiles" : percentile_values[:, 1:],
+    }
+
+def region_histogram(volumes, labels=None, regions=None, bins=100, hrange=None, density=False):
+    """
+    Calculate histograms of data within each of a set of regions
+
+    The data is supplied as a sequence of arrays, e.g. the volumes of a 4D data set,
+    which are processed one at a time so the whole data set is not needed in memory
+    at once. Bins are defined as for ``np.histogram``, and NaN values are ignored
+
+    :param volumes: Iterable of Numpy arrays whose shape matches ``labels``
+    :param labels: Integer array of region labels. If None, a histogram of all the data
+                   is calculated
+    :param regions: Sequence of region labels. If None, all non-zero labels are used
+    :param bins: Number of bins
+    :param hrange: Tuple of (min, max) for the histogram range. This is required
+    :param density: If True, return probability densities rather than counts
+    :return: Tuple of histogram values array with one row per region, and bin edges
+    """
+    hmin, hmax = [float(val) for val in hrange]
+    if hmin == hmax:
+        hmin, hmax = hmin - 0.5, hmax + 0.5
+    edges = np.linspace(hmin, hmax, bins + 1)
+
+    if labels is not None:
+        if regions is None:
+            regions = [region for region in np.unique(labels) if region != 0]
+        nregions = len(regions)
+        idx = region_index(labels, regions).ravel()
+        in_region = idx >= 0
+        idx = idx[in_region]
+    else:
+        nregions = 1
+
+    counts = np.zeros(nregions * bins, dtype=np.int64)
+    for voldata in volumes:
+        values = np.asarray(voldata).ravel()
+        if labels is not None:
+            values = values[in_region]
+            groups = idx
+        else:
+            groups = np.zeros(values.shape, dtype=np.int64)
+
+        # Values on the right hand edge go in the last bin, and values outside
+        # the range (or NaN) are ignored
+        in_range = np.logical_and(values >= hmin, values <= hmax)
+        values, groups = values[in_range], groups[in_range]
+        value_bins = np.minimum(np.searchsorted(edges, values, side="right") - 1, bins - 1)
+        counts += np.bincount(groups * bins + value_bins, minlength=nregions * bins)
+
+    hist = counts.reshape(nregions, bins)
+    if density:
+        totals = np.maximum(np.sum(hist, axis=1, keepdims=True), 1)
+        hist = hist / totals / np.diff(edges)
+    return hist, edges